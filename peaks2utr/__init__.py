@@ -36,14 +36,55 @@ def prepare_argparser():
                         help='a peak within this many bases of a gene\'s 5\'-end should be assumed to belong to it.')
     parser.add_argument('--skip-soft-clip', action="store_true",
                         help="skip the resource-intensive logic to pileup soft-clipped read edges.")
+    parser.add_argument('--shard-by-region', action="store_true",
+                        help="pileup soft-clipped reads over genomic regions in a pool of --processors processes, rather "
+                             "than splitting BAM file into read-groups with one process each.")
+    parser.add_argument('--single-pass-split', action="store_true",
+                        help="read BAM file once to write both forward and reverse strand BAM files together.")
+    parser.add_argument('--filter-strands-on-the-fly', action="store_true",
+                        help="pileup soft-clipped reads, and find zero coverage intervals with any --gap-engine but "
+                             "'bedtools', from indexed input BAM file, filtering strands by read flags, rather than from "
+                             "strand BAM files (implies --shard-by-region). Strand BAM files are then only written for "
+                             "--macs3-engine cli or --gap-engine bedtools.")
     parser.add_argument('--min-pileups', type=int, default=10, help='Minimum number of piled-up mapped reads for UTR cut-off.')
     parser.add_argument('--min-poly-tail', type=int, default=10,
                         help='Minimum length of poly-A/T tail considered in soft-clipped reads.')
+    parser.add_argument('--spat-json', action="store_true",
+                        help="also write merged SPAT pileups to json files in the cache directory, for debugging.")
+    parser.add_argument('--engine', choices=["peak", "sweep"], default="peak",
+                        help="annotation engine: 'peak' looks up genes for each peak independently, 'sweep' walks sorted "
+                             "peaks and genes together per chromosome strand, holding the genes of GFF_IN in memory.")
+    parser.add_argument('--index-in-memory', action="store_true",
+                        help="with --engine peak, preload the genes of the gff db and their child features into an "
+                             "in-memory index shared by all annotation workers, rather than querying sqlite3 several "
+                             "times per peak. Faster, especially with many peaks, but holds all of GFF_IN in memory, as "
+                             "--engine sweep and --db-engine memory always do.")
+    parser.add_argument('--gap-engine', choices=["bedtools", "native", "lazy", "auto"], default="bedtools",
+                        help="zero coverage interval engine: 'bedtools' filters the genomecov track, 'native' computes "
+                             "gaps per contig in a pool of --processors processes, 'lazy' computes gaps only around "
+                             "queried UTR ends, 'auto' chooses between 'lazy' and 'native' by number of peaks.")
+    parser.add_argument('--macs3-engine', choices=["cli", "api"], default="cli",
+                        help="peak calling: 'cli' runs `macs3 callpeak` on each strand BAM file, 'api' calls peaks "
+                             "in-process with the MACS3 library, reading BAM file once for both strands.")
+    parser.add_argument('--macs3-extsize', type=int, default=200, help="MACS3 callpeak --extsize.")
+    parser.add_argument('--macs3-gsize', default="hs", help="MACS3 callpeak --gsize.")
+    parser.add_argument('--macs3-qvalue', type=float, default=0.05, help="MACS3 callpeak --qvalue.")
+    parser.add_argument('--macs3-broad-cutoff', type=float, default=0.1, help="MACS3 callpeak --broad-cutoff.")
+    parser.add_argument('--db-engine', choices=["gffutils", "fast", "memory"], default="gffutils",
+                        help="gff db creation: 'gffutils' uses gffutils.create_db defaults, 'fast' bulk loads only the "
+                             "features peaks2utr uses, 'memory' skips the db and indexes GFF_IN in memory.")
+    parser.add_argument('--output-engine', choices=["gt", "stream"], default="gt",
+                        help="output writer: 'gt' merges all genes in memory and sorts them with genometools, 'stream' "
+                             "writes genes sorted by position straight from the gff db.")
     parser.add_argument('-p', '--processors', type=int, default=1, help="How many processor cores to use.")
     parser.add_argument('-f', '-force', '--force', action="store_true", help="Overwrite outputs if they exist.")
     parser.add_argument('-o', '--output', help="output filename.")
     parser.add_argument('--gtf', dest="gtf_out", action="store_true", help="output in GTF format (rather than default GFF3).")
-    parser.add_argument('--keep-cache', action="store_true", help="Keep cached files on run completion.")
+    parser.add_argument('--cache-dir',
+                        help="Directory of cached intermediate files, which may be shared by concurrent runs to reuse "
+                             "them, and is kept on run completion (default: .cache in working directory).")
+    parser.add_argument('--keep-cache', action="store_true",
+                        help="Keep default cache directory on run completion.")
     parser.add_argument('--version', action='version',
                         version='%(prog)s {version}'.format(version=pkg_resources.require(__package__)[0].version))
     return parser
@@ -83,15 +124,15 @@ async def _main(args):
     The main function / pipeline for peaks2utr.
     """
     import logging
-    import shutil
+    import multiprocessing
     import sys
 
     from . import constants
     from .annotations import AnnotationsPipeline
-    from .collections import AnnotationsDict, BroadPeaksList
-    from .utils import cached, yield_from_process
-    from .preprocess import BAMSplitter, call_peaks, create_db
-    from .postprocess import merge_annotations, gt_gff3_sort, write_summary_stats
+    from .cache import bam_cache_dir, close_cache_dir, open_cache_dir, pipeline_manifest
+    from .collections import AnnotationsDict, FeatureIndex
+    from .preprocess import schedule_preprocessing
+    from .postprocess import merge_annotations, gt_gff3_sort, write_sorted_annotations, write_summary_stats
 
     try:
         ###################
@@ -123,9 +164,14 @@ async def _main(args):
         # Define outputs  #
         ###################
 
+        if args.cache_dir:
+            constants.CACHE_DIR = os.path.abspath(args.cache_dir)
         if not os.path.exists(constants.CACHE_DIR):
-            logging.info("Make .cache directory")
-            os.mkdir(constants.CACHE_DIR)
+            logging.info("Make cache directory %s" % constants.CACHE_DIR)
+        # Held shared by every run using the cache directory, so that none clears it while another is running.
+        run_lock = open_cache_dir(constants.CACHE_DIR, owned=not args.cache_dir)
+        constants.BAM_CACHE_DIR = bam_cache_dir(args.BAM_IN)
+        os.makedirs(constants.BAM_CACHE_DIR, exist_ok=True)
 
         bam_basename = os.path.basename(os.path.splitext(args.BAM_IN)[0])
         gff_base, gff_ext = os.path.splitext(args.GFF_IN)
@@ -153,35 +199,40 @@ async def _main(args):
         # Pre-processing  #
         ###################
 
-        BAMSplitter(bam_basename, args).process()
+        # Outputs of each stage are cached in a directory keyed by the inputs and parameters producing them, where each
+        # is produced under a lock of its own, so only runs producing the same output wait on one another.
+        constants.STAGE_CACHE_DIRS = pipeline_manifest(args).open_stage_dirs()
 
-        db, _, _ = await asyncio.gather(
-            create_db(args.GFF_IN),
-            call_peaks(bam_basename, "forward"),
-            call_peaks(bam_basename, "reverse")
-        )
-        peaks = \
-            BroadPeaksList(broadpeak_fn=cached("forward_peaks.broadPeak"), strand="forward") + \
-            BroadPeaksList(broadpeak_fn=cached("reverse_peaks.broadPeak"), strand="reverse")
+        # One bounded pool of worker processes serves every stage. It is forked here, in the main thread before the
+        # scheduler starts any executor threads, and is terminated once pre-processing is done.
+        with multiprocessing.Pool(args.processors) as pool:
+            results = await schedule_preprocessing(bam_basename, args, pool).run()
+        db, peaks = results["gff_db"], results["peaks"]
 
         ###################
         # Process peaks   #
         ###################
 
         annotations = AnnotationsDict(args=args)
-        with AnnotationsPipeline(peaks, args, db_path=db) as pipeline:
-            for p in pipeline.processes:
-                for result in yield_from_process(pipeline.queue, p, pipeline.pbar):
-                    if result:
-                        annotations.update(result)
+        db_kwargs = {"db": db} if args.db_engine == "memory" else {"db_path": db}
+        with AnnotationsPipeline(peaks, args, **db_kwargs) as pipeline:
+            for record in pipeline.results():
+                annotations.update(pipeline.expand_record(record))
+        if isinstance(pipeline.db, FeatureIndex):
+            # Merge annotations from the in-memory index annotation was done with, rather than querying the db again.
+            db = pipeline.db
 
         ###################
         # Post-processing #
         ###################
 
-        merge_annotations(db, annotations)
-        gt_gff3_sort(annotations, new_gff_fn, args.force, args.gtf_out)
-        write_summary_stats(annotations, pipeline)
+        if args.output_engine == "gt":
+            merge_annotations(db, annotations)
+            gt_gff3_sort(annotations, new_gff_fn, args.force, args.gtf_out)
+            total_utrs = None
+        else:
+            total_utrs = write_sorted_annotations(db, annotations, new_gff_fn)
+        write_summary_stats(annotations, pipeline, total_utrs)
 
         logging.info("%s finished successfully." % __package__)
         await asyncio.sleep(1)
@@ -191,8 +242,6 @@ async def _main(args):
         sys.exit(130)
     finally:
         try:
-            if not args.keep_cache:
-                logging.info("Clearing cache.")
-                shutil.rmtree(constants.CACHE_DIR)
+            close_cache_dir(run_lock, clear=not args.keep_cache and not args.cache_dir)
         except NameError:
             pass
@@ -1,29 +1,30 @@
+from contextlib import closing
 import copy
 import logging
 import math
 import multiprocessing
+import os.path
 import sqlite3
 
+import numpy as np
 from tqdm import tqdm
 
 from . import constants, criteria
 from .constants import AnnotationColour, STRAND_MAP
-from .collections import SPATTruncationPointsDict, ZeroCoverageIntervalsDict
+from .collections import BroadPeaksList, FeatureIndex, LazyZeroCoverageIntervals, SPATTruncationPointsDict, \
+    ZeroCoverageIntervalsDict
 from .exceptions import AnnotationsError
-from .models import UTR, FeatureDB
-from .utils import Counter, Falsey, cached, iter_batches
+from .models import UTR, UTRRecord, FeatureDB
+from .preprocess import strand_sources
+from .utils import Counter, Falsey, cached, yield_from_processes
 
 
 class NoNearbyFeatures(Falsey):
     pass
 
 
-class PotentialUTRZeroCoverage(Falsey):
-    pass
-
-
 class AnnotationsPipeline:
-    def __init__(self, peaks, args, queue=None, db_path=None):
+    def __init__(self, peaks, args, db_path=None, db=None):
         super().__init__()
         self.no_features_counter = Counter()
         self.new_utr_counter = Counter()
@@ -31,48 +32,241 @@ class AnnotationsPipeline:
         self.peaks = peaks
         self.total_peaks = len(peaks)
         self.args = args
-        self.queue = queue or multiprocessing.Queue()
         self.db_path = db_path
+        self.db = db
 
     def __enter__(self):
-        if not self.db_path:
-            raise AnnotationsError("Please instantiate {} with db_path kwarg.".format(self.__class__.__name__))
-        self.processes = [
-            self._batch_annotate_strand(batch)
-            for batch in iter_batches(self.peaks, math.ceil(self.total_peaks/self.args.processors))
-        ]
+        if self.db is None:
+            if not self.db_path:
+                raise AnnotationsError("Please instantiate {} with db_path or db kwarg.".format(self.__class__.__name__))
+            if self.args.engine == "sweep" or self.args.index_in_memory:
+                # The sweep engine walks the sorted genes of an in-memory index, which holds all of GFF_IN. Workers
+                # share it copy-on-write, in place of per-peak region and children queries of sqlite3.
+                logging.info("Indexing genes from gff db.")
+                self.db = FeatureIndex(db=self._connect_db())
+        self.truncation_points, self.coverage_gaps = self._load_strand_lookups()
+        self.partitions = self._partition_peaks()
+        tasks = list(self._schedule())
+        self.tasks = multiprocessing.Queue()
+        # Each worker sends its results over a pipe of its own, so that no two workers' messages interleave.
+        pipes = [multiprocessing.Pipe(duplex=False) for _ in range(min(self.args.processors, len(tasks)))]
+        self.connections = [reader for reader, _ in pipes]
+        self.processes = [multiprocessing.Process(target=self._worker, args=(writer,)) for _, writer in pipes]
+        for task in tasks + [None] * len(self.processes):
+            self.tasks.put(task)
         for p in self.processes:
             p.start()
+        for _, writer in pipes:
+            # Only workers hold the sending ends, so that each pipe reports EOF once they have exited.
+            writer.close()
+        if self.db is None:
+            # Connected only once workers are forked, as each connects to sqlite3 itself.
+            self.db = self._connect_db()
         self.pbar = tqdm(total=self.total_peaks, desc=f'{"INFO": <8} Iterating over peaks to annotate 3\' UTRs.')
         return self
 
     def __exit__(self, type, value, traceback):
+        """
+        Terminate workers still running, as when the body raised before all results were collected, and join them.
+        """
         self.pbar.close()
+        for p in self.processes:
+            if p.is_alive():
+                p.terminate()
+            p.join()
+        for conn in self.connections:
+            conn.close()
 
     def _connect_db(self):
         db = sqlite3.connect(self.db_path, check_same_thread=False)
         return FeatureDB(db)
 
-    def _batch_annotate_strand(self, peaks_batch):
+    def _load_strand_lookups(self):
         """
-        Create multiprocessing Process to handle batch of peaks. Connect to sqlite3 db for each batch to prevent
-        serialization issues.
+        Load SPAT truncation points and zero coverage intervals per strand symbol, once for all workers. These are
+        memory-mapped from flat arrays cached alongside their source files, which are only parsed on first use.
         """
         truncation_points = {}
         coverage_gaps = {}
+        bam_basename = os.path.basename(os.path.splitext(self.args.BAM_IN)[0])
+        sources = strand_sources(self.args, bam_basename)
         for strand, symbol in STRAND_MAP.items():
-            truncation_points[symbol] = SPATTruncationPointsDict(json_fn=cached(strand + "_unmapped.json"))
-            coverage_gaps[symbol] = ZeroCoverageIntervalsDict(bed_fn=cached(strand + "_coverage_gaps.bed"))
-        db = self._connect_db()
-        return multiprocessing.Process(target=self._iter_peaks, args=(db, peaks_batch, truncation_points, coverage_gaps))
+            npz_fn = cached(strand + "_unmapped.npz", "spat_pileups")
+            if self.args.skip_soft_clip:
+                truncation_points[symbol] = SPATTruncationPointsDict()
+            elif os.path.isfile(npz_fn):
+                truncation_points[symbol] = SPATTruncationPointsDict.load(npz_fn)
+            else:
+                raise AnnotationsError("SPAT pileups %s are missing. Re-run to compute them, or pass --skip-soft-clip."
+                                       % npz_fn)
+            if self.args.gap_engine == "lazy":
+                bam_fn, index_fn, flags = sources[strand]
+                coverage_gaps[symbol] = LazyZeroCoverageIntervals(bam_fn=bam_fn, index_fn=index_fn, flags=flags)
+            else:
+                coverage_gaps[symbol] = ZeroCoverageIntervalsDict.load(cached(strand + "_coverage_gaps.bed", "coverage_gaps"))
+        return truncation_points, coverage_gaps
+
+    def _partition_peaks(self):
+        """
+        Group peaks per (chromosome, strand), sorted by start. Partitions of a columnar BroadPeaksList are slices of
+        one array, which forked workers share rather than each holding its own peak objects.
+        """
+        if isinstance(self.peaks, BroadPeaksList):
+            return self.peaks.partition()
+        partitions = {}
+        for peak in self.peaks:
+            partitions.setdefault((peak.chr, peak.strand), []).append(peak)
+        for peaks in partitions.values():
+            peaks.sort(key=lambda x: x.start)
+        return partitions
+
+    def _gene_stats(self):
+        """
+        Number, span and mean length of genes per (chromosome, strand), taken from the gene index if there is one, or
+        else with a single grouped query of the gff db.
+        """
+        if isinstance(self.db, FeatureIndex):
+            return {key: (len(genes.features), int(genes.ends.max() - genes.starts.min()),
+                          float((genes.ends - genes.starts).mean()))
+                    for key, genes in self.db.genes.items() if len(genes.features)}
+        featuretypes = constants.FeatureTypes.Gene
+        query = "SELECT seqid, strand, COUNT(*), MAX(end) - MIN(start), AVG(end - start) FROM features " \
+                "WHERE featuretype IN (%s) AND start IS NOT NULL AND end IS NOT NULL GROUP BY seqid, strand" % \
+                ", ".join("?" * len(featuretypes))
+        if self.db is not None:
+            rows = self.db.execute(query, featuretypes).fetchall()
+        else:
+            # Not kept open, as workers forked from this process must not share a sqlite3 connection.
+            with closing(sqlite3.connect(self.db_path)) as conn:
+                rows = conn.execute(query, featuretypes).fetchall()
+        return {(seqid, strand): (count, span, mean_length) for seqid, strand, count, span, mean_length in rows}
+
+    def _peak_cost(self, key, peaks):
+        """
+        Relative cost of annotating one peak in partition key: one unit plus the number of genes expected to lie within
+        max_distance of it, given the density of genes on that chromosome strand in gene_stats.
+        """
+        if key not in self.gene_stats:
+            return 1
+        num_genes, span, mean_gene_length = self.gene_stats[key]
+        if isinstance(peaks, BroadPeaksList):
+            mean_length = float(peaks.lengths.mean())
+        else:
+            mean_length = sum(peak.end - peak.start for peak in peaks) / len(peaks)
+        window = mean_length + 2 * self.args.max_distance
+        return 1 + num_genes * (window + mean_gene_length) / max(span, 1)
+
+    def _schedule(self):
+        """
+        Split each (chromosome, strand) partition into chunks of roughly equal weight, where each partition is weighted
+        by its peak count and gene density. Yield chunks as (partition key, start index, end index), heaviest first, so
+        that workers pulling them from the shared task queue all finish at around the same time.
+        """
+        self.gene_stats = self._gene_stats()
+        costs = {key: self._peak_cost(key, peaks) for key, peaks in self.partitions.items()}
+        total_weight = sum(costs[key] * len(peaks) for key, peaks in self.partitions.items())
+        target_weight = total_weight / (self.args.processors * constants.CHUNKS_PER_PROCESSOR)
+        chunks = []
+        for key, peaks in self.partitions.items():
+            chunk_size = max(1, math.floor(target_weight / costs[key]))
+            for lo in range(0, len(peaks), chunk_size):
+                hi = min(lo + chunk_size, len(peaks))
+                chunks.append((costs[key] * (hi - lo), (key, lo, hi)))
+        for _, chunk in sorted(chunks, key=lambda x: x[0], reverse=True):
+            yield chunk
+
+    def _worker(self, conn):
+        """
+        Annotate chunks of peaks pulled from the shared task queue until a None sentinel is received, sending results
+        to the parent process over connection conn. The forked worker
+        process inherits the gene index (if any), lookups and peak partitions built in __enter__, so none of these are
+        serialized or rebuilt per worker. Without a gene index, the worker queries the gff db over a connection of its
+        own.
+        """
+        db = self.db if self.db is not None else self._connect_db()
+        inherited = self._tally()
+        for key, lo, hi in iter(self.tasks.get, None):
+            records = []
+            for result in self._iter_peaks(db, self.partitions[key][lo:hi], self.truncation_points, self.coverage_gaps):
+                if result:
+                    records.extend(result)
+            conn.send((records, hi - lo, None))
+        conn.send(([], 0, self._tally(since=inherited)))
+        conn.close()
+
+    def _counters(self):
+        counters = {
+            "no_features": self.no_features_counter,
+            "new_utr": self.new_utr_counter,
+            "zero_coverage_removal": self.zero_coverage_removal_counter,
+        }
+        counters.update({f.__name__: f.fails for f in criteria.TRACKED_CRITERIA})
+        return counters
+
+    def _tally(self, since=None):
+        """
+        Values of this process's statistics counters, to be merged into the parent process. Counts in tally since,
+        such as those a forked worker inherits from the parent process, are left out.
+        """
+        since = since or {}
+        return {name: counter.value - since.get(name, 0) for name, counter in self._counters().items()}
+
+    def merge_tally(self, tally):
+        """
+        Merge statistics tally sent by a worker process into this process's counters.
+        """
+        counters = self._counters()
+        for name, value in tally.items():
+            counters[name].merge(value)
+
+    def results(self):
+        """
+        Yield UTRRecords from worker processes as they arrive from any of them, advancing the progress bar per chunk of
+        peaks and merging the statistics tally of each worker once it finishes. Raise AnnotationsError as soon as a
+        worker fails, rather than waiting on results it will never send.
+        """
+        for records, num_peaks, tally in yield_from_processes(self.connections, self.processes, AnnotationsError):
+            yield from records
+            self.pbar.update(num_peaks)
+            if tally:
+                self.merge_tally(tally)
 
     def _iter_peaks(self, db, peaks_batch, truncation_points, coverage_gaps):
-        for peak in peaks_batch:
-            self.annotate_utr_for_peak(
-                db,
-                peak,
-                truncation_points.get(peak.strand),
-                coverage_gaps.get(peak.strand))
+        if self.args.engine == "sweep":
+            yield from self.sweep_peaks(db, peaks_batch, truncation_points, coverage_gaps)
+            return
+        for (chr, strand), group in self._group_peaks(peaks_batch).items():
+            peaks_genes = ((peak, self._filter_db(db, chr, peak.start, peak.end, strand, constants.FeatureTypes.Gene))
+                           for peak in group)
+            yield from self._annotate_batch(db, peaks_genes, chr, strand, truncation_points.get(strand),
+                                            coverage_gaps.get(strand))
+
+    @staticmethod
+    def _group_peaks(peaks):
+        groups = {}
+        for peak in peaks:
+            groups.setdefault((peak.chr, peak.strand), []).append(peak)
+        return groups
+
+    def expand_record(self, record, db=None):
+        """
+        Rebuild gene, transcript, child and 3' UTR features for a UTRRecord from the gene index (or given db), returning
+        them as a {gene id: features} dict to update AnnotationsDict with.
+        """
+        db = db or self.db
+        gene = copy.copy(db[record.gene_id])
+        transcript = copy.copy(db[record.transcript_id])
+        utr = UTR(start=record.start, end=record.end)
+        utr.generate_feature(gene, transcript, db, record.colour, self.args.gtf_in)
+        features = {"gene": gene, "transcript": transcript}
+        features.update({"feature_{}".format(idx): copy.copy(f) for idx, f in enumerate(db.children(transcript))
+                         if f.id != transcript.id and f.id != gene.id})
+        features.update({"utr": utr.feature})
+        if transcript.strand == "+":
+            gene.end = transcript.end = utr.end
+        else:
+            gene.start = transcript.start = utr.start
+        return {gene.id: features}
 
     def _filter_db(self, db, chr, start, end, strand, featuretype):
         features = list(db.region(
@@ -84,101 +278,140 @@ class AnnotationsPipeline:
         )
         return sorted(features, key=lambda x: x.start, reverse=False if strand == "+" else True)
 
+    def _sweep(self, peaks, genes):
+        """
+        Walk peaks sorted by start alongside start-sorted FeatureIndex.Genes, yielding each peak with the genes that
+        _filter_db would find for it. As peak starts never decrease, genes ending before the current search window
+        are dropped for good.
+        """
+        peaks = sorted(peaks, key=lambda x: x.start)
+        if genes is None:
+            for peak in peaks:
+                yield peak, []
+            return
+        active = []
+        nxt = np.searchsorted(genes.starts, peaks[0].start - self.args.max_distance - genes.max_length, side="right") \
+            if peaks else 0
+        for peak in peaks:
+            start = peak.start - self.args.max_distance
+            end = peak.end + self.args.max_distance
+            while nxt < len(genes.features) and genes.starts[nxt] < end:
+                active.append(nxt)
+                nxt += 1
+            active = [idx for idx in active if genes.ends[idx] > start]
+            nearby = [genes.features[idx] for idx in active if genes.starts[idx] < end]
+            yield peak, nearby if peak.strand == "+" else sorted(nearby, key=lambda x: x.start, reverse=True)
+
+    def sweep_peaks(self, db, peaks, truncation_points, coverage_gaps):
+        """
+        Alternative engine to calling annotate_utr_for_peak for each peak. Group peaks per (chromosome, strand) and
+        find nearby genes with a single merge pass over the sorted genes of FeatureIndex db, applying the same criteria
+        to give the same results. Yield the result for each peak in order of start per group.
+
+        Args:
+            db (FeatureIndex)
+            truncation_points (dict): SPATTruncationPointsDict per strand symbol
+            coverage_gaps (dict): ZeroCoverageIntervalsDict per strand symbol
+        """
+        for (chr, strand), group in self._group_peaks(peaks).items():
+            yield from self._annotate_batch(db, self._sweep(group, db.genes.get((chr, strand))), chr, strand,
+                                            truncation_points.get(strand), coverage_gaps.get(strand))
+
     def annotate_utr_for_peak(self, db, peak, truncation_points, coverage_gaps):
         """
         Find genes in region of given peak and apply criteria to determine if 3' UTR exists for each.
-        If so, add to multiprocessing Queue.
+        Return list of UTRRecord for those that do, or NoNearbyFeatures if no genes are found.
 
         Args:
-            db (gffutils.interface.FeatureDB)
+            db (FeatureIndex or gffutils.interface.FeatureDB)
             truncation_points (SPATTruncationPointsDict)
             coverage_gaps (ZeroCoverageIntervalsDict)
         """
-        utr_found = False
         genes = self._filter_db(db, peak.chr, peak.start, peak.end, peak.strand, constants.FeatureTypes.Gene) or []
-        if genes:
-            for idx, gene in enumerate(genes):
-                transcripts = db.children(
-                    gene,
-                    featuretype=constants.FeatureTypes.GffTranscript + constants.FeatureTypes.GtfTranscript,
-                    order_by="end" if peak.strand == "+" else "start",
-                    reverse=True if peak.strand == "+" else False
-                )
-                # Take outermost transcript
-                try:
-                    transcript = next(transcripts)
-                except StopIteration:
-                    continue
-                try:
-                    criteria.assert_whether_utr_already_annotated(peak, transcript, db,
-                                                                  self.args.override_utr, self.args.extend_utr)
-                    criteria.assert_not_a_subset(peak, transcript)
-                    utr = UTR(start=peak.start, end=peak.end)
-                    criteria.assert_3_prime_end_and_truncate(peak, transcript, utr)
-                    if len(genes) > idx + 1:
-                        next_gene = copy.deepcopy(genes[idx + 1])
-                        criteria.belongs_to_next_gene(peak, next_gene, self.args.five_prime_ext)
-                        criteria.truncate_5_prime_end(peak, next_gene, utr, self.args.five_prime_ext)
-                except criteria.CriteriaFailure as e:
-                    logging.debug("%s - %s" % (type(e).__name__, e))
+        return self._annotate_batch(db, [(peak, genes)], peak.chr, peak.strand, truncation_points, coverage_gaps)[0]
+
+    def _annotate_batch(self, db, peaks_genes, chr, strand, truncation_points, coverage_gaps):
+        """
+        Apply criteria to determine if 3' UTR exists for each gene near each peak of a batch on one chromosome strand,
+        given as (peak, genes sorted in order away from peak) pairs. The zero coverage gaps at the 3'-ends of all the
+        batch's potential UTRs are then looked up with a single filter_many query. Return a list of UTRRecord per peak,
+        or NoNearbyFeatures for a peak with no genes.
+        """
+        results = []
+        potential_utrs = []
+        for peak, genes in peaks_genes:
+            if genes:
+                records = []
+                potential_utrs.extend((records, peak, gene, transcript, utr)
+                                      for gene, transcript, utr in self._potential_utrs(db, peak, genes))
+                results.append(records)
+            else:
+                logging.debug("No features found near peak %s" % peak.name)
+                self.no_features_counter.add(peak.name)
+                results.append(NoNearbyFeatures())
+        gap_starts, gap_ends = coverage_gaps.filter_many(
+            chr, [utr.end if strand == "+" else utr.start for _, _, _, _, utr in potential_utrs])
+        for (records, peak, gene, transcript, utr), gap_start, gap_end in zip(potential_utrs, gap_starts.tolist(),
+                                                                              gap_ends.tolist()):
+            colour = AnnotationColour.Extended
+            spat_edge = truncation_points.outermost(chr, utr.start, utr.end, strand)
+            if gap_start >= 0:
+                if strand == "+":
+                    utr.end = max(transcript.end, gap_start)
                 else:
-                    colour = AnnotationColour.Extended
-                    intersect = utr.range.intersection(map(int, sorted(truncation_points[peak.chr], key=int))) \
-                        if peak.chr in truncation_points else None
-                    if peak.strand == "+":
-                        gaps = coverage_gaps.filter(peak.chr, utr.end)
-                        try:
-                            gap_edge = min([g.start for g in gaps])
-                        except ValueError:
-                            pass
-                        else:
-                            utr.end = max(transcript.end, gap_edge)
-                            colour = AnnotationColour.TruncatedZeroCoverage
-                    else:
-                        gaps = coverage_gaps.filter(peak.chr, utr.start)
-                        try:
-                            gap_edge = max([g.end for g in gaps])
-                        except ValueError:
-                            pass
-                        else:
-                            utr.start = min(transcript.start, gap_edge)
-                            colour = AnnotationColour.TruncatedZeroCoverage
-                    if intersect:
-                        if peak.strand == "+":
-                            utr.end = max(intersect)
-                        else:
-                            utr.start = min(intersect)
-                        colour = AnnotationColour.ExtendedWithSPAT
-                    if utr.is_valid():
-                        logging.debug("Peak {} corresponds to 3' UTR {} of gene {}".upper().format(peak.name, utr, gene.id))
-                        utr.generate_feature(gene, transcript, db, colour, self.args.gtf_in)
-                        features = {"gene": gene, "transcript": transcript}
-                        features.update({"feature_{}".format(idx): f for idx, f in enumerate(db.children(transcript))
-                                        if f.id != transcript.id and f.id != gene.id})
-                        features.update({"utr": utr.feature})
-                        if peak.strand == "+":
-                            gene.end = transcript.end = utr.end
-                        else:
-                            gene.start = transcript.start = utr.start
-                        self.queue.put({gene.id: features})
-                        utr_found = True
-                        self.new_utr_counter.increment()
-                    else:
-                        if utr.length == 0:
-                            logging.debug(
-                                "Peak {} corresponds to potential 3' UTR that was removed due to zero read coverage."
-                                .format(peak.name))
-                            self.queue.put(PotentialUTRZeroCoverage())
-                            self.zero_coverage_removal_counter.add(peak.name)
-                        else:
-                            logging.error(
-                                "Peak {} produced abnormal 3' UTR {} for gene {}. "
-                                "This is a bug, please report at https://github.com/haessar/peaks2utr/issues."
-                                .format(peak.name, utr, gene.id))
-        else:
-            logging.debug("No features found near peak %s" % peak.name)
-            self.queue.put(NoNearbyFeatures())
-            self.no_features_counter.add(peak.name)
-            return
-        if not utr_found:
-            self.queue.put(None)
+                    utr.start = min(transcript.start, gap_end)
+                colour = AnnotationColour.TruncatedZeroCoverage
+            if spat_edge is not None:
+                if strand == "+":
+                    utr.end = spat_edge
+                else:
+                    utr.start = spat_edge
+                colour = AnnotationColour.ExtendedWithSPAT
+            if utr.is_valid():
+                logging.debug("Peak {} corresponds to 3' UTR {} of gene {}".upper().format(peak.name, utr, gene.id))
+                records.append(UTRRecord(gene.id, transcript.id, utr.start, utr.end, colour))
+                self.new_utr_counter.increment()
+            else:
+                if utr.length == 0:
+                    logging.debug(
+                        "Peak {} corresponds to potential 3' UTR that was removed due to zero read coverage."
+                        .format(peak.name))
+                    self.zero_coverage_removal_counter.add(peak.name)
+                else:
+                    logging.error(
+                        "Peak {} produced abnormal 3' UTR {} for gene {}. "
+                        "This is a bug, please report at https://github.com/haessar/peaks2utr/issues."
+                        .format(peak.name, utr, gene.id))
+        return results
+
+    def _potential_utrs(self, db, peak, genes):
+        """
+        Yield (gene, outermost transcript, UTR) for each of genes, sorted in order away from given peak, whose
+        transcript meets the criteria for a 3' UTR at peak, before truncation by zero coverage gaps or SPAT pileups.
+        """
+        for idx, gene in enumerate(genes):
+            transcripts = db.children(
+                gene,
+                featuretype=constants.FeatureTypes.GffTranscript + constants.FeatureTypes.GtfTranscript,
+                order_by="end" if peak.strand == "+" else "start",
+                reverse=True if peak.strand == "+" else False
+            )
+            # Take outermost transcript
+            try:
+                transcript = copy.copy(next(transcripts))
+            except StopIteration:
+                continue
+            try:
+                criteria.assert_whether_utr_already_annotated(peak, transcript, db,
+                                                              self.args.override_utr, self.args.extend_utr)
+                criteria.assert_not_a_subset(peak, transcript)
+                utr = UTR(start=peak.start, end=peak.end)
+                criteria.assert_3_prime_end_and_truncate(peak, transcript, utr)
+                if len(genes) > idx + 1:
+                    next_gene = copy.deepcopy(genes[idx + 1])
+                    criteria.belongs_to_next_gene(peak, next_gene, self.args.five_prime_ext)
+                    criteria.truncate_5_prime_end(peak, next_gene, utr, self.args.five_prime_ext)
+            except criteria.CriteriaFailure as e:
+                logging.debug("%s - %s" % (type(e).__name__, e))
+            else:
+                yield gene, transcript, utr
@@ -0,0 +1,97 @@
+from array import array
+
+import numpy as np
+
+from .utils import atomic_output
+
+
+def aligned_blocks(samfile, contig, start=None, end=None, flags=None):
+    """
+    Return (starts, ends) arrays of the aligned blocks of mapped reads overlapping contig, split on N and D ops. If
+    given, flags are the (required, excluded) SAM flags of the reads to keep, as in STRAND_FLAG_FILTERS.
+    """
+    required, excluded = flags or (0, 0)
+    block_starts, block_ends = array('q'), array('q')
+    for seg in samfile.fetch(contig, start, end):
+        if not seg.is_unmapped and seg.flag & required == required and not seg.flag & excluded:
+            for block_start, block_end in seg.get_blocks():
+                block_starts.append(block_start)
+                block_ends.append(block_end)
+    return np.frombuffer(block_starts, dtype=np.int64), np.frombuffer(block_ends, dtype=np.int64)
+
+
+def zero_coverage_intervals(block_starts, block_ends, length, min_cov=1):
+    """
+    Return (starts, ends) arrays of the merged intervals of [0, length) covered by fewer than min_cov of the aligned
+    blocks, using a difference array over the positions where coverage changes.
+    """
+    block_ends = np.minimum(block_ends, length)
+    keep = block_starts < block_ends
+    positions, inverse = np.unique(np.concatenate([block_starts[keep], block_ends[keep]]), return_inverse=True)
+    deltas = np.zeros(len(positions), dtype=np.int64)
+    np.add.at(deltas, inverse, np.repeat([1, -1], np.count_nonzero(keep)))
+    # Coverage is constant over each segment [bounds[i], bounds[i + 1]).
+    bounds = np.concatenate([[0], positions, [length]])
+    coverage = np.concatenate([[0], np.cumsum(deltas)])
+    nonempty = bounds[1:] > bounds[:-1]
+    seg_starts, seg_ends = bounds[:-1][nonempty], bounds[1:][nonempty]
+    edges = np.diff(np.concatenate([[0], (coverage[nonempty] < min_cov).astype(np.int8), [0]]))
+    return seg_starts[edges[:-1] == 1], seg_ends[np.flatnonzero(edges == -1) - 1]
+
+
+def pileup_arrays(unmapped):
+    """
+    Convert SPAT pileups {chr: {extremity: count}} to {chr: (positions, counts)} arrays sorted by position.
+    """
+    pileups = {}
+    for chr, extremities in unmapped.items():
+        positions = np.fromiter(extremities.keys(), dtype=np.int64, count=len(extremities))
+        counts = np.fromiter(extremities.values(), dtype=np.int64, count=len(extremities))
+        order = np.argsort(positions)
+        pileups[chr] = positions[order], counts[order]
+    return pileups
+
+
+def merge_pileups(pileups, min_pileups=1):
+    """
+    Merge many {chr: (positions, counts)} SPAT pileups, summing counts at matching positions, and keep positions with
+    at least min_pileups counts. Each chromosome is merged in one vectorized pass over the concatenated arrays.
+    """
+    merged = {}
+    for chr in dict.fromkeys(chr for p in pileups for chr in p):
+        positions = np.concatenate([p[chr][0] for p in pileups if chr in p])
+        counts = np.concatenate([p[chr][1] for p in pileups if chr in p])
+        if not len(positions):
+            continue
+        order = np.argsort(positions, kind="stable")
+        positions, counts = positions[order], counts[order]
+        firsts = np.flatnonzero(np.r_[True, positions[1:] != positions[:-1]])
+        positions, counts = positions[firsts], np.add.reduceat(counts, firsts)
+        keep = counts >= min_pileups
+        if keep.any():
+            merged[chr] = positions[keep], counts[keep]
+    return merged
+
+
+def save_pileups(fn, pileups):
+    """
+    Write {chr: (positions, counts)} SPAT pileups to .npz file fn as flat position and count arrays, with the offsets
+    of each chromosome within them.
+    """
+    chrs = list(pileups)
+    positions = [pileups[chr][0] for chr in chrs]
+    offsets = np.cumsum([0] + [len(p) for p in positions])
+    with atomic_output(fn) as tmp_file, open(tmp_file, "wb") as f:
+        np.savez(f, chrs=np.array(chrs, dtype=str), offsets=offsets,
+                 positions=np.concatenate(positions) if chrs else np.empty(0, dtype=np.int64),
+                 counts=np.concatenate([pileups[chr][1] for chr in chrs]) if chrs else np.empty(0, dtype=np.int64))
+
+
+def load_pileups(fn):
+    """
+    Read {chr: (positions, counts)} SPAT pileups from .npz file fn written by save_pileups.
+    """
+    with np.load(fn) as f:
+        offsets = f["offsets"]
+        positions, counts = f["positions"], f["counts"]
+        return {chr: (positions[lo:hi], counts[lo:hi]) for chr, lo, hi in zip(f["chrs"].tolist(), offsets, offsets[1:])}
@@ -0,0 +1,141 @@
+import hashlib
+import json
+import logging
+import os
+import os.path
+import shutil
+
+from . import constants
+from .constants import CACHE_FINGERPRINT_BYTES, CACHE_MANIFEST_FN, CACHEDIR_TAG_FN
+from .utils import CacheLock, atomic_output
+
+CACHEDIR_TAG = "Signature: 8a477f597d28d172789f06886806bc55\n# This directory is a cache created by peaks2utr.\n"
+
+
+def fingerprint(filename, chunk_size=CACHE_FINGERPRINT_BYTES):
+    """
+    Identify contents of filename by its size and a hash of its first and last chunk_size bytes, which is cheap even
+    for large BAM files.
+    """
+    size = os.path.getsize(filename)
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        digest.update(f.read(chunk_size))
+        if size > chunk_size:
+            f.seek(max(chunk_size, size - chunk_size))
+            digest.update(f.read(chunk_size))
+    return "%d:%s" % (size, digest.hexdigest())
+
+
+def fingerprint_digest(filename):
+    """
+    Short hexadecimal digest of the fingerprint of filename, for content-addressed cache file names.
+    """
+    return hashlib.sha256(fingerprint(filename).encode()).hexdigest()[:16]
+
+
+class CacheManifest:
+    """
+    Manifest of the inputs and parameters that produce each stage's cached outputs. Each stage is keyed by a hash of
+    its input file fingerprints, parameters and the keys of the stages it depends on, and its outputs are cached in a
+    directory of its own named after its key. A change to any of these thus moves the stage and everything downstream
+    of it to new directories, while other cached outputs are reused. Outputs of other keys are left alone, so that
+    those of different inputs and parameters sit side by side, and runs sharing the cache never remove each other's.
+    """
+    def __init__(self, cache_dir=None):
+        self.cache_dir = cache_dir or constants.BAM_CACHE_DIR
+        self.keys = {}
+        self.entries = {}
+
+    def register(self, stage, inputs=(), params=None, deps=()):
+        """
+        Register stage, returning its key.
+        """
+        entry = {
+            "inputs": [fingerprint(fn) for fn in inputs],
+            "params": params or {},
+            "deps": [self.keys[dep] for dep in deps],
+        }
+        self.keys[stage] = hashlib.sha256(json.dumps(entry, sort_keys=True).encode()).hexdigest()
+        self.entries[stage] = entry
+        return self.keys[stage]
+
+    def stage_dir(self, stage):
+        return os.path.join(self.cache_dir, "%s.%s" % (stage, self.keys[stage][:16]))
+
+    def open_stage_dirs(self):
+        """
+        Create the directory of each registered stage if need be, recording what its key was derived from in a
+        manifest file within it, and return directories per stage.
+        """
+        stage_dirs = {}
+        for stage, entry in self.entries.items():
+            stage_dirs[stage] = self.stage_dir(stage)
+            os.makedirs(stage_dirs[stage], exist_ok=True)
+            manifest_fn = os.path.join(stage_dirs[stage], CACHE_MANIFEST_FN)
+            if not os.path.isfile(manifest_fn):
+                with atomic_output(manifest_fn) as tmp_file, open(tmp_file, 'w') as f:
+                    json.dump(dict(entry, stage=stage, key=self.keys[stage]), f, indent=2, sort_keys=True)
+        return stage_dirs
+
+
+def bam_cache_dir(bam_fn, cache_dir=None):
+    """
+    Subdirectory of the cache directory for artifacts derived from bam_fn, named after its fingerprint in the same way
+    as the gff db, so that runs on different BAM files sharing a cache directory neither overwrite nor invalidate each
+    other's artifacts.
+    """
+    basename = os.path.basename(os.path.splitext(bam_fn)[0])
+    return os.path.join(cache_dir or constants.CACHE_DIR, "%s.%s" % (basename, fingerprint_digest(bam_fn)))
+
+
+def open_cache_dir(cache_dir, owned):
+    """
+    Create cache_dir if need be and return a shared CacheLock on it, to be held for the whole run so that no other run
+    clears it. If owned, i.e. cache_dir is the default rather than given by the user, an empty cache_dir is tagged with
+    CACHEDIR.TAG as created by peaks2utr, which is what allows close_cache_dir to remove it.
+    """
+    run_lock = CacheLock("run", cache_dir)
+    run_lock.acquire(shared=True)
+    tag_fn = os.path.join(cache_dir, CACHEDIR_TAG_FN)
+    if owned and set(os.listdir(cache_dir)) <= {os.path.basename(run_lock.lock_fn), CACHEDIR_TAG_FN}:
+        with atomic_output(tag_fn) as tmp_file, open(tmp_file, 'w') as f:
+            f.write(CACHEDIR_TAG)
+    return run_lock
+
+
+def close_cache_dir(run_lock, clear):
+    """
+    Release run_lock taken by open_cache_dir. If clear, remove the cache directory, but only if it was created by
+    peaks2utr and no other run holds it. Return whether it was removed.
+    """
+    run_lock.release()
+    cache_dir = os.path.dirname(run_lock.lock_fn)
+    if not clear or not os.path.isfile(os.path.join(cache_dir, CACHEDIR_TAG_FN)):
+        return False
+    clear_lock = CacheLock("run", cache_dir)
+    if not clear_lock.acquire(blocking=False):
+        logging.info("Keeping cache in use by another run.")
+        return False
+    try:
+        logging.info("Clearing cache.")
+        shutil.rmtree(cache_dir)
+    finally:
+        clear_lock.release()
+    return True
+
+
+def pipeline_manifest(args, cache_dir=None):
+    """
+    Register the cached pre-processing stages of the peaks2utr pipeline, whose directories are among the artifacts
+    derived from BAM_IN. The gff db is not registered, since it is content-addressed by the fingerprint of GFF_IN.
+    """
+    manifest = CacheManifest(cache_dir)
+    manifest.register("strands", inputs=[args.BAM_IN])
+    manifest.register("spat_pileups", deps=["strands"],
+                      params={"min_poly_tail": args.min_poly_tail, "min_pileups": args.min_pileups})
+    manifest.register("coverage_gaps", deps=["strands"])
+    manifest.register("peaks", deps=["strands"],
+                      params={"extsize": args.macs3_extsize, "gsize": args.macs3_gsize, "qvalue": args.macs3_qvalue,
+                              "broad_cutoff": args.macs3_broad_cutoff})
+    return manifest
@@ -1,11 +1,19 @@
+from array import array
 import collections
 import csv
+import functools
 import json
+import os
 
 import gffutils
+import numpy as np
+import pysam
 
-from . import constants
-from .models import Peak
+from . import constants, gffdb
+from .cache import fingerprint
+from .arrays import aligned_blocks, load_pileups, zero_coverage_intervals
+from .models import IndexedFeature, Interval, PeakView
+from .utils import atomic_output
 
 
 class AnnotationsDict(collections.UserDict):
@@ -21,17 +29,23 @@ class AnnotationsDict(collections.UserDict):
     def __setitem__(self, gene, new_features):
         existing_features = self.get(gene)
         if existing_features:
-            if new_features["utr"].range.issubset(existing_features["utr"].range):
+            if new_features["utr"].interval.issubset(existing_features["utr"].interval):
                 return
         self.data[gene] = new_features
 
     def iter_feature_strings(self):
         for gid, features in self.data.items():
-            for _, f in features.items():
-                # gene features are redundant in GTF output
-                if self.gtf_out and f.featuretype in constants.FeatureTypes.Gene:
-                    continue
-                yield str(self._apply_feature_dialect(f, gid)) + '\n'
+            yield from self.iter_gene_feature_strings(gid, features.values())
+
+    def iter_gene_feature_strings(self, gid, features):
+        """
+        Yield output lines for features of gene gid, which need not be in this dict.
+        """
+        for f in features:
+            # gene features are redundant in GTF output
+            if self.gtf_out and f.featuretype in constants.FeatureTypes.Gene:
+                continue
+            yield str(self._apply_feature_dialect(f, gid)) + '\n'
 
     @staticmethod
     def _apply_gff_dialect(feature, attrs):
@@ -76,24 +90,206 @@ class AnnotationsDict(collections.UserDict):
         return feature
 
 
-class ZeroCoverageIntervalsDict(collections.UserDict):
+class FeatureIndex(collections.UserDict):
+    """
+    Dictionary of compact IndexedFeature records per id, preloaded from a FeatureDB (or parsed straight from a GFF3/GTF
+    file, skipping sqlite3 altogether) in a single pass together with start-sorted genes per (chromosome, strand) and
+    the child features of each gene and transcript. Answers the lookups, region and children queries AnnotationsPipeline and
+    merge_annotations make of a gffutils.FeatureDB in memory, so it can be passed in place of the db.
+
+    Build it in the parent process before forking workers: they then share it copy-on-write rather than each
+    connecting to sqlite3. Returned features are shared between queries, so copy any feature before modifying it.
+    """
+    class Genes:
+        """
+        Genes on one chromosome strand, sorted by start.
+        """
+        __slots__ = ("features", "starts", "ends", "max_length")
+
+        def __init__(self, features):
+            self.features = sorted(features, key=lambda x: x.start)
+            self.starts = np.fromiter((f.start for f in self.features), dtype=np.int64, count=len(self.features))
+            self.ends = np.fromiter((f.end for f in self.features), dtype=np.int64, count=len(self.features))
+            self.max_length = int((self.ends - self.starts).max()) if self.features else 0
+
+    def __init__(self, dict=None, db=None, gff_fn=None):
+        super().__init__(dict)
+        self.genes = {}
+        self.children_by_parent = {}
+        if db:
+            self._load(db.all_features(), db.execute("SELECT DISTINCT parent, child FROM relations"))
+        elif gff_fn:
+            features, relations = gffdb.parse_features(gff_fn)
+            self._load(features.values(), relations)
+
+    def _load(self, features, relations):
+        self.data.update((f.id, f if isinstance(f, IndexedFeature) else IndexedFeature.from_feature(f)) for f in features)
+        for parent, child in relations:
+            if child in self.data:
+                self.children_by_parent.setdefault(parent, []).append(self.data[child])
+        genes = {}
+        for f in self.data.values():
+            if f.featuretype in constants.FeatureTypes.Gene and f.start is not None and f.end is not None:
+                genes.setdefault((f.seqid, f.strand), []).append(f)
+        for key, strand_genes in genes.items():
+            self.genes[key] = self.Genes(strand_genes)
+
+    def region(self, seqid, start, end, strand=None, featuretype=None):
+        """
+        Return genes on seqid that partially or completely overlap [start, end], as for gffutils.FeatureDB.region.
+        """
+        for (chr, gene_strand), genes in self.genes.items():
+            if chr != seqid or (strand is not None and gene_strand != strand):
+                continue
+            lo = np.searchsorted(genes.starts, start - genes.max_length, side="right")
+            hi = np.searchsorted(genes.starts, end, side="left")
+            for idx in range(lo, hi):
+                if genes.ends[idx] > start:
+                    gene = genes.features[idx]
+                    if featuretype is None or gene.featuretype in featuretype:
+                        yield gene
+
+    def all_features(self, featuretype=None, order_by=None):
+        """
+        Return all features, optionally of given featuretype(s), as for gffutils.FeatureDB.all_features.
+        """
+        if isinstance(featuretype, str):
+            featuretype = [featuretype]
+        features = (f for f in self.data.values() if featuretype is None or f.featuretype in featuretype)
+        if order_by is not None:
+            if isinstance(order_by, str):
+                order_by = [order_by]
+            features = iter(sorted(features, key=lambda x: tuple(getattr(x, attr) for attr in order_by)))
+        return features
+
+    def children(self, id, featuretype=None, order_by=None, reverse=False):
+        """
+        Return children of feature id at all levels, as for gffutils.FeatureDB.children.
+        """
+        if not isinstance(id, str):
+            id = id.id
+        children = self.children_by_parent.get(id, [])
+        if featuretype is not None:
+            if isinstance(featuretype, str):
+                featuretype = [featuretype]
+            children = [f for f in children if f.featuretype in featuretype]
+        if order_by is not None:
+            children = sorted(children, key=lambda x: getattr(x, order_by), reverse=reverse)
+        return iter(children)
+
+
+class FlatArraysMixin:
+    """
+    Persist per-chromosome arrays of a lookup dict as one flat int64 .npy file, with the offsets of each chromosome in
+    a json index alongside. Loading memory-maps the file read-only, so the parent and every forked worker read the
+    same page cache rather than each parsing the source file into its own copy.
+    """
+    @staticmethod
+    def _npy_fns(source_fn):
+        root = os.path.splitext(source_fn)[0]
+        return root + ".npy", root + ".npy.json"
+
+    def _columns(self, value):
+        return np.atleast_2d(value)
+
+    def _from_columns(self, columns):
+        return columns[0]
+
+    def save_npy(self, source_fn):
+        """
+        Write arrays to the .npy file and index alongside source_fn. The index records the fingerprint of source_fn
+        and is written last, so its presence marks the .npy file as complete.
+        """
+        npy_fn, index_fn = self._npy_fns(source_fn)
+        columns = [self._columns(self.data[chr]) for chr in self.data]
+        offsets = np.cumsum([0] + [c.shape[1] for c in columns]).tolist()
+        flat = np.concatenate(columns, axis=1) if columns else np.empty((self._num_columns, 0), dtype=np.int64)
+        with atomic_output(npy_fn) as tmp_file, open(tmp_file, 'wb') as f:
+            np.save(f, flat.astype(np.int64))
+        with atomic_output(index_fn) as tmp_file, open(tmp_file, 'w') as f:
+            json.dump({"source": fingerprint(source_fn),
+                       "offsets": {chr: offsets[i:i + 2] for i, chr in enumerate(self.data)}}, f)
+
+    @classmethod
+    def _read_index(cls, source_fn):
+        """
+        Return offsets per chromosome from the index of source_fn, or None if there is no index or it was written for
+        other contents of source_fn.
+        """
+        try:
+            with open(cls._npy_fns(source_fn)[1], 'r') as f:
+                index = json.load(f)
+        except FileNotFoundError:
+            return None
+        if index.get("source") != fingerprint(source_fn):
+            return None
+        return index["offsets"]
+
+    @classmethod
+    def load(cls, source_fn):
+        """
+        Return lookup dict of source_fn, memory-mapped from its .npy file if cached from the same contents of
+        source_fn, or else parsed from source_fn and cached for the next run.
+        """
+        index = cls._read_index(source_fn)
+        if index is None:
+            obj = cls(**{cls._source_kwargs[os.path.splitext(source_fn)[1]]: source_fn})
+            obj.save_npy(source_fn)
+            return obj
+        obj = cls()
+        if index:
+            flat = np.load(cls._npy_fns(source_fn)[0], mmap_mode='r').view(np.ndarray)
+            for chr, (lo, hi) in index.items():
+                obj.data[chr] = obj._from_columns(flat[:, lo:hi])
+        return obj
+
+
+class ZeroCoverageIntervalsDict(FlatArraysMixin, collections.UserDict):
     """
-    Dictionary of zero coverage intervals per chromosome from parsed BED file.
+    Dictionary of zero coverage intervals per chromosome from parsed BED file. Intervals for each chromosome are
+    held as a pair of sorted (starts, ends) arrays; since merged gaps never overlap, containment queries are answered
+    by bisection.
     """
-    class Interval:
-        def __init__(self, start, end):
-            self.start = int(start)
-            self.end = int(end)
+    Interval = Interval
+    _num_columns = 2
+    _source_kwargs = {".bed": "bed_fn"}
 
     def __init__(self, dict=None, bed_fn=None):
         super().__init__(dict)
         if bed_fn:
-            with open(bed_fn, 'r') as f:
-                for line in f.readlines():
-                    chr, start, end = line.strip().split('\t')
-                    if chr not in self.data:
-                        self.data[chr] = []
-                    self.data[chr].append(self.Interval(start, end))
+            for chr, (starts, ends) in self._stream_bed(bed_fn).items():
+                self._set_arrays(chr, starts, ends)
+
+    @staticmethod
+    def _stream_bed(bed_fn):
+        """
+        Stream BED file line by line into compact per-chromosome start and end arrays.
+        """
+        intervals = {}
+        with open(bed_fn, 'r') as f:
+            for line in f:
+                chr, start, end = line.rstrip('\n').split('\t')[:3]
+                if chr not in intervals:
+                    intervals[chr] = (array('q'), array('q'))
+                intervals[chr][0].append(int(start))
+                intervals[chr][1].append(int(end))
+        return intervals
+
+    def _set_arrays(self, chr, starts, ends):
+        starts = np.asarray(starts, dtype=np.int64)
+        ends = np.asarray(ends, dtype=np.int64)
+        order = np.argsort(starts, kind="stable")
+        self.data[chr] = (starts[order], ends[order])
+
+    def _columns(self, value):
+        return np.vstack(value)
+
+    def _from_columns(self, columns):
+        return columns[0], columns[1]
+
+    def __setitem__(self, chr, intervals):
+        intervals = list(intervals)
+        self._set_arrays(chr, [i.start for i in intervals], [i.end for i in intervals])
 
     def filter(self, chr, base):
         """
@@ -104,29 +300,259 @@ class ZeroCoverageIntervalsDict(collections.UserDict):
         distributed systems.
         """
         if chr in self:
-            return [i for i in self[chr] if i.start < base < i.end]
+            starts, ends = self.data[chr]
+            idx = np.searchsorted(starts, base) - 1
+            if idx >= 0 and base < ends[idx]:
+                return [self.Interval(int(starts[idx]), int(ends[idx]))]
+        return []
+
+    def filter_many(self, chr, bases):
+        """
+        Vectorized filter for many bases on chr at once. Return (starts, ends) arrays aligned with bases, giving the
+        bounds of the interval containing each base, or -1 where there is none.
+        """
+        bases = np.asarray(bases, dtype=np.int64)
+        gap_starts = np.full(bases.shape, -1, dtype=np.int64)
+        gap_ends = np.full(bases.shape, -1, dtype=np.int64)
+        if chr in self:
+            starts, ends = self.data[chr]
+            idx = np.searchsorted(starts, bases) - 1
+            hit = idx >= 0
+            hit[hit] = bases[hit] < ends[idx[hit]]
+            gap_starts[hit] = starts[idx[hit]]
+            gap_ends[hit] = ends[idx[hit]]
+        return gap_starts, gap_ends
+
+
+class LazyZeroCoverageIntervals:
+    """
+    Zero coverage intervals looked up on demand from an indexed BAM file, as an alternative to computing them across
+    the whole genome with ZeroCoverageIntervalsDict. Gaps are computed per fixed window of each contig and the most
+    recently used windows are cached; gaps reaching a window's edge are merged with those of neighbouring windows.
+    Only reads with (required, excluded) SAM flags, if given, are counted, so that a strand can be read from BAM_IN.
+    """
+    Interval = Interval
+
+    def __init__(self, bam_fn, window_size=constants.COVERAGE_WINDOW_SIZE,
+                 cache_size=constants.COVERAGE_WINDOW_CACHE_SIZE, min_cov=1, index_fn=None, flags=None):
+        self.bam_fn = bam_fn
+        self.index_fn = index_fn
+        self.flags = flags
+        self.window_size = window_size
+        self.min_cov = min_cov
+        self._samfile = None
+        self._pid = None
+        with pysam.AlignmentFile(bam_fn, "rb", index_filename=index_fn) as samfile:
+            self.lengths = dict(zip(samfile.references, samfile.lengths))
+        self._window_gaps = functools.lru_cache(maxsize=cache_size)(self._compute_window_gaps)
+
+    def __contains__(self, chr):
+        return chr in self.lengths
+
+    @property
+    def samfile(self):
+        """
+        BAM file handle of the current process, since handles inherited from a parent process cannot be shared.
+        """
+        if self._pid != os.getpid():
+            self._samfile = pysam.AlignmentFile(self.bam_fn, "rb", index_filename=self.index_fn)
+            self._pid = os.getpid()
+        return self._samfile
+
+    def _compute_window_gaps(self, chr, window):
+        start = window * self.window_size
+        end = min(start + self.window_size, self.lengths[chr])
+        block_starts, block_ends = aligned_blocks(self.samfile, chr, start, end, self.flags)
+        starts, ends = zero_coverage_intervals(np.maximum(block_starts, start) - start, block_ends - start,
+                                               end - start, self.min_cov)
+        return starts + start, ends + start
+
+    def _gap_at(self, chr, base):
+        """
+        Return (start, end) of the gap with start <= base < end within base's window, or None.
+        """
+        window = base // self.window_size
+        starts, ends = self._window_gaps(chr, window)
+        idx = np.searchsorted(starts, base, side="right") - 1
+        if idx >= 0 and base < ends[idx]:
+            return int(starts[idx]), int(ends[idx])
+
+    def filter(self, chr, base):
+        """
+        Filter intervals that contain base, as ZeroCoverageIntervalsDict.filter.
+        """
+        if chr not in self or not 0 <= base < self.lengths[chr]:
+            return []
+        gap = self._gap_at(chr, base)
+        if gap is None:
+            return []
+        start, end = gap
+        while start > 0 and start % self.window_size == 0:
+            gap = self._gap_at(chr, start - 1)
+            if gap is None:
+                break
+            start = gap[0]
+        while end < self.lengths[chr] and end % self.window_size == 0:
+            gap = self._gap_at(chr, end)
+            if gap is None:
+                break
+            end = gap[1]
+        if start < base < end:
+            return [self.Interval(start, end)]
         return []
 
+    def filter_many(self, chr, bases):
+        """
+        Return (starts, ends) arrays aligned with bases, as ZeroCoverageIntervalsDict.filter_many.
+        """
+        bases = np.asarray(bases, dtype=np.int64)
+        gap_starts = np.full(bases.shape, -1, dtype=np.int64)
+        gap_ends = np.full(bases.shape, -1, dtype=np.int64)
+        for i, base in enumerate(bases.tolist()):
+            for gap in self.filter(chr, base):
+                gap_starts[i], gap_ends[i] = gap.start, gap.end
+        return gap_starts, gap_ends
+
 
-class SPATTruncationPointsDict(collections.UserDict):
+class SPATTruncationPointsDict(FlatArraysMixin, collections.UserDict):
     """
-    Dictionary of SPAT "truncation points" per chromosome from json file.
+    Dictionary of SPAT "truncation points" per chromosome from json or SPAT pileups .npz file. Points for each
+    chromosome are held as a sorted integer array so that window queries are answered by binary search.
     """
-    def __init__(self, dict=None, json_fn=None):
+    _num_columns = 1
+    _source_kwargs = {".json": "json_fn", ".npz": "npz_fn"}
+
+    def __init__(self, dict=None, json_fn=None, npz_fn=None):
         super().__init__(dict)
         if json_fn:
             with open(json_fn, 'r') as f:
-                self.data.update(json.load(f) or {})
+                self.update(json.load(f) or {})
+        if npz_fn:
+            for chr, (positions, _) in load_pileups(npz_fn).items():
+                self.data[chr] = positions
+
+    def __setitem__(self, chr, points):
+        self.data[chr] = np.unique(np.fromiter(map(int, points), dtype=np.int64))
+
+    def within(self, chr, start, end):
+        """
+        Return sorted truncation points on chr that fall within [start, end).
+        """
+        points = self.data.get(chr)
+        if points is None:
+            return np.empty(0, dtype=np.int64)
+        lo, hi = np.searchsorted(points, (start, end))
+        return points[lo:hi]
+
+    def outermost(self, chr, start, end, strand):
+        """
+        Return truncation point within [start, end) furthest from the transcript, accounting for strand, or None if
+        there are none.
+        """
+        points = self.within(chr, start, end)
+        if not len(points):
+            return None
+        return int(points[-1] if strand == "+" else points[0])
 
 
-class BroadPeaksList(collections.UserList):
+class BroadPeaksList:
     """
-    List of MACS3 broad peaks
+    Columnar list of MACS3 broad peaks, held in a NumPy structured array with chromosomes encoded as indices into chrs.
+    Indexing yields a PeakView of one row and slicing a BroadPeaksList viewing the same array, so that batches of peaks
+    share memory with the whole rather than each peak being a Python object. Peaks without a strand, as read from a
+    broadPeak file without giving one, have an empty strand column and a strand of None.
     """
+    _fields = ["chr", "start", "end", "name", "score", "strand", "signalValue", "pValue", "qValue"]
+    # Rows are converted to PeakViews in blocks of this many, when iterating.
+    _block_size = 10000
+
     def __init__(self, initlist=None, broadpeak_fn=None, strand=None):
-        super().__init__(initlist)
+        self.chrs = []
+        self.data = self._empty(0)
         if broadpeak_fn:
             with open(broadpeak_fn, 'r') as f:
-                self.data = [Peak(*peak) for peak in csv.reader(f, delimiter="\t")]
-                for peak in self.data:
-                    peak.strand = constants.STRAND_MAP.get(strand)
+                self._load(csv.reader(f, delimiter="\t"), constants.STRAND_MAP.get(strand, ""))
+        elif initlist is not None:
+            self._load(([getattr(peak, field) for field in self._fields] for peak in initlist))
+
+    @staticmethod
+    def _empty(size, name_len=1):
+        return np.empty(size, dtype=[
+            ("chr", np.int32), ("start", np.int64), ("end", np.int64), ("name", "S%d" % max(name_len, 1)),
+            ("score", np.int64), ("strand", "S1"), ("signalValue", np.float64), ("pValue", np.float64),
+            ("qValue", np.float64)])
+
+    def _load(self, rows, strand=None):
+        """
+        Fill columns from rows of broadPeak fields, overriding their strand if given.
+        """
+        columns = [[] for _ in self._fields]
+        for row in rows:
+            for column, value in zip(columns, row):
+                column.append(value)
+        codes = {}
+        chr_codes = [codes.setdefault(chr, len(codes)) for chr in columns[0]]
+        self.chrs = list(codes)
+        names = np.array(columns[3], dtype=bytes)
+        self.data = self._empty(len(names), names.dtype.itemsize)
+        self.data["chr"] = chr_codes
+        self.data["name"] = names
+        for field, column in zip(self._fields, columns):
+            if field not in ["chr", "name", "strand"]:
+                self.data[field] = np.asarray(column).astype(self.data.dtype[field])
+        self.data["strand"] = strand if strand is not None else [value or "" for value in columns[5]]
+
+    @classmethod
+    def _view(cls, data, chrs):
+        peaks = cls()
+        peaks.data = data
+        peaks.chrs = chrs
+        return peaks
+
+    def __len__(self):
+        return len(self.data)
+
+    def _peak(self, row):
+        chr, start, end, name, score, strand, signal_value, p_value, q_value = row
+        return PeakView(self.chrs[chr], start, end, name.decode(), score, strand.decode() or None, signal_value,
+                        p_value, q_value)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return self._view(self.data[idx], self.chrs)
+        return self._peak(self.data[idx].item())
+
+    def __iter__(self):
+        for lo in range(0, len(self.data), self._block_size):
+            for row in self.data[lo:lo + self._block_size].tolist():
+                yield self._peak(row)
+
+    def __add__(self, other):
+        chrs = list(dict.fromkeys(self.chrs + other.chrs))
+        name_len = max(self.data.dtype["name"].itemsize, other.data.dtype["name"].itemsize)
+        data = self._empty(len(self.data) + len(other.data), name_len)
+        for peaks, rows in [(self, data[:len(self.data)]), (other, data[len(self.data):])]:
+            for field in self._fields:
+                rows[field] = peaks.data[field]
+            codes = np.array([chrs.index(chr) for chr in peaks.chrs], dtype=np.int32)
+            if len(rows):
+                rows["chr"] = codes[peaks.data["chr"]]
+        return self._view(data, chrs)
+
+    @property
+    def lengths(self):
+        return self.data["end"] - self.data["start"]
+
+    def partition(self):
+        """
+        Group peaks per (chromosome, strand), sorted by start, as slices of a single sorted copy of the peaks.
+        """
+        order = np.lexsort((self.data["start"], self.data["strand"], self.data["chr"]))
+        data = self.data[order]
+        bounds = np.flatnonzero((data["chr"][1:] != data["chr"][:-1]) | (data["strand"][1:] != data["strand"][:-1])) + 1
+        partitions = {}
+        for lo, hi in zip(np.concatenate([[0], bounds]), np.concatenate([bounds, [len(data)]])):
+            if hi > lo:
+                key = (self.chrs[data["chr"][lo]], data["strand"][lo].decode() or None)
+                partitions[key] = self._view(data[lo:hi], self.chrs)
+        return partitions
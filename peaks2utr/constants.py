@@ -36,6 +36,12 @@ STRAND_PYSAM_ARGS = {
     'reverse': ["-f", "16"],
 }
 
+# (required, excluded) SAM flag bits equivalent to STRAND_PYSAM_ARGS
+STRAND_FLAG_FILTERS = {
+    'forward': (0, 20),
+    'reverse': (16, 0),
+}
+
 GFFUTILS_GTF_DIALECT = {
     'leading semicolon': False,
     'trailing semicolon': True,
@@ -61,8 +67,83 @@ GFFUTILS_GFF_DIALECT = {
 }
 
 CACHE_DIR = os.path.join(os.getcwd(), '.cache')
+# Subdirectory of CACHE_DIR holding the artifacts derived from BAM_IN, named after its fingerprint by cache.bam_cache_dir.
+BAM_CACHE_DIR = CACHE_DIR
+# Subdirectories of BAM_CACHE_DIR holding the outputs of each cached pre-processing stage, named after its key by
+# cache.CacheManifest.
+STAGE_CACHE_DIRS = {}
+CACHEDIR_TAG_FN = "CACHEDIR.TAG"
 LOG_DIR = os.path.join(os.getcwd(), '.log')
 
+CACHE_MANIFEST_FN = "manifest.json"
+
+CACHE_FINGERPRINT_BYTES = 1 << 20
+
 TMP_GFF_FN = "_tmp.gff"
 
 PERC_ALLOCATED_VRAM = 75
+
+# Rough peak memory of pre-processing stages per byte of the input file they hold in memory, for the memory budget of
+# the stage scheduler.
+FEATURE_INDEX_MEMORY_FACTOR = 10
+MACS3_MEMORY_FACTOR = 4
+NATIVE_GAPS_MEMORY_FACTOR = 1
+
+CHUNKS_PER_PROCESSOR = 8
+
+PBAR_UPDATE_INTERVAL = 10000
+
+SPAT_TILE_SIZE = 5000000
+
+COVERAGE_WINDOW_SIZE = 100000
+
+COVERAGE_WINDOW_CACHE_SIZE = 256
+
+DB_INSERT_BATCH_SIZE = 10000
+
+FAST_DB_PRAGMAS = {
+    'synchronous': 'OFF',
+    'journal_mode': 'MEMORY',
+    'temp_store': 'MEMORY',
+    'main.page_size': 4096,
+    'main.cache_size': -262144,
+}
+
+# Defaults of `macs3 callpeak` options, for calling peaks in-process with the MACS3 library.
+MACS3_CALLPEAK_DEFAULTS = {
+    'cfile': None,
+    'format': 'BAM',
+    'tsize': None,
+    'keepduplicates': '1',
+    'barcodefile': '',
+    'maxcount': None,
+    'store_bdg': False,
+    'verbose': 2,
+    'trackline': False,
+    'do_SPMR': False,
+    'nomodel': True,
+    'shift': 0,
+    'bw': 300,
+    'd_min': 20,
+    'mfold': [5, 50],
+    'onauto': False,
+    'pvalue': None,
+    'scaleto': 'small',
+    'downsample': False,
+    'seed': -1,
+    'nolambda': False,
+    'smalllocal': 1000,
+    'largelocal': 10000,
+    'maxgap': None,
+    'minlen': None,
+    'broad': True,
+    'cutoff_analysis': False,
+    'call_summits': False,
+    'fecutoff': 1.0,
+    'tolarge': False,
+    'ratio': 1.0,
+    'buffer_size': 100000,
+}
+
+# SAM flag bits of reads that MACS3 skips when parsing BAM files: unmapped, secondary, QC fail or supplementary.
+MACS3_EXCLUDED_FLAGS = 2820
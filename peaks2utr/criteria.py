@@ -1,3 +1,4 @@
+import functools
 import logging
 
 from .constants import FeatureTypes
@@ -8,10 +9,14 @@ class CriteriaFailure(Exception):
     pass
 
 
+TRACKED_CRITERIA = []
+
+
 def track_failed_peaks(f):
     """
     Decorator to track set of peaks that fail this criterion.
     """
+    @functools.wraps(f)
     def wrapped(*args, **kwargs):
         try:
             return f(*args, **kwargs)
@@ -20,6 +25,7 @@ def track_failed_peaks(f):
             wrapped.fails.add(peak.name)
             raise
     wrapped.fails = Counter()
+    TRACKED_CRITERIA.append(wrapped)
     return wrapped
 
 
@@ -50,7 +56,7 @@ def assert_not_a_subset(peak, transcript):
     If a peak occurs entirely within an existing transcript annotation (i.e. it's a subset), we consider that it is already
     accounted for and can't possibly refer to a new UTR.
     """
-    if peak.range.issubset(transcript.range):
+    if peak.interval.issubset(transcript.interval):
         raise CriteriaFailure("Peak %s wholly contained within transcript %s" % (peak.name, transcript.id))
 
 
@@ -75,7 +81,7 @@ def truncate_5_prime_end(peak, next_gene, utr, five_prime_ext=0):
     If a peak is broad enough it can potentially overlap the 5'-end of the following gene, so we check for an
     intersection and truncate if it exists (taking into account assumed 5' extension).
     """
-    if utr.range.intersection(next_gene.range):
+    if utr.interval.overlaps(next_gene.interval):
         logging.debug("Peak %s overlapping following gene %s: Truncating" % (peak.name, next_gene.id))
         if peak.strand == "+":
             utr.end = next_gene.start - five_prime_ext
@@ -0,0 +1,278 @@
+from abc import ABC, abstractmethod
+from collections import Counter
+import logging
+import sqlite3
+
+import gffutils
+from gffutils import bins, constants as gffutils_constants, helpers
+from gffutils.create import _GFFDBCreator, _GTFDBCreator
+from gffutils.feature import Feature
+from gffutils.iterators import DataIterator
+
+from .constants import DB_INSERT_BATCH_SIZE, FAST_DB_PRAGMAS, FeatureTypes
+from .models import IndexedFeature
+
+
+class _BulkInsertMixin(ABC):
+    """
+    Insert features in batches with executemany inside the single transaction gffutils opens, falling back to
+    inserting row by row (and so to gffutils' merge strategies) only for a batch containing a duplicate id. Indexes
+    are only created once everything is loaded, by _finalize.
+    """
+    def _insert_many(self, cursor, features):
+        cursor.execute("SAVEPOINT batch")
+        try:
+            cursor.executemany(gffutils_constants._INSERT, [f.astuple() for f in features])
+        except sqlite3.IntegrityError:
+            cursor.execute("ROLLBACK TO batch")
+            for f in features:
+                self._insert_or_merge(cursor, f, self.merge_strategy)
+        cursor.execute("RELEASE batch")
+
+    def _insert_or_merge(self, cursor, f, merge_strategy):
+        try:
+            self._insert(f, cursor)
+        except sqlite3.IntegrityError:
+            fixed, final_strategy = self._do_merge(f, merge_strategy)
+            if final_strategy == 'merge':
+                cursor.execute("UPDATE features SET attributes = ? WHERE id = ?",
+                               (helpers._jsonify(fixed.attributes), fixed.id))
+                if self.force_merge_fields:
+                    cursor.execute("UPDATE features SET %s WHERE id = ?" %
+                                   ', '.join('%s = ?' % field for field in self.force_merge_fields),
+                                   [getattr(fixed, field) for field in self.force_merge_fields] + [fixed.id])
+            elif final_strategy == 'replace':
+                self._replace(f, cursor)
+            elif final_strategy == 'create_unique':
+                self._insert(f, cursor)
+
+    def _keep(self, f):
+        return True
+
+    @abstractmethod
+    def _feature_relations(self, f):
+        """
+        Return (parent, child, level) relations of feature f to insert alongside it.
+        """
+
+    def _populate_from_lines(self, lines):
+        logging.debug("Populating features table and first-order relations.")
+        c = self.conn.cursor()
+        batch, relations = [], []
+        features_seen = 0
+        for features_seen, f in enumerate(lines, 1):
+            # Assign ids to every feature, kept or not, so that autoincremented ids match gffutils.create_db.
+            f.id = self._id_handler(f)
+            if not self._keep(f):
+                continue
+            batch.append(f)
+            relations.extend(self._feature_relations(f))
+            if len(batch) == DB_INSERT_BATCH_SIZE:
+                self._insert_many(c, batch)
+                c.executemany("INSERT OR IGNORE INTO relations VALUES (?, ?, ?)", relations)
+                batch, relations = [], []
+        if not features_seen:
+            raise ValueError("No lines parsed -- was an empty file provided?")
+        self._insert_many(c, batch)
+        c.executemany("INSERT OR IGNORE INTO relations VALUES (?, ?, ?)", relations)
+        self.conn.commit()
+
+
+class FastGFFDBCreator(_BulkInsertMixin, _GFFDBCreator):
+    """
+    GFF3 db creator skipping top-level features other than genes, which peaks2utr never reads or writes, and
+    deriving second-order relations with a single join rather than one query per feature.
+    """
+    def _keep(self, f):
+        return f.featuretype in FeatureTypes.Gene or 'Parent' in f.attributes
+
+    def _feature_relations(self, f):
+        return [(parent, f.id, 1) for parent in f.attributes.get('Parent', [])]
+
+    def _update_relations(self):
+        logging.debug("Updating relations.")
+        c = self.conn.cursor()
+        c.execute(
+            '''
+            INSERT OR IGNORE INTO relations
+            SELECT DISTINCT parents.parent, children.child, 2
+            FROM relations AS parents
+            JOIN relations AS children ON children.parent = parents.child
+            WHERE parents.parent IN (SELECT id FROM features)
+            ''')
+        c.execute("DROP INDEX IF EXISTS binindex")
+        c.execute("CREATE INDEX binindex ON features (bin)")
+        self.conn.commit()
+
+
+class FastGTFDBCreator(_BulkInsertMixin, _GTFDBCreator):
+    """
+    GTF db creator inferring the extents of all transcripts and genes with one grouped query rather than two queries
+    per transcript.
+    """
+    def _feature_relations(self, f):
+        relations = []
+        parent = None
+        if self.transcript_key in f.attributes:
+            parent = f.attributes[self.transcript_key][0]
+            relations.append((parent, f.id, 1))
+        if self.gene_key in f.attributes and f.attributes[self.gene_key]:
+            grandparent = f.attributes[self.gene_key][0]
+            relations.append((grandparent, f.id, 2))
+            if parent is not None:
+                relations.append((grandparent, parent, 1))
+        return relations
+
+    def _update_relations(self):
+        if self.disable_infer_genes and self.disable_infer_transcripts:
+            return
+        logging.debug("Inferring transcript and gene extents.")
+        c = self.conn.cursor()
+        c.execute("CREATE INDEX IF NOT EXISTS relationschild ON relations (child)")
+        extents = {
+            parent: (start, end, strand, seqid) for parent, start, end, strand, seqid in c.execute(
+                '''
+                SELECT relations.parent, MIN(start), MAX(end), strand, seqid
+                FROM features
+                JOIN relations ON features.id = relations.child
+                WHERE featuretype = ?
+                GROUP BY relations.parent
+                ''', (self.subfeature,))}
+        transcript_genes = c.execute(
+            '''
+            SELECT DISTINCT firstlevel.parent, relations.parent
+            FROM (
+                SELECT DISTINCT parent
+                FROM relations
+                JOIN features ON features.id = relations.child
+                WHERE features.featuretype = ?
+                AND relations.level = 1
+            )
+            AS firstlevel
+            JOIN relations ON firstlevel.parent = child
+            WHERE relations.level = 1
+            ORDER BY relations.parent
+            ''', (self.subfeature,)).fetchall()
+        c.execute("DROP INDEX IF EXISTS relationschild")
+
+        derived = []
+        last_gene_id = None
+        for transcript_id, gene_id in transcript_genes:
+            if not self.disable_infer_transcripts:
+                derived.append(self._derived_feature(
+                    transcript_id, 'transcript', {self.transcript_key: [transcript_id], self.gene_key: [gene_id]},
+                    extents[transcript_id]))
+            if not self.disable_infer_genes and gene_id != last_gene_id:
+                derived.append(self._derived_feature(gene_id, 'gene', {self.gene_key: [gene_id]}, extents[gene_id]))
+            last_gene_id = gene_id
+
+        # Inferred features are merged into any of the same id already in the file, as in gffutils.
+        for f in derived:
+            self._insert_or_merge(c, f, 'merge')
+        self.conn.commit()
+
+    def _derived_feature(self, id, featuretype, attributes, extent):
+        start, end, strand, seqid = extent
+        # Round-trip attributes through JSON as gffutils does when reading inferred features back from its tempfile.
+        f = Feature(seqid=seqid, source='gffutils_derived', featuretype=featuretype, start=start, end=end, score='.',
+                    strand=strand, frame='.', attributes=helpers._unjsonify(helpers._jsonify(attributes)), extra=[],
+                    bin=bins.bins(start, end, one=True))
+        f.id = self._id_handler(f)
+        return f
+
+
+def create_db(data, dbfn, force=False, verbose=False):
+    """
+    Faster equivalent of gffutils.create_db(data, dbfn, force=force, verbose=verbose) for peaks2utr's needs: bulk
+    inserts with tuned pragmas, skipping features peaks2utr never uses.
+    """
+    iterator = DataIterator(data=data, checklines=10)
+    dialect = iterator.dialect
+    kwargs = dict(data=iterator._iter, dbfn=dbfn, force=force, verbose=verbose, checklines=0, dialect=dialect,
+                  directives=iterator.directives, pragmas=FAST_DB_PRAGMAS)
+    if dialect['fmt'] == 'gtf':
+        creator = FastGTFDBCreator(id_spec={'gene': 'gene_id', 'transcript': 'transcript_id'}, transcript_key='transcript_id',
+                                   gene_key='gene_id', subfeature='exon', **kwargs)
+    else:
+        creator = FastGFFDBCreator(id_spec='ID', **kwargs)
+    creator.create()
+    creator.conn.close()
+    return gffutils.FeatureDB(dbfn)
+
+
+def parse_features(data):
+    """
+    Stream GFF3 or GTF data once into features and (parent, child) relations at all levels, as gffutils.create_db would
+    store them in the features and relations tables, but without sqlite3. Returns features as IndexedFeature records in
+    a dict per id in file order, followed by any transcripts and genes inferred from GTF exons.
+
+    As with the default merge strategy of gffutils.create_db, a duplicate feature id raises ValueError. Inferred
+    transcripts and genes are only added where the GTF has no line of their own, which gffutils would merge them into.
+    """
+    iterator = DataIterator(data=data, checklines=10)
+    dialect = iterator.dialect
+    gtf = dialect['fmt'] == 'gtf'
+    autoincrements = Counter()
+    features = {}
+    relations = {}
+    extents = {}
+
+    def feature_id(f):
+        key = {'gene': 'gene_id', 'transcript': 'transcript_id'}.get(f.featuretype) if gtf else 'ID'
+        try:
+            return f.attributes[key][0]
+        except (KeyError, IndexError):
+            autoincrements[f.featuretype] += 1
+            return '%s_%s' % (f.featuretype, autoincrements[f.featuretype])
+
+    def add(f, id):
+        features[id] = IndexedFeature.from_feature(f, id, dialect)
+
+    for f in iterator:
+        # Assign ids to every feature, kept or not, so that autoincremented ids match gffutils.create_db.
+        id = feature_id(f)
+        if gtf:
+            transcript_id = (f.attributes.get('transcript_id') or [None])[0]
+            gene_id = (f.attributes.get('gene_id') or [None])[0]
+            relations.update(dict.fromkeys(
+                relation for relation in [(transcript_id, id), (gene_id, id), (gene_id, transcript_id)]
+                if None not in relation))
+            if f.featuretype == 'exon':
+                for parent in (transcript_id, gene_id):
+                    if parent is not None:
+                        start, end, _, _ = extents.get(parent, (f.start, f.end, None, None))
+                        extents[parent] = (min(start, f.start), max(end, f.end), f.strand, f.seqid)
+        elif f.featuretype in FeatureTypes.Gene or 'Parent' in f.attributes:
+            relations.update(dict.fromkeys((parent, id) for parent in f.attributes.get('Parent', [])))
+        else:
+            continue
+        if id in features:
+            raise ValueError("Duplicate ID %s" % id)
+        add(f, id)
+    if not features:
+        raise ValueError("No lines parsed -- was an empty file provided?")
+
+    if gtf:
+        transcript_genes = sorted({(gene_id, transcript_id) for gene_id, transcript_id in relations
+                                   if transcript_id in extents and gene_id in extents})
+        for gene_id, transcript_id in transcript_genes:
+            if transcript_id not in features:
+                add(_derived_feature('transcript', {'transcript_id': [transcript_id], 'gene_id': [gene_id]},
+                                     extents[transcript_id]), transcript_id)
+            if gene_id not in features:
+                add(_derived_feature('gene', {'gene_id': [gene_id]}, extents[gene_id]), gene_id)
+    else:
+        children = {}
+        for parent, child in relations:
+            children.setdefault(parent, []).append(child)
+        relations.update(dict.fromkeys(
+            (parent, grandchild) for parent, child in list(relations) if parent in features
+            for grandchild in children.get(child, [])))
+    return features, list(relations)
+
+
+def _derived_feature(featuretype, attributes, extent):
+    start, end, strand, seqid = extent
+    return Feature(seqid=seqid, source='gffutils_derived', featuretype=featuretype, start=start, end=end, score='.',
+                   strand=strand, frame='.', attributes=helpers._unjsonify(helpers._jsonify(attributes)), extra=[],
+                   bin=bins.bins(start, end, one=True))
@@ -1,18 +1,93 @@
 from abc import ABC
+from collections import namedtuple
 import re
+import sys
 
 import gffutils
 
 from .constants import AnnotationColour, FeatureTypes, STRAND_CIGAR_SOFT_CLIP_REGEX, GFFUTILS_GFF_DIALECT, GFFUTILS_GTF_DIALECT
 
 
+class Interval:
+    """
+    Half-open interval of bases [start, end), answering set-like queries arithmetically rather than by
+    materialising set(range(start, end)).
+    """
+    __slots__ = ("start", "end")
+
+    def __init__(self, start, end):
+        self.start = start
+        self.end = end
+
+    def __repr__(self):
+        return "<%s: [%s, %s)>" % (self.__class__.__name__, self.start, self.end)
+
+    def __len__(self):
+        return max(self.end - self.start, 0)
+
+    def __bool__(self):
+        return self.end > self.start
+
+    def __iter__(self):
+        return iter(range(self.start, self.end))
+
+    def __contains__(self, base):
+        return self.start <= base < self.end
+
+    def __eq__(self, other):
+        if isinstance(other, Interval):
+            if not self or not other:
+                return not self and not other
+            return self.start == other.start and self.end == other.end
+        if isinstance(other, (set, frozenset)):
+            return len(self) == len(other) and all(base in self for base in other)
+        return NotImplemented
+
+    def __hash__(self):
+        return hash((self.start, self.end) if self else ())
+
+    def issubset(self, other):
+        """
+        Return True if every base of this interval is also in other.
+        """
+        if not self:
+            return True
+        if isinstance(other, Interval):
+            return other.start <= self.start and self.end <= other.end
+        return all(base in other for base in self)
+
+    def intersection(self, other):
+        """
+        Return the bases shared with other. For another Interval this is itself an Interval (possibly empty); for
+        any other iterable of bases, a set of those bases that fall within this interval.
+        """
+        if isinstance(other, Interval):
+            return Interval(max(self.start, other.start), min(self.end, other.end))
+        return {base for base in other if base in self}
+
+    def overlaps(self, other):
+        """
+        Return True if this interval shares at least one base with other.
+        """
+        return max(self.start, other.start) < min(self.end, other.end)
+
+
 class RangeMixin(ABC):
+    # No instance dict of its own, so that slotted subclasses such as PeakView have none either.
+    __slots__ = ()
     start: int
     end: int
 
+    @property
+    def interval(self):
+        return Interval(self.start, self.end)
+
     @property
     def range(self):
-        return set(range(self.start, self.end))
+        """
+        Lazy, set-like view of bases in [start, end). Kept for compatibility; prefer interval.
+        """
+        return self.interval
 
     @property
     def length(self):
@@ -38,6 +113,27 @@ class Peak(RangeMixin):
         return "<%s: %s>" % (self.__class__.__name__, str(self.__dict__))
 
 
+class PeakView(RangeMixin):
+    """
+    Lightweight, slotted peak read from one row of a columnar BroadPeaksList, with the attributes of Peak.
+    """
+    __slots__ = ("chr", "start", "end", "name", "score", "strand", "signalValue", "pValue", "qValue")
+
+    def __init__(self, chr, start, end, name, score, strand, signalValue, pValue, qValue):
+        self.chr = chr
+        self.start = start
+        self.end = end
+        self.name = name
+        self.score = score
+        self.strand = strand
+        self.signalValue = signalValue
+        self.pValue = pValue
+        self.qValue = qValue
+
+    def __repr__(self):
+        return "<%s: %s>" % (self.__class__.__name__, str({attr: getattr(self, attr) for attr in self.__slots__}))
+
+
 class Feature(gffutils.Feature, RangeMixin):
     """
     gffutils.Feature with range property
@@ -47,6 +143,71 @@ class Feature(gffutils.Feature, RangeMixin):
         self.keep_order = True
 
 
+class IndexedFeature(RangeMixin):
+    """
+    Compact, slotted record of a feature held in memory by FeatureIndex, with only the fields of gffutils.Feature that
+    peaks2utr reads or writes. Records of one file share its dialect and interned copies of the strings repeated from
+    line to line, and hold attributes as tuples rather than a mapping of lists. Formatted as a line of the file as
+    Feature is.
+    """
+    __slots__ = ("seqid", "source", "featuretype", "start", "end", "score", "strand", "frame", "_attributes", "extra",
+                 "id", "dialect")
+
+    def __init__(self, seqid, source, featuretype, start, end, score, strand, frame, attributes, extra, id, dialect):
+        self.seqid = _intern(seqid)
+        self.source = _intern(source)
+        self.featuretype = _intern(featuretype)
+        self.start = start
+        self.end = end
+        self.score = _intern(score)
+        self.strand = _intern(strand)
+        self.frame = _intern(frame)
+        self.attributes = attributes
+        self.extra = extra or None
+        self.id = id
+        self.dialect = dialect
+
+    @classmethod
+    def from_feature(cls, f, id=None, dialect=None):
+        return cls(f.seqid, f.source, f.featuretype, f.start, f.end, f.score, f.strand, f.frame, f.attributes, f.extra,
+                   f.id if id is None else id, dialect or f.dialect)
+
+    @property
+    def chrom(self):
+        return self.seqid
+
+    @property
+    def attributes(self):
+        """
+        Attributes of this record, held as a tuple of (key, values) pairs. Modifying those returned does not modify the
+        record, unless they are assigned back to it.
+        """
+        return gffutils.attributes.Attributes({key: list(values) for key, values in self._attributes})
+
+    @attributes.setter
+    def attributes(self, attributes):
+        self._attributes = tuple((_intern(key), tuple(values)) for key, values in (attributes or {}).items())
+
+    def feature(self):
+        """
+        Return this record as a Feature.
+        """
+        return Feature(seqid=self.seqid, source=self.source, featuretype=self.featuretype, start=self.start,
+                       end=self.end, score=self.score, strand=self.strand, frame=self.frame, attributes=self.attributes,
+                       extra=list(self.extra or []), id=self.id, dialect=self.dialect)
+
+    def __str__(self):
+        return str(self.feature())
+
+    def __repr__(self):
+        return "<%s %s (%s:%s-%s[%s])>" % (self.__class__.__name__, self.featuretype, self.seqid, self.start, self.end,
+                                           self.strand)
+
+
+def _intern(value):
+    return sys.intern(value) if isinstance(value, str) else value
+
+
 class FeatureDB(gffutils.FeatureDB):
     def _feature_returner(self, **kwargs):
         """
@@ -73,7 +234,7 @@ class UTR(RangeMixin):
         return "<%s: (%s, %s)>" % (self.__class__.__name__, self.start, self.end)
 
     def __eq__(self, other):
-        return self.range == other.range
+        return self.interval == other.interval
 
     def _create_id(self, transcript, db):
         existing_utrs = list(db.children(transcript, featuretype=FeatureTypes.ThreePrimeUTR)) + \
@@ -118,6 +279,13 @@ class UTR(RangeMixin):
         return self.end > self.start
 
 
+class UTRRecord(namedtuple("UTRRecord", ["gene_id", "transcript_id", "start", "end", "colour"])):
+    """
+    Compact record of a new 3' UTR, sent from annotation workers in place of full gene feature graphs.
+    """
+    __slots__ = ()
+
+
 class SoftClippedRead:
     """
     Read in SAM file format.
@@ -1,4 +1,7 @@
+import heapq
+from itertools import groupby
 import logging
+from operator import itemgetter
 import os.path
 import shutil
 import subprocess
@@ -6,13 +9,17 @@ import subprocess
 import sqlite3
 
 from . import criteria
+from .collections import FeatureIndex
 from .constants import FeatureTypes, LOG_DIR, TMP_GFF_FN
 from .models import FeatureDB
 from .utils import cached, format_stats_line
 
 
-def write_summary_stats(annotations, pipeline):
+def write_summary_stats(annotations, pipeline, total_utrs=None):
     total_peaks = pipeline.total_peaks
+    if total_utrs is None:
+        total_utrs = len([vv for v in annotations.values() for vv in v.values()
+                          if vv.featuretype in FeatureTypes.ThreePrimeUTR])
     with open('summary_stats.txt', 'w') as fstats:
         logging.info("Writing summary statistics file.")
         fstats.write(format_stats_line("Total peaks", total_peaks))
@@ -25,25 +32,66 @@ def write_summary_stats(annotations, pipeline):
                                        int(criteria.assert_3_prime_end_and_truncate.fails)))
         fstats.write(format_stats_line("\t...corresponding to potential 3' UTR removed due to zero read coverage",
                                        total_peaks, int(pipeline.zero_coverage_removal_counter)))
-        fstats.write(format_stats_line("Total 3' UTRs", len([vv for v in annotations.values() for vv in v.values()
-                                                             if vv.featuretype in FeatureTypes.ThreePrimeUTR])))
+        fstats.write(format_stats_line("Total 3' UTRs", total_utrs))
         fstats.write(format_stats_line("\t...annotated by {}".format(__package__), int(pipeline.new_utr_counter)))
 
 
 def merge_annotations(db, annotations):
     """
-    Update three_prime_UTR annotations dict with all features from GFF_IN file.
+    Update three_prime_UTR annotations dict with all features from GFF_IN file, given as the path to its gff db or as
+    a FeatureIndex.
     """
     logging.info("Merging annotations with canonical gff file.")
 
-    db = sqlite3.connect(db, check_same_thread=False)
-    db = FeatureDB(db)
+    db = _open_db(db)
     for gene in db.all_features(featuretype=FeatureTypes.Gene):
         if gene.id not in annotations:
-            features = {"gene": gene}
-            features.update({"feature_{}".format(idx): f for idx, f in enumerate(db.children(gene))
-                             if f.id != gene.id})
-            annotations[gene.id] = features
+            annotations[gene.id] = _gene_features(db, gene)
+
+
+def write_sorted_annotations(db, annotations, new_gff_fn):
+    """
+    Write genes from GFF_IN file, given as the path to its gff db or as a FeatureIndex, to new_gff_fn sorted by
+    chromosome, start and id, replacing those in three_prime_UTR annotations dict with their updated features. Genes
+    not in annotations are streamed from the db one at a time, rather than all merged into annotations and sorted with
+    genometools. This saves copying them, but a FeatureIndex still holds all of GFF_IN in memory while writing.
+    Return the number of 3' UTRs written.
+    """
+    logging.info("Writing annotations merged with canonical gff file to %s." % new_gff_fn)
+
+    db = _open_db(db)
+    canonical_genes = (((gene.seqid, gene.start), gene.id, gene)
+                       for gene in db.all_features(featuretype=FeatureTypes.Gene, order_by=("seqid", "start"))
+                       if gene.id not in annotations)
+    # The db only orders genes by position, so order those sharing a start by id.
+    canonical_genes = (gene for _, genes in groupby(canonical_genes, key=itemgetter(0))
+                       for gene in sorted(genes, key=itemgetter(1)))
+    new_genes = sorted(((features["gene"].seqid, features["gene"].start), gid, None)
+                       for gid, features in annotations.items())
+    total_utrs = 0
+    with open(new_gff_fn, 'w') as fout:
+        if not annotations.gtf_out:
+            fout.write("##gff-version 3\n")
+        for _, gid, gene in heapq.merge(canonical_genes, new_genes, key=itemgetter(0, 1)):
+            features = list(annotations[gid].values() if gene is None else _gene_features(db, gene).values())
+            # Keep gene first, then order its descendants by position, with parents before children sharing a start,
+            # and otherwise by featuretype and id, so that output is the same from one run to the next.
+            features[1:] = sorted(features[1:], key=lambda x: (x.start, -x.end, x.featuretype, x.id or ""))
+            total_utrs += len([f for f in features if f.featuretype in FeatureTypes.ThreePrimeUTR])
+            fout.writelines(annotations.iter_gene_feature_strings(gid, features))
+    return total_utrs
+
+
+def _open_db(db):
+    if isinstance(db, FeatureIndex):
+        return db
+    return FeatureDB(sqlite3.connect(db, check_same_thread=False))
+
+
+def _gene_features(db, gene):
+    features = {"gene": gene}
+    features.update({"feature_{}".format(idx): f for idx, f in enumerate(db.children(gene)) if f.id != gene.id})
+    return features
 
 
 def gt_gff3_sort(annotations, new_gff_fn, force=False, gtf_out=False):
@@ -51,7 +99,8 @@ def gt_gff3_sort(annotations, new_gff_fn, force=False, gtf_out=False):
     Use genometools (gt) binary to sort and tidy tmp file into new combined output gff3 file.
     """
     log_fn = "gt_gff3.log"
-    with open(cached(TMP_GFF_FN), 'w') as fout:
+    tmp_gff_fn = cached("%d%s" % (os.getpid(), TMP_GFF_FN))
+    with open(tmp_gff_fn, 'w') as fout:
         fout.writelines(annotations.iter_feature_strings())
     if not gtf_out:
         command = "gt gff3 -sort -retainids -tidy -o {} ".format(new_gff_fn)
@@ -60,7 +109,7 @@ def gt_gff3_sort(annotations, new_gff_fn, force=False, gtf_out=False):
         with open(os.path.join(LOG_DIR, log_fn), 'w') as flog:
             try:
                 output = subprocess.check_output(
-                    command + cached(TMP_GFF_FN),
+                    command + tmp_gff_fn,
                     universal_newlines=True,
                     stderr=subprocess.STDOUT,
                     shell=True
@@ -75,6 +124,7 @@ def gt_gff3_sort(annotations, new_gff_fn, force=False, gtf_out=False):
                 flog.write(output)
                 if os.path.exists(new_gff_fn):
                     logging.info("Successfully formatted GFF3 output file %s using genometools." % new_gff_fn)
+                    os.remove(tmp_gff_fn)
                     return
         logging.warning("Some issues were encountered when processing output file. Check %s." % log_fn)
-    shutil.copy(cached(TMP_GFF_FN), new_gff_fn)
+    shutil.move(tmp_gff_fn, new_gff_fn)
@@ -1,48 +1,97 @@
 import asyncio
 from collections import defaultdict
+from contextlib import ExitStack
 from glob import glob
+from itertools import groupby
 import json
 import logging
+from operator import itemgetter
 import os.path
 import re
 
 from asgiref.sync import sync_to_async
 import gffutils
+from psutil import virtual_memory
 import pysam
 from tqdm import tqdm
 
+from . import constants, gffdb
 from .exceptions import EXCEPTIONS_MAP
-from .models import SoftClippedRead
-from .utils import cached, consume_lines, filter_nested_dict, sum_nested_dicts, multiprocess_over_dict
-from .constants import CACHE_DIR, LOG_DIR, STRAND_PYSAM_ARGS
+from .arrays import aligned_blocks, load_pileups, merge_pileups, pileup_arrays, save_pileups, zero_coverage_intervals
+from .cache import fingerprint_digest
+from .collections import BroadPeaksList, FeatureIndex
+from .models import Peak
+from .scheduler import StageScheduler
+from .utils import CacheLock, atomic_output, atomic_outputs_dir, cache_locked, cached, consume_lines, \
+    multiprocess_over_dict, stage_cache_dir
+from .constants import COVERAGE_WINDOW_SIZE, FEATURE_INDEX_MEMORY_FACTOR, LOG_DIR, MACS3_CALLPEAK_DEFAULTS, \
+    MACS3_EXCLUDED_FLAGS, MACS3_MEMORY_FACTOR, NATIVE_GAPS_MEMORY_FACTOR, PBAR_UPDATE_INTERVAL, PERC_ALLOCATED_VRAM, \
+    SPAT_TILE_SIZE, STRAND_FLAG_FILTERS, STRAND_MAP, STRAND_PYSAM_ARGS
 
 
 class BAMSplitter:
-    def __init__(self, bam_basename, args):
+    def __init__(self, bam_basename, args, pool):
         self.basename = bam_basename
         self.args = args
-        self.pbar = None
+        self.pool = pool
 
     def process(self):
         self.split_strands()
+        self.pileup_soft_clips()
+        self.prepare_coverage_gaps()
+
+    def pileup_soft_clips(self):
         if not self.args.skip_soft_clip:
-            self.split_read_groups()
-            self.pileup_soft_clipped_reads()
+            if self.args.shard_by_region or self.args.filter_strands_on_the_fly:
+                self.pileup_soft_clipped_reads_by_region()
+            else:
+                self.split_read_groups()
+                self.pileup_soft_clipped_reads()
+
+    def prepare_coverage_gaps(self):
         # TODO make this an optional step as it's a bit of a bottleneck for little gain.
-        self.find_zero_coverage_intervals()
+        if self.args.gap_engine in ["lazy", "auto"]:
+            self.indexed_strand_sources()
+        else:
+            self.find_zero_coverage_intervals()
 
+    def choose_gap_engine(self, num_peaks):
+        """
+        Choose between lazily looking up coverage gaps around each peak and a genome-wide native pass, depending on
+        how much of the genome the peaks' coverage windows would span.
+        """
+        with pysam.AlignmentFile(self.args.BAM_IN, "rb") as samfile:
+            genome_size = sum(samfile.lengths)
+        return "lazy" if num_peaks * COVERAGE_WINDOW_SIZE < genome_size else "native"
+
+    def needs_strand_bams(self):
+        """
+        Whether any stage reads the strand BAM files: MACS3 on the command line and bedtools always do, while SPAT
+        pileups and the other zero coverage interval engines only do unless filtering strands of BAM_IN on the fly.
+        """
+        return self.args.macs3_engine == "cli" or self.args.gap_engine == "bedtools" or \
+            not self.args.filter_strands_on_the_fly
+
+    @cache_locked("strands", "strands")
     def split_strands(self):
         self.gap_outputs = {}
+        self.gap_outputs_to_process = {}
+        if not self.needs_strand_bams():
+            logging.info("Filtering strands of %s on the fly, so not splitting strand BAM files." % self.args.BAM_IN)
+            return
+        if self.args.single_pass_split:
+            self._split_strands_single_pass()
         for strand in ["forward", "reverse"]:
-            output_file = cached(self.basename + '.%s.bam' % strand)
+            output_file = cached(self.basename + '.%s.bam' % strand, "strands")
             if not os.path.isfile(output_file):
                 logging.info("Splitting %s strand from %s." % (strand, self.args.BAM_IN))
                 try:
-                    pysam.view(
-                        "--threads", str(self.args.processors),
-                        "-b", *STRAND_PYSAM_ARGS[strand],
-                        "-o", output_file,
-                        self.args.BAM_IN, catch_stdout=False)
+                    with atomic_output(output_file) as tmp_file:
+                        pysam.view(
+                            "--threads", str(self.args.processors),
+                            "-b", *STRAND_PYSAM_ARGS[strand],
+                            "-o", tmp_file,
+                            self.args.BAM_IN, catch_stdout=False)
                 except TypeError as e:
                     logging.error("pysam returned an error: %s" % e)
                     raise
@@ -50,141 +99,550 @@ class BAMSplitter:
                     logging.info("Finished splitting %s strand." % strand)
             else:
                 logging.info("Using cached %s strand BAM file." % strand)
-            self.gap_outputs[output_file] = cached("%s_coverage_gaps.bed" % strand)
+            self.gap_outputs[output_file] = cached("%s_coverage_gaps.bed" % strand, "coverage_gaps")
         self.gap_outputs_to_process = self.gap_outputs.copy()
 
+    def _split_strands_single_pass(self):
+        """
+        Read BAM_IN once, writing each read to the forward or reverse strand BAM file it belongs to.
+        """
+        output_files = {strand: cached(self.basename + '.%s.bam' % strand, "strands") for strand in ["forward", "reverse"]}
+        if all(os.path.isfile(f) for f in output_files.values()):
+            return
+        logging.info("Splitting forward and reverse strands from %s in a single pass." % self.args.BAM_IN)
+        with pysam.AlignmentFile(self.args.BAM_IN, "rb", threads=self.args.processors) as bam_in, \
+             atomic_output(output_files["forward"]) as forward_file, atomic_output(output_files["reverse"]) as reverse_file:
+            outputs = {strand: pysam.AlignmentFile(f, "wb", template=bam_in, threads=self.args.processors)
+                       for strand, f in [("forward", forward_file), ("reverse", reverse_file)]}
+            try:
+                for seg in bam_in.fetch(until_eof=True):
+                    for strand, output in outputs.items():
+                        if is_strand(seg.flag, strand):
+                            output.write(seg)
+            finally:
+                for output in outputs.values():
+                    output.close()
+        logging.info("Finished splitting strands.")
+
+    def indexed_input_bam(self):
+        """
+        Return BAM_IN and the path of its index, creating one in the cache if BAM_IN is not already indexed.
+        """
+        index_file = input_bam_index(self.args.BAM_IN, self.basename)
+        if not os.path.isfile(index_file):
+            with CacheLock(os.path.basename(index_file), stage_cache_dir("strands")):
+                if not os.path.isfile(index_file):
+                    logging.info("Indexing %s." % self.args.BAM_IN)
+                    with atomic_output(index_file) as tmp_file:
+                        pysam.index("-@", str(self.args.processors), self.args.BAM_IN, tmp_file)
+        return self.args.BAM_IN, index_file
+
     @staticmethod
     def num_read_groups(bam):
         header = pysam.view("-H", bam).split("\n")
         return len([h for h in header if h.startswith("@RG")])
 
+    @cache_locked("read_groups", "strands")
     def split_read_groups(self):
         for strand in ["forward", "reverse"]:
-            input_bam = cached(self.basename + '.%s.bam' % strand)
-            if len(glob(cached(self.basename + ".%s_*.bam" % strand))) < self.num_read_groups(input_bam):
+            input_bam = cached(self.basename + '.%s.bam' % strand, "strands")
+            if len(glob(cached(self.basename + ".%s_*.bam" % strand, "strands"))) < self.num_read_groups(input_bam):
                 logging.info("Splitting %s-stranded BAM file into read-groups." % strand)
-                pysam.split("-@", str(self.args.processors), "-f", cached("%*_%#.%."), input_bam)
+                with atomic_outputs_dir("strands") as tmp_dir:
+                    pysam.split("-@", str(self.args.processors), "-f", os.path.join(tmp_dir, "%*_%#.%."), input_bam)
 
-        self.read_group_bams = sorted(glob(cached(self.basename + ".forward_*.bam")) +
-                                      glob(cached(self.basename + ".reverse_*.bam")),
+        self.read_group_bams = sorted(glob(cached(self.basename + ".forward_*.bam", "strands")) +
+                                      glob(cached(self.basename + ".reverse_*.bam", "strands")),
                                       key=lambda x: os.stat(x).st_size,
                                       reverse=True)
         self.spat_outputs = {
-            bf: cached(re.search(r'%s.(.*).bam$' % self.basename, os.path.basename(bf)).group(1) + "_unmapped.json")
+            bf: cached(re.search(r'%s.(.*).bam$' % self.basename, os.path.basename(bf)).group(1) + "_unmapped.npz",
+                       "spat_pileups")
             for bf in self.read_group_bams}
         self.spat_outputs_to_process = self.spat_outputs.copy()
 
     def index_bam_file(self, bam_file):
-        if not os.path.isfile(cached(bam_file + '.bai')):
-            logging.info("Indexing %s." % bam_file)
-            pysam.index("-@", str(self.args.processors), bam_file)
+        with CacheLock(os.path.basename(bam_file) + ".bai", os.path.dirname(bam_file)):
+            if not os.path.isfile(bam_file + '.bai'):
+                logging.info("Indexing %s." % bam_file)
+                with atomic_output(bam_file + '.bai') as tmp_file:
+                    pysam.index("-@", str(self.args.processors), bam_file, tmp_file)
+
+    def indexed_strand_sources(self):
+        """
+        Return strand_sources, indexing the BAM files they read from if need be.
+        """
+        sources = strand_sources(self.args, self.basename)
+        if self.args.filter_strands_on_the_fly:
+            self.indexed_input_bam()
+        else:
+            for bam_file, _, _ in sources.values():
+                self.index_bam_file(bam_file)
+        return sources
 
-    def _get_max_reads_for_pbar(self):
-        max_reads = 0
+    def _get_reads_for_pbar(self):
+        reads = {}
         for bf in self.read_group_bams:
             if not os.path.isfile(self.spat_outputs[bf]):
                 self.index_bam_file(bf)
                 idxstats = pysam.idxstats(bf).split('\n')
-                num_reads = sum([int(chr.split("\t")[2]) + int(chr.split("\t")[3]) for chr in idxstats[:-1]])
-                if num_reads > max_reads:
-                    max_reads = num_reads
-                    self.max_bam = bf
+                reads[bf] = sum([int(chr.split("\t")[2]) + int(chr.split("\t")[3]) for chr in idxstats[:-1]])
             else:
                 del self.spat_outputs_to_process[bf]
-        return max_reads
+        return reads
 
+    @cache_locked("spat_pileups", "spat_pileups")
     def pileup_soft_clipped_reads(self):
-        if not os.path.isfile(cached("forward_unmapped.json")) or not os.path.isfile(cached("reverse_unmapped.json")):
-            max_reads = self._get_max_reads_for_pbar()
-            if self.spat_outputs_to_process and max_reads > 0:
-                with tqdm(total=max_reads,
+        if not all(os.path.isfile(cached("%s_unmapped.npz" % strand, "spat_pileups")) for strand in STRAND_MAP):
+            reads = self._get_reads_for_pbar()
+            if self.spat_outputs_to_process and sum(reads.values()) > 0:
+                with tqdm(total=sum(reads.values()),
                           desc=f'{"INFO": <8} Iterating over reads to determine SPAT pileups',
-                          bar_format='{l_bar}{bar}| [{elapsed}<{remaining}]') as self.pbar:
-                    multiprocess_over_dict(self._count_unmapped_pileups, self.spat_outputs_to_process)
+                          bar_format='{l_bar}{bar}| [{elapsed}<{remaining}]') as pbar:
+                    multiprocess_over_dict(self.pool, _count_unmapped_pileups, self.spat_outputs_to_process,
+                                           self.args.min_poly_tail, weight=os.path.getsize,
+                                           callback=lambda bf: pbar.update(reads[bf]))
 
             logging.info('Merging SPAT outputs.')
             for strand in ["forward", "reverse"]:
-                strand_output = {}
-                for output in self.spat_outputs.values():
-                    if strand in os.path.basename(output):
-                        with open(output, 'r') as f:
-                            strand_output = sum_nested_dicts(strand_output, json.load(f))
-                with open(cached("%s_unmapped.json" % strand), "w") as f:
-                    json.dump(filter_nested_dict(strand_output, self.args.min_pileups), f)
+                pileups = [load_pileups(output) for output in self.spat_outputs.values()
+                           if strand in os.path.basename(output)]
+                self._save_strand_pileups(strand, merge_pileups(pileups, self.args.min_pileups))
         else:
             logging.info("Using cached SPAT pileups.")
 
-    def _count_unmapped_pileups(self, bam_file, output_file):
-        samfile = pysam.AlignmentFile(bam_file, "rb")
-        unmapped = defaultdict(lambda: defaultdict(int))
-        for seg in samfile.fetch(until_eof=True):
-            read = SoftClippedRead(
-                chr=seg.reference_name,
-                start=seg.reference_start,
-                end=seg.reference_end,
-                cigar=seg.cigarstring,
-                seq=seg.query_sequence,
-                strand="reverse" if seg.is_reverse else "forward")
-            if read.poly_tail_exists(self.args.min_poly_tail):
-                unmapped[read.chr][read.extremity] += 1
-            if bam_file == self.max_bam:
-                self.pbar.update()
-
-        with open(output_file, "w") as f:
-            json.dump(unmapped, f)
+    @cache_locked("spat_pileups", "spat_pileups")
+    def pileup_soft_clipped_reads_by_region(self):
+        """
+        Alternative to splitting strand BAM files into read-groups: count SPAT pileups over genomic tiles of the
+        indexed strand BAM files in the pool of --processors processes, so core usage is independent of how many read
+        groups there are. With --filter-strands-on-the-fly, tiles of the indexed BAM_IN are read instead, filtering
+        reads for each strand by their flags.
+        """
+        if not all(os.path.isfile(cached("%s_unmapped.npz" % strand, "spat_pileups")) for strand in STRAND_MAP):
+            shards = []
+            for strand, (bam_file, index_file, flags) in self.indexed_strand_sources().items():
+                shards.extend((strand, bam_file, index_file, *tile, self.args.min_poly_tail, flags is not None)
+                              for tile in iter_tiles(bam_file, index_file))
+            strand_pileups = {"forward": [], "reverse": []}
+            with tqdm(total=len(shards),
+                      desc=f'{"INFO": <8} Iterating over genomic regions to determine SPAT pileups',
+                      bar_format='{l_bar}{bar}| [{elapsed}<{remaining}]') as pbar:
+                for strand, pileups in self.pool.imap_unordered(_count_unmapped_pileups_in_region, shards):
+                    strand_pileups[strand].append(pileups)
+                    pbar.update()
+            for strand, pileups in strand_pileups.items():
+                self._save_strand_pileups(strand, merge_pileups(pileups, self.args.min_pileups))
+        else:
+            logging.info("Using cached SPAT pileups.")
 
+    def _save_strand_pileups(self, strand, pileups):
+        if self.args.spat_json:
+            with atomic_output(cached("%s_unmapped.json" % strand, "spat_pileups")) as tmp_file, open(tmp_file, "w") as f:
+                json.dump({chr: dict(zip(map(str, positions.tolist()), counts.tolist()))
+                           for chr, (positions, counts) in pileups.items()}, f)
+        save_pileups(cached("%s_unmapped.npz" % strand, "spat_pileups"), pileups)
+
+    @cache_locked("coverage_gaps", "coverage_gaps")
     def find_zero_coverage_intervals(self):
-        if not os.path.isfile(cached("forward_coverage_gaps.bed")) or not os.path.isfile(cached("reverse_coverage_gaps.bed")):
+        if not all(os.path.isfile(cached("%s_coverage_gaps.bed" % strand, "coverage_gaps")) for strand in STRAND_MAP):
             logging.info('Filtering intervals with zero coverage.')
-            multiprocess_over_dict(self._find_zero_coverage_intervals, self.gap_outputs_to_process)
+            if self.args.gap_engine == "native":
+                self._find_zero_coverage_intervals_native()
+            else:
+                multiprocess_over_dict(self.pool, _find_zero_coverage_intervals, self.gap_outputs_to_process,
+                                       weight=os.path.getsize)
         else:
             logging.info("Using cached zero coverage intervals.")
 
-    def _find_zero_coverage_intervals(self, bam_file, output_file, min_cov=1):
-        from pybedtools import BedTool
-        bed_tool = BedTool(bam_file)
-        bed = bed_tool.genome_coverage(bga=True, split=True)
-        gaps = bed.filter(lambda x: float(x.name) < min_cov).merge()
-        gaps.saveas(cached(output_file))
+    def _find_zero_coverage_intervals_native(self, min_cov=1):
+        """
+        In-process alternative to bedtools genomecov: compute merged zero-coverage intervals of each contig of the
+        indexed strand BAM files (or with --filter-strands-on-the-fly, of each strand of BAM_IN) in the pool of
+        --processors processes, writing only the gaps.
+        """
+        shards = []
+        contigs = {}
+        for strand, (bam_file, index_file, flags) in self.indexed_strand_sources().items():
+            with pysam.AlignmentFile(bam_file, "rb", index_filename=index_file) as samfile:
+                contigs[strand] = list(zip(samfile.references, samfile.lengths))
+            shards.extend((strand, bam_file, index_file, flags, contig, length, min_cov)
+                          for contig, length in contigs[strand])
+        gaps = defaultdict(dict)
+        with tqdm(total=len(shards),
+                  desc=f'{"INFO": <8} Iterating over contigs to find zero coverage intervals',
+                  bar_format='{l_bar}{bar}| [{elapsed}<{remaining}]') as pbar:
+            for strand, contig, starts, ends in self.pool.imap_unordered(_find_zero_coverage_intervals_in_contig,
+                                                                         shards):
+                gaps[strand][contig] = (starts, ends)
+                pbar.update()
+        for strand in contigs:
+            with atomic_output(cached("%s_coverage_gaps.bed" % strand, "coverage_gaps")) as tmp_file, open(tmp_file, "w") as f:
+                for contig, _ in contigs[strand]:
+                    starts, ends = gaps[strand][contig]
+                    f.writelines("%s\t%d\t%d\n" % (contig, start, end) for start, end in zip(starts, ends))
 
 
-async def create_db(gff_in):
+def input_bam_index(bam_fn, bam_basename):
     """
-    Asynchronously create sqlite3 db for GFF_IN.
+    Path of the index of input bam_fn: alongside it if there is one, otherwise among the cached artifacts.
     """
-    gff_db = cached(os.path.basename(os.path.splitext(gff_in)[0] + '.db'))
-    if not os.path.isfile(gff_db):
-        logging.info('Creating gff db.')
-        await sync_to_async(gffutils.create_db)(
-            gff_in, gff_db, force=True, verbose=True)
-        logging.info('Finished creating gff db.')
-    else:
-        logging.info("Using cached gff db.")
+    index_file = bam_fn + ".bai"
+    return index_file if os.path.isfile(index_file) else cached(bam_basename + ".bam.bai", "strands")
+
+
+def strand_sources(args, bam_basename):
+    """
+    Return {strand: (bam file, index file, flags)} to read the reads of each strand from: its strand BAM file, or with
+    --filter-strands-on-the-fly, BAM_IN keeping the reads with the strand's (required, excluded) SAM flags.
+    """
+    if args.filter_strands_on_the_fly:
+        index_file = input_bam_index(args.BAM_IN, bam_basename)
+        return {strand: (args.BAM_IN, index_file, flags) for strand, flags in STRAND_FLAG_FILTERS.items()}
+    return {strand: (cached("%s.%s.bam" % (bam_basename, strand), "strands"),
+                     cached("%s.%s.bam.bai" % (bam_basename, strand), "strands"), None)
+            for strand in STRAND_FLAG_FILTERS}
+
+
+def is_strand(flag, strand):
+    """
+    Return True if a read with SAM flag would be written to strand's BAM file with STRAND_PYSAM_ARGS.
+    """
+    required, excluded = STRAND_FLAG_FILTERS[strand]
+    return flag & required == required and not flag & excluded
+
+
+def iter_tiles(bam_file, index_file=None, tile_size=SPAT_TILE_SIZE):
+    """
+    Yield (contig, start, end) tiles of at most tile_size bases covering each contig with mapped reads in indexed
+    bam_file.
+    """
+    with pysam.AlignmentFile(bam_file, "rb", index_filename=index_file) as samfile:
+        for stats in samfile.get_index_statistics():
+            if stats.mapped:
+                length = samfile.get_reference_length(stats.contig)
+                for start in range(0, length, tile_size):
+                    yield stats.contig, start, min(start + tile_size, length)
+
+
+def _count_unmapped_pileups(bam_file, output_file, min_poly_tail):
+    with pysam.AlignmentFile(bam_file, "rb") as samfile:
+        unmapped = count_poly_tail_extremities(samfile.fetch(until_eof=True), min_poly_tail)
+    save_pileups(output_file, pileup_arrays(unmapped))
+
+
+def _count_unmapped_pileups_in_region(shard):
+    """
+    Count SPAT pileups for reads starting within one tile of a strand BAM file, so that reads overlapping two tiles
+    are only counted once.
+    """
+    strand, bam_file, index_file, contig, start, end, min_poly_tail, filter_strand = shard
+    with pysam.AlignmentFile(bam_file, "rb", index_filename=index_file) as samfile:
+        segments = (seg for seg in samfile.fetch(contig, start, end)
+                    if seg.reference_start >= start and (not filter_strand or is_strand(seg.flag, strand)))
+        return strand, pileup_arrays(count_poly_tail_extremities(segments, min_poly_tail))
+
+
+def _find_zero_coverage_intervals_in_contig(shard):
+    """
+    Find merged intervals of contig covered by fewer than min_cov reads, as bedtools genomecov -bga -split would.
+    """
+    strand, bam_file, index_file, flags, contig, length, min_cov = shard
+    with pysam.AlignmentFile(bam_file, "rb", index_filename=index_file) as samfile:
+        starts, ends = zero_coverage_intervals(*aligned_blocks(samfile, contig, flags=flags), length, min_cov)
+    return strand, contig, starts, ends
+
+
+def _find_zero_coverage_intervals(bam_file, output_file, min_cov=1):
+    from pybedtools import BedTool
+    bed_tool = BedTool(bam_file)
+    bed = bed_tool.genome_coverage(bga=True, split=True)
+    gaps = bed.filter(lambda x: float(x.name) < min_cov).merge()
+    with atomic_output(output_file) as tmp_file:
+        gaps.saveas(tmp_file)
+
+
+def count_poly_tail_extremities(segments, min_poly_tail, pbar=None):
+    """
+    Tally extremities of reads with a poly-A/T tail of at least min_poly_tail bases in their soft-clipped end, per
+    chromosome. Gives the same counts as SoftClippedRead.poly_tail_exists, but reads cigartuples directly, only touches
+    the sequence of reads soft-clipped at the relevant end, and updates optional tqdm pbar in chunks.
+    """
+    poly_tail = re.compile("A{%d}|T{%d}" % (min_poly_tail, min_poly_tail))
+    unmapped = defaultdict(lambda: defaultdict(int))
+    num_reads = 0
+    for seg in segments:
+        num_reads += 1
+        if pbar and num_reads % PBAR_UPDATE_INTERVAL == 0:
+            pbar.update(PBAR_UPDATE_INTERVAL)
+        cigar = seg.cigartuples
+        if not cigar:
+            continue
+        op, length = cigar[0] if seg.is_reverse else cigar[-1]
+        if op != pysam.CSOFT_CLIP or length == 0:
+            continue
+        seq = seg.query_sequence
+        if seq is None:
+            continue
+        if seg.is_reverse:
+            if poly_tail.search(seq, 0, length):
+                unmapped[seg.reference_name][seg.reference_start] += 1
+        elif poly_tail.search(seq, len(seq) - length):
+            unmapped[seg.reference_name][seg.reference_end] += 1
+    if pbar:
+        pbar.update(num_reads % PBAR_UPDATE_INTERVAL)
+    return {chr: dict(extremities) for chr, extremities in unmapped.items()}
+
+
+async def create_db(gff_in, engine="gffutils"):
+    """
+    Asynchronously create sqlite3 db for GFF_IN. The db is named after the fingerprint of GFF_IN and the engine creating
+    it, so that runs sharing a cache directory reuse the db of the same reference annotation only if created alike.
+    """
+    gff_db = os.path.join(constants.CACHE_DIR, "%s.%s.%s.db" % (
+        os.path.basename(os.path.splitext(gff_in)[0]), fingerprint_digest(gff_in), engine))
+    return await sync_to_async(_create_db, thread_sensitive=False)(gff_in, gff_db, engine)
+
+
+def _create_db(gff_in, gff_db, engine):
+    with CacheLock(os.path.basename(gff_db), constants.CACHE_DIR):
+        if not os.path.isfile(gff_db):
+            logging.info('Creating gff db.')
+            with atomic_output(gff_db) as tmp_file:
+                if engine == "fast":
+                    gffdb.create_db(gff_in, tmp_file, force=True, verbose=True)
+                else:
+                    gffutils.create_db(gff_in, tmp_file, force=True, verbose=True)
+            logging.info('Finished creating gff db.')
+        else:
+            logging.info("Using cached gff db.")
     return gff_db
 
 
-async def call_peaks(bam_basename, strand):
+async def index_features(gff_in):
+    """
+    Asynchronously parse GFF_IN into an in-memory FeatureIndex, in place of creating a sqlite3 db.
+    """
+    logging.info('Indexing features from %s in memory.' % gff_in)
+    index = await sync_to_async(FeatureIndex, thread_sensitive=False)(gff_fn=gff_in)
+    logging.info('Finished indexing features.')
+    return index
+
+
+async def call_peaks(bam_basename, strand, args):
     """
     Call MACS3 asynchronously for stranded BAM file.
     """
-    if not os.path.isfile(cached("%s_peaks.broadPeak" % strand)):
+    lock = CacheLock("%s_peaks" % strand, stage_cache_dir("peaks"))
+    await sync_to_async(lock.acquire, thread_sensitive=False)()
+    try:
+        await _call_peaks(bam_basename, strand, args)
+    finally:
+        lock.release()
+
+
+async def _call_peaks(bam_basename, strand, args):
+    if not os.path.isfile(cached("%s_peaks.broadPeak" % strand, "peaks")):
         logging.info("Calling peaks for %s strand with MACS3." % strand)
-        process = await asyncio.create_subprocess_exec(
-            "macs3", "callpeak",
-            "-t", cached(bam_basename + '.%s.bam' % strand),
-            "-n", strand,
-            "--nomodel",
-            "--extsize", "200",
-            "--broad",
-            "--outdir", CACHE_DIR,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.STDOUT
-        )
-        asyncio.create_task(consume_lines(process.stdout, os.path.join(LOG_DIR, "%s_macs3.log" % strand)))
-        exit_code = await process.wait()
-        if exit_code != 0:
-            logging.error("MACS3 returned an error.")
-            raise EXCEPTIONS_MAP.get(call_peaks.__name__, Exception)("Check %s_macs3.log." % strand)
+        with atomic_outputs_dir("peaks") as tmp_dir:
+            process = await asyncio.create_subprocess_exec(
+                "macs3", "callpeak",
+                "-t", cached(bam_basename + '.%s.bam' % strand, "strands"),
+                "-n", strand,
+                "--nomodel",
+                "--extsize", str(args.macs3_extsize),
+                "--gsize", args.macs3_gsize,
+                "--qvalue", str(args.macs3_qvalue),
+                "--broad",
+                "--broad-cutoff", str(args.macs3_broad_cutoff),
+                "--outdir", tmp_dir,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.STDOUT
+            )
+            asyncio.create_task(consume_lines(process.stdout, os.path.join(LOG_DIR, "%s_macs3.log" % strand)))
+            exit_code = await process.wait()
+            if exit_code != 0:
+                logging.error("MACS3 returned an error.")
+                raise EXCEPTIONS_MAP.get(call_peaks.__name__, Exception)("Check %s_macs3.log." % strand)
         logging.info("Finished calling %s strand peaks." % strand)
     else:
         logging.info("Using cached %s strand peaks file." % strand)
+
+
+async def call_peaks_in_process(args):
+    """
+    In-process alternative to call_peaks for both strands: build a MACS3 track of each strand in a single pass over
+    BAM_IN and call broad peaks on them with the MACS3 library, returning peaks as a BroadPeaksList rather than parsing
+    them back from the broadPeak files, which are still cached.
+    """
+    broadpeak_fns = {strand: cached("%s_peaks.broadPeak" % strand, "peaks") for strand in STRAND_FLAG_FILTERS}
+    peaks = await sync_to_async(_cached_peaks_in_process, thread_sensitive=False)(args, broadpeak_fns)
+    return peaks["forward"] + peaks["reverse"]
+
+
+def _cached_peaks_in_process(args, broadpeak_fns):
+    with ExitStack() as stack:
+        # Locked in the same order by every run, under the names call_peaks locks each strand's peaks file by.
+        for strand in broadpeak_fns:
+            stack.enter_context(CacheLock("%s_peaks" % strand, stage_cache_dir("peaks")))
+        if all(os.path.isfile(fn) for fn in broadpeak_fns.values()):
+            logging.info("Using cached peaks files.")
+            return {strand: BroadPeaksList(broadpeak_fn=fn, strand=strand) for strand, fn in broadpeak_fns.items()}
+        logging.info("Calling peaks for both strands with MACS3 library.")
+        peaks = _call_peaks_in_process(args, broadpeak_fns)
+        logging.info("Finished calling peaks.")
+        return peaks
+
+
+def schedule_preprocessing(bam_basename, args, pool):
+    """
+    Return a StageScheduler of the pre-processing stages, with a budget of --processors CPU slots and of the share of
+    memory peaks2utr allocates itself. The gff db (or in-memory index) does not depend on the BAM file, nor do
+    in-process MACS3 peaks on the strand BAM files, so these run alongside the BAM stages. The gff db uses no slot, so
+    it overlaps MACS3 even with a single processor, as it always has. Results are stored under "gff_db" and "peaks".
+
+    Stages holding much of an input file in memory reserve a rough estimate of what it takes, so that building the
+    in-memory index, calling peaks with MACS3 and finding native gaps only run together if memory allows. With
+    --gap-engine auto, gaps reserve as much as the native engine might take.
+
+    Stages run their multiprocess tasks in pool, one pool of --processors worker processes shared by all of them, so
+    that together they never use more than --processors cores, and none of them forks processes of its own.
+
+    Stages running pysam commands hold every slot, so no two of them run at once, as pysam commands are not thread-safe.
+    """
+    bam_splitter = BAMSplitter(bam_basename, args, pool)
+    scheduler = StageScheduler(args.processors, PERC_ALLOCATED_VRAM * virtual_memory().total / 100)
+    bam_size, gff_size = os.path.getsize(args.BAM_IN), os.path.getsize(args.GFF_IN)
+
+    async def load_annotations():
+        if args.db_engine == "memory":
+            return await index_features(args.GFF_IN)
+        return await create_db(args.GFF_IN, args.db_engine)
+
+    async def load_peaks():
+        if args.macs3_engine == "api":
+            return await call_peaks_in_process(args)
+        await asyncio.gather(call_peaks(bam_basename, "forward", args), call_peaks(bam_basename, "reverse", args))
+        return BroadPeaksList(broadpeak_fn=cached("forward_peaks.broadPeak", "peaks"), strand="forward") + \
+            BroadPeaksList(broadpeak_fn=cached("reverse_peaks.broadPeak", "peaks"), strand="reverse")
+
+    def prepare_coverage_gaps():
+        if args.gap_engine == "auto":
+            args.gap_engine = bam_splitter.choose_gap_engine(len(scheduler.results["peaks"]))
+            logging.info("Using %s zero coverage interval engine." % args.gap_engine)
+        bam_splitter.prepare_coverage_gaps()
+
+    scheduler.add("strands", bam_splitter.split_strands, cpus=args.processors)
+    scheduler.add("gff_db", load_annotations, cpus=0,
+                  mem=gff_size * FEATURE_INDEX_MEMORY_FACTOR if args.db_engine == "memory" else 0)
+    scheduler.add("spat_pileups", bam_splitter.pileup_soft_clips, deps=["strands"], cpus=args.processors)
+    scheduler.add("peaks", load_peaks, deps=[] if args.macs3_engine == "api" else ["strands"],
+                  cpus=1 if args.macs3_engine == "api" else 2, mem=bam_size * MACS3_MEMORY_FACTOR)
+    scheduler.add("coverage_gaps", prepare_coverage_gaps,
+                  deps=["strands", "peaks"] if args.gap_engine == "auto" else ["strands"],
+                  cpus={"bedtools": 2, "lazy": 1}.get(args.gap_engine, args.processors),
+                  mem=bam_size * NATIVE_GAPS_MEMORY_FACTOR if args.gap_engine in ["native", "auto"] else 0)
+    return scheduler
+
+
+def _call_peaks_in_process(args, broadpeak_fns):
+    from MACS3.Signal.PeakDetect import PeakDetect
+
+    tracks, tag_sizes = macs3_strand_tracks(args.BAM_IN, MACS3_CALLPEAK_DEFAULTS["buffer_size"])
+    macs3_logger = logging.getLogger("MACS3")
+    peaks = {}
+    for strand, track in tracks.items():
+        handler = logging.FileHandler(os.path.join(LOG_DIR, "%s_macs3.log" % strand), mode="w")
+        macs3_logger.addHandler(handler)
+        macs3_logger.propagate = False
+        try:
+            options = macs3_callpeak_options(args, strand, tag_sizes[strand])
+            track.filter_dup(int(options.keepduplicates))
+            peakdetect = PeakDetect(treat=track, control=None, opt=options)
+            peakdetect.call_peaks()
+            peakdetect.peaks.filter_fc(fc_low=options.fecutoff)
+        except SystemExit:
+            logging.error("MACS3 returned an error.")
+            raise EXCEPTIONS_MAP.get(call_peaks.__name__, Exception)("Check %s_macs3.log." % strand)
+        finally:
+            macs3_logger.removeHandler(handler)
+            macs3_logger.propagate = True
+            handler.close()
+        with atomic_output(broadpeak_fns[strand]) as tmp_file, open(tmp_file, "w") as f:
+            peakdetect.peaks.write_to_broadPeak(f, name_prefix=b"%s_peak_", name=strand.encode(),
+                                                description=strand.encode(), score_column="qscore", trackline=False)
+        peaks[strand] = BroadPeaksList(macs3_broad_peaks(peakdetect.peaks, strand))
+    return peaks
+
+
+def macs3_strand_tracks(bam_fn, buffer_size):
+    """
+    Read bam_fn once into a MACS3 FWTrack of the reads that each strand's BAM file would hold, keeping only the reads
+    MACS3 itself would parse from it. Return tracks and the tag size MACS3 would determine for each strand, from the
+    first 10 reads of its BAM file.
+    """
+    from MACS3.Signal.FixWidthTrack import FWTrack
+
+    tracks = {strand: FWTrack(buffer_size=buffer_size) for strand in STRAND_FLAG_FILTERS}
+    tag_sizes = {strand: [] for strand in STRAND_FLAG_FILTERS}
+    with pysam.AlignmentFile(bam_fn, "rb") as samfile:
+        references = [reference.encode() for reference in samfile.references]
+        for seg in samfile.fetch(until_eof=True):
+            flag = seg.flag
+            for strand, track in tracks.items():
+                if not is_strand(flag, strand):
+                    continue
+                if len(tag_sizes[strand]) < 10:
+                    tag_sizes[strand].append(seg.query_length)
+                # Paired reads are only counted once, by their proper-pair mate 1.
+                if flag & MACS3_EXCLUDED_FLAGS or (flag & 1 and (flag & 136 or not flag & 2)):
+                    continue
+                if flag & 16:
+                    track.add_loc(references[seg.reference_id], seg.reference_end, 1)
+                else:
+                    track.add_loc(references[seg.reference_id], seg.reference_start, 0)
+        rlengths = dict(zip(references, samfile.lengths))
+    for track in tracks.values():
+        track.finalize()
+        track.set_rlengths(rlengths)
+    return tracks, {strand: int(sum(sizes) / len(sizes)) if sizes else 0 for strand, sizes in tag_sizes.items()}
+
+
+def macs3_callpeak_options(args, strand, tsize):
+    """
+    Options for calling broad peaks without a model on strand with the MACS3 library, as `macs3 callpeak` would
+    validate them from the command line of call_peaks.
+    """
+    from argparse import Namespace
+
+    from MACS3.Utilities.OptValidator import opt_validate_callpeak
+
+    options = Namespace(**MACS3_CALLPEAK_DEFAULTS)
+    options.tfile = [cached("%s.%s.bam" % (os.path.basename(os.path.splitext(args.BAM_IN)[0]), strand), "strands")]
+    options.name = strand
+    options.outdir = stage_cache_dir("peaks")
+    options.extsize = args.macs3_extsize
+    options.gsize = args.macs3_gsize
+    options.qvalue = args.macs3_qvalue
+    options.broadcutoff = args.macs3_broad_cutoff
+    options = opt_validate_callpeak(options)
+    options.tsize = tsize
+    options.PE_MODE = False
+    options.d = options.extsize
+    options.scanwindow = 2 * options.d
+    return options
+
+
+def macs3_broad_peaks(peakio, strand):
+    """
+    Yield Peaks of MACS3 BroadPeakIO peakio as written to a broadPeak file by MACS3, with strand.
+    """
+    n_peak = 0
+    for chrom in sorted(peakio.peaks.keys()):
+        for _, group in groupby(peakio.peaks[chrom], key=itemgetter("end")):
+            n_peak += 1
+            peak = next(group)
+            p = Peak(chrom.decode(), peak["start"], peak["end"], "%s_peak_%d" % (strand, n_peak),
+                     int(10 * peak["qscore"]), ".", *(float("%.6g" % peak[key]) for key in ["fc", "pscore", "qscore"]))
+            p.strand = STRAND_MAP[strand]
+            yield p
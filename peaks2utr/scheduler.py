@@ -0,0 +1,111 @@
+import asyncio
+import logging
+import time
+
+
+class Stage:
+    def __init__(self, name, func, deps=(), cpus=1, mem=0):
+        self.name = name
+        self.func = func
+        self.deps = list(deps)
+        self.cpus = cpus
+        self.mem = mem
+
+
+class StageScheduler:
+    """
+    Run pipeline stages as asyncio tasks, each as soon as the stages it depends on have finished, within a budget of
+    CPU slots and bytes of memory shared by all stages. A stage holds as many slots and bytes as it uses while it runs
+    (each capped at the budget), so independent stages overlap only as far as the budget allows; I/O-bound stages using
+    neither run regardless.
+    Blocking stage functions are run in an executor thread each, so the event loop stays free to run coroutine stages
+    and start others while they block. Stages needing worker processes should submit tasks to a pool forked before the
+    scheduler runs, rather than fork from their executor thread, which is unsafe.
+    """
+    def __init__(self, cpus, mem=None):
+        self.cpus = max(1, cpus)
+        self.mem = mem
+        self.free = self.cpus
+        self.free_mem = mem
+        self.stages = {}
+        self.results = {}
+        self.timings = {}
+        self._budget = None
+
+    def add(self, name, func, deps=(), cpus=1, mem=0):
+        """
+        Add stage name, calling func (a coroutine function or blocking function) with no arguments once each of the
+        stages in deps has finished, and once cpus slots and mem bytes of the budget are free. The result of func is
+        stored in results[name].
+        """
+        for dep in deps:
+            if dep not in self.stages:
+                raise ValueError("Stage %s depends on unknown stage %s." % (name, dep))
+        self.stages[name] = Stage(name, func, deps, min(cpus, self.cpus), min(mem, self.mem) if self.mem else 0)
+
+    def _fits(self, stage):
+        return self.free >= stage.cpus and (not self.mem or self.free_mem >= stage.mem)
+
+    async def _run_stage(self, stage, tasks):
+        for dep in stage.deps:
+            await tasks[dep]
+        async with self._budget:
+            await self._budget.wait_for(lambda: self._fits(stage))
+            self.free -= stage.cpus
+            if self.mem:
+                self.free_mem -= stage.mem
+        start = time.monotonic()
+        try:
+            if asyncio.iscoroutinefunction(stage.func):
+                result = await stage.func()
+            else:
+                result = await asyncio.get_running_loop().run_in_executor(None, stage.func)
+        finally:
+            self.timings[stage.name] = (start, time.monotonic())
+            async with self._budget:
+                self.free += stage.cpus
+                if self.mem:
+                    self.free_mem += stage.mem
+                self._budget.notify_all()
+        self.results[stage.name] = result
+        return result
+
+    async def run(self):
+        """
+        Run all stages, returning their results by name. If any stage fails, cancel the others and raise its exception.
+        """
+        self._budget = asyncio.Condition()
+        start = time.monotonic()
+        tasks = {}
+        for name, stage in self.stages.items():
+            tasks[name] = asyncio.ensure_future(self._run_stage(stage, tasks))
+        try:
+            await asyncio.gather(*tasks.values())
+        except BaseException:
+            for task in tasks.values():
+                task.cancel()
+            raise
+        path = self.critical_path()
+        logging.info("Pre-processing took %.1fs, with a critical path of %.1fs: %s." % (
+            time.monotonic() - start, sum(self.duration(name) for name in path),
+            " > ".join("%s (%.1fs)" % (name, self.duration(name)) for name in path)))
+        return self.results
+
+    def duration(self, name):
+        start, end = self.timings[name]
+        return end - start
+
+    def critical_path(self):
+        """
+        Return names of the longest chain of dependent stages by the time they took to run, which bounds the time the
+        stages could take however large the budget. Where the time taken overall is longer, stages were kept waiting
+        on the budget.
+        """
+        if not self.timings:
+            return []
+        longest = {}
+        # Stages are added after the stages they depend on, so each chain ending in a dependency is already known.
+        for name, stage in self.stages.items():
+            chain = max((longest[dep] for dep in stage.deps), key=lambda chain: chain[0], default=(0, []))
+            longest[name] = (chain[0] + self.duration(name), chain[1] + [name])
+        return max(longest.values(), key=lambda chain: chain[0], default=(0, []))[1]
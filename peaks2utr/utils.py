@@ -1,9 +1,17 @@
-import multiprocessing
+from contextlib import contextmanager
+import fcntl
+import functools
+import logging
+from multiprocessing.connection import wait
+import os
 import os.path
-from queue import Empty
 import resource
+import shutil
+import tempfile
+import time
+import traceback
 
-from .constants import CACHE_DIR
+from . import constants
 from .exceptions import EXCEPTIONS_MAP
 
 
@@ -14,11 +22,14 @@ class Falsey:
 
 
 class Counter:
+    """
+    Process-local tally, so counting takes no locks. Worker processes each keep their own and send its value to the
+    parent process to be merged once they finish.
+    """
     seen = set()
 
     def __init__(self):
-        self.val = multiprocessing.Value('i', 0)
-        self.lock = multiprocessing.Lock()
+        self.val = 0
 
     def __int__(self):
         return self.value
@@ -26,27 +37,133 @@ class Counter:
     def add(self, key):
         """
         Add key to global seen set. This Counter will only increment if key is not a duplicate in _any_ Counter.
+        Keys are only deduplicated within a process, so a given key should only ever be added in one process.
         """
         if key not in self.seen:
-            with self.lock:
-                self.val.value += 1
-                self.seen.add(key)
+            self.val += 1
+            self.seen.add(key)
 
     def increment(self):
         """
         Increment this Counter in any circumstance.
         """
-        with self.lock:
-            self.val.value += 1
+        self.val += 1
+
+    def merge(self, value):
+        """
+        Add value tallied by another process to this Counter.
+        """
+        self.val += value
 
     @property
     def value(self):
-        with self.lock:
-            return self.val.value
+        return self.val
+
+
+def stage_cache_dir(stage=None):
+    """
+    Directory of the cached outputs of pre-processing stage, or of the artifacts derived from BAM_IN if stage is None
+    or has no directory of its own.
+    """
+    return constants.STAGE_CACHE_DIRS.get(stage, constants.BAM_CACHE_DIR)
+
+
+def cached(filename, stage=None):
+    """
+    Path of filename among the cached outputs of stage (by default, among the artifacts derived from BAM_IN).
+    """
+    return os.path.join(stage_cache_dir(stage), filename)
+
+
+class CacheLock:
+    """
+    Advisory lock on a file in the cache directory (by default, the directory of artifacts derived from BAM_IN), so
+    that concurrent runs sharing it neither race to produce the same artifact nor remove artifacts another run is using.
+    """
+    def __init__(self, name, cache_dir=None):
+        self.lock_fn = os.path.join(cache_dir, name + ".lock") if cache_dir else cached(name + ".lock")
+        self.f = None
+
+    def acquire(self, shared=False, blocking=True):
+        """
+        Acquire a shared or exclusive lock. Return False if not blocking and the lock is held by another run.
+        """
+        while True:
+            if self.f is None:
+                os.makedirs(os.path.dirname(self.lock_fn), exist_ok=True)
+                self.f = open(self.lock_fn, "a")
+            try:
+                fcntl.flock(self.f, (fcntl.LOCK_SH if shared else fcntl.LOCK_EX) | (0 if blocking else fcntl.LOCK_NB))
+            except BlockingIOError:
+                self.release()
+                return False
+            # Another run may have cleared the cache directory while this one waited, leaving the lock on an unlinked
+            # file, in which case lock a new one.
+            try:
+                if os.stat(self.lock_fn).st_ino == os.fstat(self.f.fileno()).st_ino:
+                    return True
+            except FileNotFoundError:
+                pass
+            self.release()
+
+    def release(self):
+        if self.f is not None:
+            fcntl.flock(self.f, fcntl.LOCK_UN)
+            self.f.close()
+            self.f = None
 
+    def __enter__(self):
+        self.acquire()
+        return self
 
-def cached(filename):
-    return os.path.join(CACHE_DIR, filename)
+    def __exit__(self, type, value, traceback):
+        self.release()
+
+
+def cache_locked(name, stage=None):
+    """
+    Decorate function producing cached outputs of stage to run under CacheLock(name) in the stage's directory, so that
+    concurrent runs sharing the cache wait for one another and reuse the outputs rather than producing them at the same
+    time.
+    """
+    def decorator(f):
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            with CacheLock(name, stage_cache_dir(stage)):
+                return f(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+@contextmanager
+def atomic_output(filename):
+    """
+    Yield a temporary path alongside filename, which is renamed to filename only once written successfully, so that
+    a cached artifact is never seen partially written.
+    """
+    dirname, basename = os.path.split(filename)
+    tmp_fn = os.path.join(dirname, ".%d.%s" % (os.getpid(), basename))
+    try:
+        yield tmp_fn
+        os.replace(tmp_fn, filename)
+    finally:
+        if os.path.exists(tmp_fn):
+            os.remove(tmp_fn)
+
+
+@contextmanager
+def atomic_outputs_dir(stage=None):
+    """
+    Yield a temporary directory within the directory of cached outputs of stage (by default, of artifacts derived from
+    BAM_IN), whose files are renamed into it only once all were written successfully.
+    """
+    tmp_dir = tempfile.mkdtemp(prefix=".", dir=stage_cache_dir(stage))
+    try:
+        yield tmp_dir
+        for fn in os.listdir(tmp_dir):
+            os.replace(os.path.join(tmp_dir, fn), cached(fn, stage))
+    finally:
+        shutil.rmtree(tmp_dir)
 
 
 async def consume_lines(pipe, log_file):
@@ -58,21 +175,35 @@ async def consume_lines(pipe, log_file):
             f.write(line)
 
 
-def multiprocess_over_dict(f, d):
+def multiprocess_over_dict(pool, f, d, *args, weight=None, callback=None):
     """
-    Assign a multiprocessing Process to call function f for every key-value pair in d, passing this item
-    as the function's first argument.
-    Start each process and wait for them all to finish before returning.
+    Call function f for every key-value pair in d as a task of pool, passing this item followed by args as the
+    function's arguments. Items are submitted in order of descending weight(key) if given, so that the largest are not
+    left until last, and at most as many run at once as pool has worker processes. Call callback(key) in this process
+    as each item finishes, and wait for them all to finish before returning. If f raises for any item, raise the
+    exception mapped to f, naming the failed item and with the traceback of its worker.
     """
-    jobs = []
-    for input, output in d.items():
-        p = multiprocessing.Process(target=f, args=(input, output))
-        jobs.append(p)
-        p.start()
-    for job in jobs:
-        job.join()
-        if job.exitcode != 0:
-            raise EXCEPTIONS_MAP.get(f.__name__, Exception)
+    items = sorted(d.items(), key=lambda item: weight(item[0]), reverse=True) if weight else list(d.items())
+    for input, elapsed, error in pool.imap_unordered(functools.partial(_call_over_item, f, args), items):
+        if error is not None:
+            raise EXCEPTIONS_MAP.get(f.__name__, Exception)("{} failed for {}:\n{}".format(f.__name__, input, error))
+        logging.debug("%s finished for %s in %.1fs." % (f.__name__, input, elapsed))
+        if callback:
+            callback(input)
+
+
+def _call_over_item(f, args, item):
+    """
+    Call f with item and args in a worker process, returning the item's key with either the time taken or the
+    traceback of the exception raised, which may not be picklable itself.
+    """
+    input, output = item
+    start = time.monotonic()
+    try:
+        f(input, output, *args)
+    except Exception:
+        return input, None, traceback.format_exc()
+    return input, time.monotonic() - start, None
 
 
 def format_stats_line(msg, total, numerator=None):
@@ -95,21 +226,31 @@ def iter_batches(lst, n):
         yield lst[i:i + n]
 
 
-def yield_from_process(q, p, pbar=None):
+def yield_from_processes(connections, processes, error=Exception):
     """
-    Yield items in queue q while each process p is alive. This prevents program from locking up when queue
-    gets too large.
-    Pass an optional tqdm progress bar (pbar) to keep a single progress bar running over multiple processes.
+    Yield objects received over connections, the receiving ends of the pipes processes send them over, as they arrive
+    from any of them, until all processes have exited and their pipes are drained. Connections and the processes'
+    sentinels are waited on together, so objects are yielded as soon as they are sent and the last worker's exit is
+    seen immediately. If any process exits with a non-zero exit code, terminate and join the others and raise error.
     """
-    while p.is_alive():
-        p.join(timeout=1)
-        while True:
-            try:
-                yield q.get(block=False)
-                if pbar:
-                    pbar.update()
-            except Empty:
-                break
+    running = {p.sentinel: p for p in processes}
+    readers = list(connections)
+    while running or readers:
+        for ready in wait(readers + list(running)):
+            if ready in running:
+                p = running.pop(ready)
+                p.join()
+                if p.exitcode != 0:
+                    for other in running.values():
+                        other.terminate()
+                    for other in running.values():
+                        other.join()
+                    raise error("Process {} exited with code {}.".format(p.name, p.exitcode))
+            else:
+                try:
+                    yield ready.recv()
+                except EOFError:
+                    readers.remove(ready)
 
 
 def limit_memory(maxsize):
@@ -118,35 +259,3 @@ def limit_memory(maxsize):
     """
     _, hard = resource.getrlimit(resource.RLIMIT_AS)
     resource.setrlimit(resource.RLIMIT_AS, (int(maxsize), hard))
-
-
-def filter_nested_dict(node, threshold):
-    """
-    For an n-nested dictionary, filter out integer leaves with a minimum threshold value.
-    """
-    if isinstance(node, int):
-        if node >= threshold:
-            return node
-    else:
-        dupe_node = {}
-        for k, v in node.items():
-            cur_node = filter_nested_dict(v, threshold)
-            if cur_node:
-                dupe_node[k] = cur_node
-        return dupe_node or None
-
-
-def sum_nested_dicts(d1, d2):
-    """
-    For an n-nested dictionary, sum numeric values in leaves with matching keys.
-    """
-    def sum(v1, v2):
-        if v2 is None:
-            return v1
-        try:
-            return v1 + v2
-        except TypeError:
-            return sum_nested_dicts(v1, v2)
-    result = d2.copy()
-    result.update({k: sum(v, d2.get(k)) for k, v in d1.items()})
-    return result
@@ -0,0 +1,72 @@
+"""
+Benchmark gff db creation with gffutils.create_db against peaks2utr's fast path on the bundled demo GFF, optionally
+tiled into a larger annotation with --copies, checking that both produce the same tables.
+
+    python tests/benchmark_create_db.py --copies 50
+"""
+import argparse
+import os
+import re
+import sqlite3
+import tempfile
+import time
+
+import gffutils
+
+from peaks2utr import gffdb
+
+DEMO_GFF = os.path.join(os.path.dirname(__file__), os.pardir, "peaks2utr", "demo", "Tb927_01_v5.1.gff")
+
+
+def tile_gff(gff_in, gff_out, copies):
+    """
+    Write copies of gff_in to gff_out, each on its own renamed sequence with renamed IDs.
+    """
+    with open(gff_in) as f:
+        lines = [line for line in f if not line.startswith("#")]
+    with open(gff_out, "w") as f:
+        f.write("##gff-version 3\n")
+        for copy in range(copies):
+            prefix = "copy%d_" % copy
+            for line in lines:
+                line = re.sub(r"(ID=|Parent=)", r"\1" + prefix, line)
+                f.write(prefix + line)
+
+
+def dump(db_fn):
+    conn = sqlite3.connect(db_fn)
+    tables = [
+        conn.execute("SELECT * FROM features ORDER BY rowid").fetchall(),
+        sorted(conn.execute("SELECT * FROM relations").fetchall()),
+        conn.execute("SELECT * FROM autoincrements ORDER BY base").fetchall(),
+    ]
+    conn.close()
+    return tables
+
+
+def benchmark(gff_fn, repeats):
+    timings = {}
+    dumps = {}
+    for name, create_db in [("gffutils", gffutils.create_db), ("fast", gffdb.create_db)]:
+        db_fn = os.path.join(os.path.dirname(gff_fn), name + ".db")
+        timings[name] = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            create_db(gff_fn, db_fn, force=True)
+            timings[name].append(time.perf_counter() - start)
+        dumps[name] = dump(db_fn)
+    return {name: min(t) for name, t in timings.items()}, dumps["gffutils"] == dumps["fast"]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--copies", type=int, default=1, help="tile demo GFF this many times.")
+    parser.add_argument("--repeats", type=int, default=3, help="best of this many runs.")
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        gff_fn = os.path.join(tmp_dir, "demo.gff")
+        tile_gff(DEMO_GFF, gff_fn, args.copies)
+        timings, identical = benchmark(gff_fn, args.repeats)
+    print("gffutils.create_db: %.3fs" % timings["gffutils"])
+    print("gffdb.create_db:    %.3fs (%.1fx)" % (timings["fast"], timings["gffutils"] / timings["fast"]))
+    print("identical tables:   %s" % identical)
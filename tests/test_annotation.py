@@ -1,14 +1,20 @@
 import os
 import os.path
-from queue import Queue
+import tempfile
 import unittest
+from unittest import mock
 
 import gffutils
 
 from peaks2utr import prepare_argparser
 from peaks2utr.annotations import AnnotationsPipeline, NoNearbyFeatures
+from peaks2utr.arrays import save_pileups
+from peaks2utr.constants import AnnotationColour, CHUNKS_PER_PROCESSOR, STRAND_MAP
+from peaks2utr.exceptions import AnnotationsError
 from peaks2utr.models import UTR, FeatureDB
-from peaks2utr.collections import AnnotationsDict, BroadPeaksList, ZeroCoverageIntervalsDict, SPATTruncationPointsDict
+from peaks2utr.collections import AnnotationsDict, BroadPeaksList, FeatureIndex, ZeroCoverageIntervalsDict, \
+    SPATTruncationPointsDict
+from peaks2utr.utils import Counter
 
 TEST_DIR = os.path.dirname(__file__)
 
@@ -29,22 +35,23 @@ class TestUTRAnnotation(unittest.TestCase):
         os.remove(os.path.join(TEST_DIR, "Chr1.db"))
 
     def strand_annotations(self, peaks_filename, strand, expected_annotations):
+        for db in (self.db, FeatureIndex(db=self.db), FeatureIndex(gff_fn=os.path.join(TEST_DIR, "Chr1.gtf"))):
+            self._strand_annotations(db, peaks_filename, strand, expected_annotations)
+
+    def _strand_annotations(self, db, peaks_filename, strand, expected_annotations):
         peaks = BroadPeaksList(broadpeak_fn=peaks_filename, strand=strand)
         annotations = AnnotationsDict()
-        pipeline = AnnotationsPipeline(peaks, self.args, queue=Queue())
+        pipeline = AnnotationsPipeline(peaks, self.args)
         for peak in peaks:
             if peak.name in expected_annotations:
-                pipeline.annotate_utr_for_peak(self.db, peak, self.truncation_points, self.coverage_gaps)
+                result = pipeline.annotate_utr_for_peak(db, peak, self.truncation_points, self.coverage_gaps)
                 if expected_annotations[peak.name] is None:
-                    self.assertIsNone(pipeline.queue.get())
+                    self.assertListEqual(result, [])
                 elif expected_annotations[peak.name] is NoNearbyFeatures:
-                    self.assertIsInstance(pipeline.queue.get(), NoNearbyFeatures)
+                    self.assertIsInstance(result, NoNearbyFeatures)
                 else:
-                    result = None
-                    while not pipeline.queue.empty():
-                        result = pipeline.queue.get()
-                        if type(result) == dict:
-                            annotations.update(result)
+                    for record in result:
+                        annotations.update(pipeline.expand_record(record, db))
                     for gene in expected_annotations[peak.name].keys():
                         self.assertIn(gene, annotations)
                         self.assertEqual(annotations.data[gene]['utr'].range, expected_annotations[peak.name][gene].range)
@@ -77,6 +84,138 @@ class TestUTRAnnotation(unittest.TestCase):
         peaks_filename = os.path.join(TEST_DIR, "test_reverse_peaks.broadPeak")
         self.strand_annotations(peaks_filename, 'reverse', expected_annotations)
 
+    def test_sweep_engine_matches_peak_engine(self):
+        index = FeatureIndex(db=self.db)
+        for strand in ["forward", "reverse"]:
+            peaks = BroadPeaksList(broadpeak_fn=os.path.join(TEST_DIR, "test_%s_peaks.broadPeak" % strand), strand=strand)
+            pipeline = AnnotationsPipeline(peaks, self.args)
+            expected = [self._comparable(pipeline.annotate_utr_for_peak(index, peak, self.truncation_points,
+                                                                        self.coverage_gaps))
+                        for peak in peaks]
+            results = [self._comparable(result) for result in pipeline.sweep_peaks(
+                index, peaks, {STRAND_MAP[strand]: self.truncation_points}, {STRAND_MAP[strand]: self.coverage_gaps})]
+            self.assertListEqual(results, expected)
+
+    def test_zero_coverage_truncation(self):
+        chr = "Pb1219_15UTR_PbANKA_01_v3"
+        coverage_gaps = ZeroCoverageIntervalsDict({chr: [ZeroCoverageIntervalsDict.Interval(16000, 18000),
+                                                         ZeroCoverageIntervalsDict.Interval(700, 1000)]})
+        index = FeatureIndex(db=self.db)
+        for strand, name, expected in [("forward", "forward_peak_6", (14118, 16000)),
+                                       ("reverse", "reverse_peak_1", (1000, 1098))]:
+            peaks = BroadPeaksList(broadpeak_fn=os.path.join(TEST_DIR, "test_%s_peaks.broadPeak" % strand), strand=strand)
+            pipeline = AnnotationsPipeline(peaks, self.args)
+            expected_results = [self._comparable(pipeline.annotate_utr_for_peak(index, peak, self.truncation_points,
+                                                                                coverage_gaps))
+                                for peak in peaks]
+            results = [self._comparable(result) for result in pipeline.sweep_peaks(
+                index, peaks, {STRAND_MAP[strand]: self.truncation_points}, {STRAND_MAP[strand]: coverage_gaps})]
+            self.assertListEqual(results, expected_results)
+            record, = pipeline.annotate_utr_for_peak(index, next(p for p in peaks if p.name == name),
+                                                     self.truncation_points, coverage_gaps)
+            self.assertTupleEqual((record.start, record.end), expected)
+            self.assertEqual(record.colour, AnnotationColour.TruncatedZeroCoverage)
+
+    @staticmethod
+    def _comparable(result):
+        return type(result) if isinstance(result, NoNearbyFeatures) else result
+
+
+class TestAnnotationsPipeline(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        for strand in STRAND_MAP:
+            open(os.path.join(self.tmp_dir.name, "%s_coverage_gaps.bed" % strand), "w").close()
+            save_pileups(os.path.join(self.tmp_dir.name, "%s_unmapped.npz" % strand), {})
+        patcher = mock.patch("peaks2utr.constants.BAM_CACHE_DIR", self.tmp_dir.name)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.index = FeatureIndex(gff_fn=os.path.join(TEST_DIR, "Chr1.gtf"))
+        self.peaks = sum((BroadPeaksList(broadpeak_fn=os.path.join(TEST_DIR, "test_%s_peaks.broadPeak" % strand),
+                                         strand=strand) for strand in STRAND_MAP), BroadPeaksList())
+        self.args = prepare_argparser().parse_args(["", "reads.bam", "--max-distance", "2500"])
+        self.args.gtf_in = True
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_schedule(self):
+        self.args.processors = 3
+        pipeline = AnnotationsPipeline(self.peaks, self.args, db=self.index)
+        pipeline.partitions = pipeline._partition_peaks()
+        chunks = list(pipeline._schedule())
+        covered = {key: [] for key in pipeline.partitions}
+        for key, lo, hi in chunks:
+            covered[key].extend(range(lo, hi))
+        for key, peaks in pipeline.partitions.items():
+            self.assertListEqual(sorted(covered[key]), list(range(len(peaks))))
+        costs = {key: pipeline._peak_cost(key, peaks) for key, peaks in pipeline.partitions.items()}
+        weights = [costs[key] * (hi - lo) for key, lo, hi in chunks]
+        target_weight = sum(weights) / (self.args.processors * CHUNKS_PER_PROCESSOR)
+        self.assertListEqual(weights, sorted(weights, reverse=True))
+        self.assertGreaterEqual(len(chunks), self.args.processors * CHUNKS_PER_PROCESSOR)
+        for (key, _, _), weight in zip(chunks, weights):
+            self.assertLessEqual(weight, max(target_weight, costs[key]))
+
+    def create_db(self):
+        db_path = os.path.join(self.tmp_dir.name, "Chr1.db")
+        gffutils.create_db(os.path.join(TEST_DIR, "Chr1.gtf"), db_path, force=True)
+        return db_path
+
+    def test_peak_cost_from_db(self):
+        costs = []
+        for kwargs in [{"db": self.index}, {"db_path": self.create_db()}]:
+            pipeline = AnnotationsPipeline(self.peaks, self.args, **kwargs)
+            pipeline.partitions = pipeline._partition_peaks()
+            list(pipeline._schedule())
+            costs.append({key: pipeline._peak_cost(key, peaks) for key, peaks in pipeline.partitions.items()})
+        self.assertTrue(all(cost > 1 for cost in costs[0].values()))
+        self.assertListEqual(sorted(costs[1]), sorted(costs[0]))
+        for key, cost in costs[0].items():
+            self.assertAlmostEqual(costs[1][key], cost)
+
+    def test_index_in_memory(self):
+        db_path = self.create_db()
+        self.args.processors = 2
+        results = []
+        for index_in_memory in [False, True]:
+            self.args.index_in_memory = index_in_memory
+            with AnnotationsPipeline(self.peaks, self.args, db_path=db_path) as pipeline:
+                results.append(sorted(pipeline.results()))
+            self.assertEqual(isinstance(pipeline.db, FeatureIndex), index_in_memory)
+        self.assertTrue(results[0])
+        self.assertListEqual(*results)
+
+    def test_missing_spat_pileups(self):
+        os.remove(os.path.join(self.tmp_dir.name, "reverse_unmapped.npz"))
+        with self.assertRaisesRegex(AnnotationsError, "reverse_unmapped.npz"):
+            AnnotationsPipeline(self.peaks, self.args, db=self.index)._load_strand_lookups()
+        self.args.skip_soft_clip = True
+        truncation_points, _ = AnnotationsPipeline(self.peaks, self.args, db=self.index)._load_strand_lookups()
+        self.assertFalse(any(truncation_points.values()))
+
+    def test_exit_terminates_workers(self):
+        self.args.processors = 2
+        with self.assertRaises(RuntimeError):
+            with AnnotationsPipeline(self.peaks, self.args, db=self.index) as pipeline:
+                raise RuntimeError
+        self.assertTrue(all(p.exitcode is not None for p in pipeline.processes))
+
+    def test_merge_tally(self):
+        tallies = []
+        for processors in [1, 3]:
+            self.args.processors = processors
+            with mock.patch.object(Counter, "seen", set()):
+                with AnnotationsPipeline(self.peaks, self.args, db=self.index) as pipeline:
+                    before = pipeline._tally()
+                    records = list(pipeline.results())
+            self.assertEqual(len(pipeline.processes), processors)
+            tally = {name: value - before[name] for name, value in pipeline._tally().items()}
+            self.assertEqual(tally["new_utr"], len(records))
+            tallies.append(tally)
+        self.assertTrue(tallies[0]["new_utr"] and tallies[0]["assert_not_a_subset"])
+        self.assertDictEqual(*tallies)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,141 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from peaks2utr import prepare_argparser
+from peaks2utr.cache import bam_cache_dir, close_cache_dir, fingerprint, fingerprint_digest, open_cache_dir, \
+    pipeline_manifest
+from peaks2utr.constants import CACHE_MANIFEST_FN
+from peaks2utr.utils import CacheLock
+
+
+class TestCacheManifest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.tmp_dir, ".cache")
+        os.mkdir(self.cache_dir)
+        self.bam_fn = os.path.join(self.tmp_dir, "sample.bam")
+        self.gff_fn = os.path.join(self.tmp_dir, "genome.gff")
+        self.write(self.bam_fn, "reads")
+        self.write(self.gff_fn, "genes")
+        self.outputs = {"strands": "sample.forward.bam", "spat_pileups": "forward_unmapped.npz",
+                        "coverage_gaps": "reverse_coverage_gaps.bed", "peaks": "forward_peaks.broadPeak"}
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    @staticmethod
+    def write(fn, content):
+        with open(fn, "w") as f:
+            f.write(content)
+
+    def run_pipeline(self, *argv):
+        """
+        Return stage directories of a run with argv and the stages whose outputs were cached already, then write them.
+        """
+        args = prepare_argparser().parse_args([self.gff_fn, self.bam_fn, *argv])
+        stage_dirs = pipeline_manifest(args, cache_dir=self.cache_dir).open_stage_dirs()
+        cached = [stage for stage, fn in self.outputs.items() if os.path.isfile(os.path.join(stage_dirs[stage], fn))]
+        for stage, fn in self.outputs.items():
+            self.write(os.path.join(stage_dirs[stage], fn), "")
+        return stage_dirs, cached
+
+    def test_reuse_unchanged(self):
+        stage_dirs, cached = self.run_pipeline()
+        self.assertListEqual(cached, [])
+        self.assertTupleEqual(self.run_pipeline(), (stage_dirs, list(self.outputs)))
+        for stage, stage_dir in stage_dirs.items():
+            self.assertEqual(os.path.dirname(stage_dir), self.cache_dir)
+            with open(os.path.join(stage_dir, CACHE_MANIFEST_FN)) as f:
+                self.assertEqual(json.load(f)["stage"], stage)
+
+    def test_changed_parameter(self):
+        stage_dirs, _ = self.run_pipeline()
+        new_stage_dirs, cached = self.run_pipeline("--min-pileups", "3")
+        self.assertListEqual(cached, ["strands", "coverage_gaps", "peaks"])
+        self.assertNotEqual(new_stage_dirs["spat_pileups"], stage_dirs["spat_pileups"])
+        # Outputs of both parameter sets are kept side by side.
+        self.assertListEqual(self.run_pipeline()[1], list(self.outputs))
+        self.assertListEqual(self.run_pipeline("--min-pileups", "3")[1], list(self.outputs))
+
+    def test_concurrent_runs_with_other_parameters(self):
+        stage_dirs, _ = self.run_pipeline()
+        peaks_fn = os.path.join(stage_dirs["peaks"], self.outputs["peaks"])
+        with CacheLock("forward_peaks", stage_dirs["peaks"]):
+            other_stage_dirs, _ = self.run_pipeline("--macs3-qvalue", "0.01")
+            self.assertTrue(os.path.isfile(peaks_fn))
+            self.assertFalse(CacheLock("forward_peaks", stage_dirs["peaks"]).acquire(blocking=False))
+            other_lock = CacheLock("forward_peaks", other_stage_dirs["peaks"])
+            self.assertTrue(other_lock.acquire(blocking=False))
+            other_lock.release()
+
+    def test_downstream_of_changed_input(self):
+        self.run_pipeline()
+        self.write(self.bam_fn, "other reads")
+        self.assertListEqual(self.run_pipeline()[1], [])
+
+    def test_fingerprint(self):
+        self.assertEqual(fingerprint(self.bam_fn), fingerprint(self.bam_fn))
+        self.assertNotEqual(fingerprint(self.bam_fn), fingerprint(self.gff_fn))
+        self.write(self.bam_fn, "a" * 100 + "b")
+        self.write(self.gff_fn, "a" * 100 + "c")
+        self.assertNotEqual(fingerprint(self.bam_fn, chunk_size=10), fingerprint(self.gff_fn, chunk_size=10))
+        self.assertNotEqual(fingerprint_digest(self.bam_fn), fingerprint_digest(self.gff_fn))
+
+
+class TestCacheDir(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.tmp_dir, ".cache")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_clear_owned(self):
+        run_lock = open_cache_dir(self.cache_dir, owned=True)
+        with open(os.path.join(self.cache_dir, "forward_peaks.broadPeak"), "w"):
+            pass
+        self.assertTrue(close_cache_dir(run_lock, clear=True))
+        self.assertFalse(os.path.exists(self.cache_dir))
+
+    def test_keep_user_supplied(self):
+        os.mkdir(self.cache_dir)
+        user_fn = os.path.join(self.cache_dir, "notes.txt")
+        with open(user_fn, "w"):
+            pass
+        for owned in [False, True]:
+            self.assertFalse(close_cache_dir(open_cache_dir(self.cache_dir, owned=owned), clear=True))
+            self.assertTrue(os.path.isfile(user_fn))
+
+    def test_keep_in_use(self):
+        run_lock = open_cache_dir(self.cache_dir, owned=True)
+        other_run_lock = open_cache_dir(self.cache_dir, owned=True)
+        self.assertFalse(close_cache_dir(run_lock, clear=True))
+        self.assertTrue(os.path.isdir(self.cache_dir))
+        self.assertTrue(close_cache_dir(other_run_lock, clear=True))
+
+    def test_reopen_cleared(self):
+        run_lock = open_cache_dir(self.cache_dir, owned=True)
+        waiting_lock = CacheLock("run", self.cache_dir)
+        self.assertTrue(close_cache_dir(run_lock, clear=True))
+        self.assertTrue(waiting_lock.acquire(shared=True))
+        self.assertTrue(os.path.isfile(waiting_lock.lock_fn))
+        waiting_lock.release()
+
+    def test_bam_cache_dir(self):
+        bam_fns = [os.path.join(self.tmp_dir, name, "sample.bam") for name in ["a", "b"]]
+        for bam_fn, content in zip(bam_fns, ["reads", "other reads"]):
+            os.mkdir(os.path.dirname(bam_fn))
+            with open(bam_fn, "w") as f:
+                f.write(content)
+        dirs = [bam_cache_dir(bam_fn, self.cache_dir) for bam_fn in bam_fns]
+        self.assertNotEqual(*dirs)
+        self.assertTrue(all(os.path.dirname(d) == self.cache_dir for d in dirs))
+
+
+if __name__ == '__main__':
+    unittest.main()
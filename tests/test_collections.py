@@ -0,0 +1,260 @@
+import csv
+import json
+import os
+import random
+import tempfile
+import unittest
+
+import gffutils
+import numpy as np
+import pysam
+
+from peaks2utr import gffdb
+from peaks2utr.arrays import aligned_blocks, zero_coverage_intervals
+from peaks2utr.collections import BroadPeaksList, FeatureIndex, LazyZeroCoverageIntervals, SPATTruncationPointsDict, \
+    ZeroCoverageIntervalsDict
+from peaks2utr.models import FeatureDB, IndexedFeature, Peak
+
+TEST_DIR = os.path.dirname(__file__)
+
+
+class TestSPATTruncationPointsDict(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.json_fn = tempfile.mkstemp(suffix=".json")
+        with os.fdopen(fd, "w") as f:
+            json.dump({"chr1": {"500": 12, "20": 10, "150": 11, "1000": 30}, "chr2": {"7": 10}}, f)
+        self.truncation_points = SPATTruncationPointsDict(json_fn=self.json_fn)
+
+    def tearDown(self):
+        os.remove(self.json_fn)
+
+    def test_sorted_arrays(self):
+        self.assertListEqual(self.truncation_points["chr1"].tolist(), [20, 150, 500, 1000])
+        self.assertIn("chr2", self.truncation_points)
+
+    def test_within(self):
+        self.assertListEqual(self.truncation_points.within("chr1", 150, 1000).tolist(), [150, 500])
+        self.assertListEqual(self.truncation_points.within("chr1", 501, 999).tolist(), [])
+        self.assertListEqual(self.truncation_points.within("chr3", 0, 1000).tolist(), [])
+
+    def test_outermost(self):
+        self.assertEqual(self.truncation_points.outermost("chr1", 0, 600, "+"), 500)
+        self.assertEqual(self.truncation_points.outermost("chr1", 0, 600, "-"), 20)
+        self.assertIsNone(self.truncation_points.outermost("chr1", 21, 150, "+"))
+
+    def test_empty_json(self):
+        with open(self.json_fn, "w") as f:
+            json.dump(None, f)
+        self.assertFalse(SPATTruncationPointsDict(json_fn=self.json_fn))
+
+    def test_load_npy(self):
+        npy_fn, index_fn = SPATTruncationPointsDict._npy_fns(self.json_fn)
+        try:
+            parsed = SPATTruncationPointsDict.load(self.json_fn)
+            loaded = SPATTruncationPointsDict.load(self.json_fn)
+            self.assertIsInstance(np.load(npy_fn, mmap_mode="r"), np.memmap)
+            self.assertListEqual(sorted(loaded), sorted(parsed))
+            for chr in parsed:
+                self.assertListEqual(loaded[chr].tolist(), parsed[chr].tolist())
+            self.assertEqual(loaded.outermost("chr1", 0, 600, "+"), 500)
+        finally:
+            os.remove(npy_fn)
+            os.remove(index_fn)
+
+    def test_load_npy_of_changed_source(self):
+        npy_fn, index_fn = SPATTruncationPointsDict._npy_fns(self.json_fn)
+        try:
+            SPATTruncationPointsDict.load(self.json_fn)
+            with open(self.json_fn, "w") as f:
+                json.dump({"chr3": {"40": 10}}, f)
+            loaded = SPATTruncationPointsDict.load(self.json_fn)
+            self.assertListEqual(list(loaded), ["chr3"])
+            self.assertListEqual(loaded["chr3"].tolist(), [40])
+            self.assertListEqual(SPATTruncationPointsDict.load(self.json_fn)["chr3"].tolist(), [40])
+        finally:
+            os.remove(npy_fn)
+            os.remove(index_fn)
+
+
+class TestZeroCoverageIntervalsDict(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.bed_fn = tempfile.mkstemp(suffix=".bed")
+        with os.fdopen(fd, "w") as f:
+            f.write("chr1\t300\t400\nchr1\t0\t100\nchr1\t150\t200\nchr2\t10\t20\n")
+        self.coverage_gaps = ZeroCoverageIntervalsDict(bed_fn=self.bed_fn)
+
+    def tearDown(self):
+        os.remove(self.bed_fn)
+
+    def test_filter(self):
+        for chr, base in [("chr1", 50), ("chr1", 151), ("chr1", 399), ("chr2", 15)]:
+            gaps = self.coverage_gaps.filter(chr, base)
+            self.assertEqual(len(gaps), 1)
+            self.assertTrue(gaps[0].start < base < gaps[0].end)
+        for chr, base in [("chr1", 0), ("chr1", 100), ("chr1", 150), ("chr1", 250), ("chr1", 500), ("chr3", 50)]:
+            self.assertListEqual(self.coverage_gaps.filter(chr, base), [])
+
+    def test_filter_many(self):
+        starts, ends = self.coverage_gaps.filter_many("chr1", [50, 100, 175, 250, 350])
+        self.assertListEqual(starts.tolist(), [0, -1, 150, -1, 300])
+        self.assertListEqual(ends.tolist(), [100, -1, 200, -1, 400])
+
+    def test_from_intervals(self):
+        coverage_gaps = ZeroCoverageIntervalsDict({"chr1": [ZeroCoverageIntervalsDict.Interval(150, 200),
+                                                            ZeroCoverageIntervalsDict.Interval(0, 100)]})
+        self.assertEqual(coverage_gaps.filter("chr1", 160)[0].start, 150)
+
+    def test_load_npy(self):
+        npy_fn, index_fn = ZeroCoverageIntervalsDict._npy_fns(self.bed_fn)
+        try:
+            ZeroCoverageIntervalsDict.load(self.bed_fn)
+            loaded = ZeroCoverageIntervalsDict.load(self.bed_fn)
+            self.assertIsInstance(np.load(npy_fn, mmap_mode="r"), np.memmap)
+            for chr in self.coverage_gaps:
+                for expected, actual in zip(self.coverage_gaps[chr], loaded[chr]):
+                    self.assertListEqual(actual.tolist(), expected.tolist())
+            starts, ends = loaded.filter_many("chr1", [50, 100, 175, 250, 350])
+            self.assertListEqual(starts.tolist(), [0, -1, 150, -1, 300])
+        finally:
+            os.remove(npy_fn)
+            os.remove(index_fn)
+
+
+class TestLazyZeroCoverageIntervals(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.bam_fn = tempfile.mkstemp(suffix=".bam")
+        os.close(fd)
+        header = pysam.AlignmentHeader.from_dict({"SQ": [{"SN": "chr1", "LN": 1000}, {"SN": "chr2", "LN": 300}]})
+        rng = random.Random(0)
+        reads = []
+        for i in range(30):
+            read = pysam.AlignedSegment(header)
+            read.query_name = "read_%d" % i
+            read.reference_id = 0
+            read.reference_start = rng.randrange(950)
+            read.cigartuples = [(pysam.CMATCH, 10), (pysam.CREF_SKIP, rng.randrange(1, 80)), (pysam.CMATCH, 10)]
+            read.query_sequence = "A" * 20
+            reads.append(read)
+        with pysam.AlignmentFile(self.bam_fn, "wb", header=header) as f:
+            for read in sorted(reads, key=lambda r: r.reference_start):
+                f.write(read)
+        pysam.index(self.bam_fn)
+
+    def tearDown(self):
+        os.remove(self.bam_fn)
+        os.remove(self.bam_fn + ".bai")
+
+    def test_matches_genome_wide_gaps(self):
+        coverage_gaps = ZeroCoverageIntervalsDict()
+        with pysam.AlignmentFile(self.bam_fn, "rb") as samfile:
+            for chr, length in zip(samfile.references, samfile.lengths):
+                starts, ends = zero_coverage_intervals(*aligned_blocks(samfile, chr), length)
+                coverage_gaps[chr] = map(ZeroCoverageIntervalsDict.Interval, starts.tolist(), ends.tolist())
+        lazy_coverage_gaps = LazyZeroCoverageIntervals(self.bam_fn, window_size=37, cache_size=4)
+        for chr, length in [("chr1", 1000), ("chr2", 300), ("chr3", 10)]:
+            for base in range(-1, length + 1):
+                self.assertListEqual(lazy_coverage_gaps.filter(chr, base), coverage_gaps.filter(chr, base))
+
+
+class TestFeatureIndex(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.db_fn = tempfile.mkstemp(suffix=".db")
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.db_fn)
+
+    def assertMatchesDB(self, gff_fn):
+        gffutils.create_db(gff_fn, self.db_fn, force=True)
+        expected = FeatureIndex(db=FeatureDB(self.db_fn))
+        index = FeatureIndex(gff_fn=gff_fn)
+        self.assertListEqual(list(index.keys()), list(expected.keys()))
+        for id, f in expected.items():
+            self.assertEqual(str(index[id]), str(f))
+            self.assertListEqual(sorted(c.id for c in index.children(id)), sorted(c.id for c in expected.children(id)))
+        self.assertListEqual([g.id for g in index.all_features(featuretype="gene")],
+                             [g.id for g in expected.all_features(featuretype="gene")])
+        self.assertTrue(all(isinstance(f, IndexedFeature) and not hasattr(f, "__dict__") for f in index.values()))
+
+    def test_gtf(self):
+        self.assertMatchesDB(os.path.join(TEST_DIR, "Chr1.gtf"))
+
+    def test_gff(self):
+        self.assertMatchesDB(os.path.join(TEST_DIR, os.pardir, "peaks2utr", "demo", "Tb927_01_v5.1.gff"))
+
+    def test_duplicate_id(self):
+        gff_fn = self.db_fn + ".gff"
+        self.addCleanup(os.remove, gff_fn)
+        with open(gff_fn, "w") as f:
+            f.write("chr1\t.\tgene\t1\t900\t.\t+\t.\tID=g1\n"
+                    "chr1\t.\tmRNA\t1\t900\t.\t+\t.\tID=t1;Parent=g1\n"
+                    "chr1\t.\tCDS\t1\t300\t.\t+\t0\tID=cds1;Parent=t1\n"
+                    "chr1\t.\tCDS\t600\t900\t.\t+\t0\tID=cds1;Parent=t1\n")
+        for create_db in (gffutils.create_db, gffdb.create_db):
+            with self.assertRaisesRegex(ValueError, "Duplicate ID cds1"):
+                create_db(gff_fn, self.db_fn, force=True)
+        with self.assertRaisesRegex(ValueError, "Duplicate ID cds1"):
+            FeatureIndex(gff_fn=gff_fn)
+
+    def test_attributes(self):
+        feature = next(iter(FeatureIndex(gff_fn=os.path.join(TEST_DIR, "Chr1.gtf")).values()))
+        attributes = feature.attributes
+        attributes["colour"] = ["3"]
+        self.assertNotIn("colour", feature.attributes)
+        feature.attributes = attributes
+        self.assertListEqual(feature.attributes["colour"], ["3"])
+        self.assertIn("colour", str(feature))
+
+
+class TestBroadPeaksList(unittest.TestCase):
+
+    def setUp(self):
+        self.peaks = {strand: BroadPeaksList(broadpeak_fn=os.path.join(TEST_DIR, "test_%s_peaks.broadPeak" % strand),
+                                             strand=strand) for strand in ["forward", "reverse"]}
+
+    @staticmethod
+    def fields(peak):
+        return [getattr(peak, field) for field in BroadPeaksList._fields]
+
+    def test_matches_peaks(self):
+        for strand, peaks in self.peaks.items():
+            with open(os.path.join(TEST_DIR, "test_%s_peaks.broadPeak" % strand)) as f:
+                expected = [Peak(*row) for row in csv.reader(f, delimiter="\t")]
+            for peak in expected:
+                peak.strand = "+" if strand == "forward" else "-"
+            self.assertEqual(len(peaks), len(expected))
+            self.assertListEqual([self.fields(p) for p in peaks], [self.fields(p) for p in expected])
+            self.assertListEqual(self.fields(peaks[3]), self.fields(expected[3]))
+            self.assertListEqual([self.fields(p) for p in BroadPeaksList(expected)], [self.fields(p) for p in expected])
+
+    def test_without_strand(self):
+        peaks = BroadPeaksList(broadpeak_fn=os.path.join(TEST_DIR, "test_forward_peaks.broadPeak"))
+        self.assertTrue(all(peak.strand is None for peak in peaks))
+        self.assertTrue(all(strand is None for _, strand in peaks.partition()))
+        self.assertTrue(all(peak.strand is None for peak in BroadPeaksList(list(peaks))))
+        self.assertFalse(hasattr(peaks[0], "__dict__"))
+
+    def test_slice_shares_memory(self):
+        peaks = self.peaks["forward"]
+        batch = peaks[2:5]
+        self.assertTrue(np.shares_memory(batch.data, peaks.data))
+        self.assertListEqual([p.name for p in batch], [p.name for p in list(peaks)[2:5]])
+
+    def test_concatenate_and_partition(self):
+        peaks = self.peaks["forward"] + self.peaks["reverse"]
+        expected = list(self.peaks["forward"]) + list(self.peaks["reverse"])
+        self.assertListEqual([self.fields(p) for p in peaks], [self.fields(p) for p in expected])
+        partitions = peaks.partition()
+        for (chr, strand), partition in partitions.items():
+            self.assertListEqual([p.name for p in partition],
+                                 [p.name for p in sorted(expected, key=lambda x: x.start)
+                                  if p.chr == chr and p.strand == strand])
+        self.assertEqual(sum(len(partition) for partition in partitions.values()), len(expected))
+
+
+if __name__ == '__main__':
+    unittest.main()
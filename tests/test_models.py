@@ -0,0 +1,33 @@
+import unittest
+
+from peaks2utr.models import Interval, UTR
+
+
+class TestInterval(unittest.TestCase):
+
+    def test_matches_set_semantics(self):
+        pairs = [(0, 10), (5, 15), (10, 20), (12, 14), (3, 3), (8, 2)]
+        for a in pairs:
+            for b in pairs:
+                ia, ib = Interval(*a), Interval(*b)
+                sa, sb = set(range(*a)), set(range(*b))
+                self.assertEqual(ia.issubset(ib), sa.issubset(sb))
+                self.assertEqual(set(ia.intersection(ib)), sa.intersection(sb))
+                self.assertEqual(ia.overlaps(ib), bool(sa.intersection(sb)))
+                self.assertEqual(ia == ib, sa == sb)
+                self.assertEqual(ia == sb, sa == sb)
+
+    def test_intersection_with_iterable(self):
+        self.assertEqual(Interval(10, 20).intersection([5, 10, 15, 20]), {10, 15})
+
+    def test_range_compatibility(self):
+        utr = UTR(100, 200)
+        self.assertEqual(utr.range, set(range(100, 200)))
+        self.assertEqual(len(utr.range), utr.length)
+        self.assertIn(150, utr.range)
+        self.assertNotIn(200, utr.range)
+        self.assertEqual(utr, UTR(100, 200))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,10 +1,18 @@
+import os
+import tempfile
 import unittest
 from unittest.mock import MagicMock
 
+import gffutils
+
 from peaks2utr import prepare_argparser
-from peaks2utr.collections import AnnotationsDict
-from peaks2utr.constants import FeatureTypes, GFFUTILS_GTF_DIALECT
-from peaks2utr.models import Feature, UTR
+from peaks2utr.annotations import AnnotationsPipeline
+from peaks2utr.collections import AnnotationsDict, FeatureIndex
+from peaks2utr.constants import AnnotationColour, FeatureTypes, GFFUTILS_GTF_DIALECT
+from peaks2utr.models import Feature, UTR, UTRRecord
+from peaks2utr.postprocess import merge_annotations, write_sorted_annotations
+
+TEST_DIR = os.path.dirname(__file__)
 
 
 class TestOutputFormatting(unittest.TestCase):
@@ -98,5 +106,58 @@ class TestOutputFormatting(unittest.TestCase):
         self.assertListEqual(utr.strip().split("\t"), expected_utr)
 
 
+class TestSortedOutput(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.gtf_fn = os.path.join(TEST_DIR, "Chr1.gtf")
+        self.db_fn = os.path.join(self.tmp_dir.name, "Chr1.db")
+        gffutils.create_db(self.gtf_fn, self.db_fn, force=True)
+        argparser = prepare_argparser()
+        self.args = argparser.parse_args(["", ""])
+        self.args.gtf_in = True
+        self.records = [UTRRecord("PBANKA_0100041.1", "PBANKA_0100041.1.1", 14118, 17222, AnnotationColour.Extended),
+                        UTRRecord("PBANKA_0100021.1", "PBANKA_0100021.1.1", 801, 1098, AnnotationColour.Extended)]
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def annotations(self):
+        annotations = AnnotationsDict(args=self.args)
+        pipeline = AnnotationsPipeline([], self.args)
+        index = FeatureIndex(gff_fn=self.gtf_fn)
+        for record in self.records:
+            annotations.update(pipeline.expand_record(record, index))
+        return annotations
+
+    def test_matches_merged_annotations(self):
+        for gtf_out in [False, True]:
+            self.args.gtf_out = gtf_out
+            expected = self.annotations()
+            merge_annotations(self.db_fn, expected)
+            expected_lines = sorted(expected.iter_feature_strings())
+            expected_utrs = len([f for features in expected.values() for f in features.values()
+                                 if f.featuretype in FeatureTypes.ThreePrimeUTR])
+            for db in [self.db_fn, FeatureIndex(gff_fn=self.gtf_fn)]:
+                out_fn = os.path.join(self.tmp_dir.name, "out")
+                total_utrs = write_sorted_annotations(db, self.annotations(), out_fn)
+                with open(out_fn) as f:
+                    lines = [line for line in f if not line.startswith("#")]
+                self.assertEqual(total_utrs, expected_utrs)
+                self.assertListEqual(sorted(lines), expected_lines)
+                positions = [(line.split("\t")[0], int(line.split("\t")[3])) for line in lines
+                             if line.split("\t")[2] in FeatureTypes.Gene + FeatureTypes.GtfTranscript]
+                self.assertListEqual(positions, sorted(positions))
+
+    def test_deterministic_order(self):
+        outputs = []
+        for db in [self.db_fn, FeatureIndex(gff_fn=self.gtf_fn)]:
+            out_fn = os.path.join(self.tmp_dir.name, "out")
+            write_sorted_annotations(db, self.annotations(), out_fn)
+            with open(out_fn) as f:
+                outputs.append(f.readlines())
+        self.assertListEqual(*outputs)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,301 @@
+import asyncio
+import functools
+import multiprocessing
+import os
+import random
+import sqlite3
+import tempfile
+import unittest
+from unittest import mock
+
+import gffutils
+import numpy as np
+import pysam
+
+from peaks2utr import gffdb, prepare_argparser, preprocess
+from peaks2utr.models import SoftClippedRead
+from peaks2utr.arrays import load_pileups, merge_pileups, pileup_arrays, save_pileups, zero_coverage_intervals
+from peaks2utr.constants import STRAND_PYSAM_ARGS
+from peaks2utr.preprocess import BAMSplitter, count_poly_tail_extremities, is_strand, macs3_strand_tracks
+
+
+TEST_DIR = os.path.dirname(__file__)
+
+
+def random_reads(header, n, seed=0):
+    rng = random.Random(seed)
+    for i in range(n):
+        read = pysam.AlignedSegment(header)
+        read.query_name = "read_%d" % i
+        read.reference_id = rng.randrange(2)
+        read.reference_start = rng.randrange(1000)
+        read.is_reverse = rng.random() < 0.5
+        head_clip, match, tail_clip = rng.choice([0, 3, 12, 20]), rng.randrange(20, 60), rng.choice([0, 3, 12, 20])
+        cigar = [(pysam.CMATCH, match)]
+        if head_clip:
+            cigar.insert(0, (pysam.CSOFT_CLIP, head_clip))
+        if tail_clip:
+            cigar.append((pysam.CSOFT_CLIP, tail_clip))
+        if rng.random() < 0.1:
+            cigar.append((pysam.CHARD_CLIP, 5))
+        read.cigartuples = cigar
+        seq = [rng.choice("ACGT") for _ in range(head_clip + match + tail_clip)]
+        for start, length in [(0, head_clip), (head_clip + match, tail_clip)]:
+            if length and rng.random() < 0.7:
+                tail = rng.choice("AT") * rng.randrange(8, length + 1) if length >= 8 else ""
+                seq[start:start + len(tail)] = tail
+        read.query_sequence = "".join(seq)
+        yield read
+
+
+class TestSPATScanner(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.bam_fn = tempfile.mkstemp(suffix=".bam")
+        os.close(fd)
+        header = pysam.AlignmentHeader.from_dict(
+            {"SQ": [{"SN": "chr1", "LN": 2000}, {"SN": "chr2", "LN": 2000}]})
+        with pysam.AlignmentFile(self.bam_fn, "wb", header=header) as f:
+            for read in random_reads(header, 2000):
+                f.write(read)
+
+    def tearDown(self):
+        os.remove(self.bam_fn)
+
+    def test_matches_soft_clipped_read(self):
+        for min_poly_tail in [5, 10]:
+            expected = {}
+            with pysam.AlignmentFile(self.bam_fn, "rb") as samfile:
+                for seg in samfile.fetch(until_eof=True):
+                    read = SoftClippedRead(
+                        chr=seg.reference_name,
+                        start=seg.reference_start,
+                        end=seg.reference_end,
+                        cigar=seg.cigarstring,
+                        seq=seg.query_sequence,
+                        strand="reverse" if seg.is_reverse else "forward")
+                    if read.poly_tail_exists(min_poly_tail):
+                        expected.setdefault(read.chr, {}).setdefault(read.extremity, 0)
+                        expected[read.chr][read.extremity] += 1
+            with pysam.AlignmentFile(self.bam_fn, "rb") as samfile:
+                counts = count_poly_tail_extremities(samfile.fetch(until_eof=True), min_poly_tail)
+            self.assertTrue(expected)
+            self.assertDictEqual({chr: dict(v) for chr, v in counts.items()}, expected)
+
+
+class TestMergePileups(unittest.TestCase):
+
+    def setUp(self):
+        rng = random.Random(0)
+        self.unmapped = [{chr: {rng.randrange(1000): rng.randint(1, 5) for _ in range(200)}
+                          for chr in rng.sample(["chr1", "chr2", "chr3"], 2)} for _ in range(5)]
+
+    def test_matches_nested_dicts(self):
+        for min_pileups in [1, 8]:
+            expected = {}
+            for unmapped in self.unmapped:
+                for chr, extremities in unmapped.items():
+                    for extremity, count in extremities.items():
+                        expected.setdefault(chr, {}).setdefault(extremity, 0)
+                        expected[chr][extremity] += count
+            expected = {chr: {k: v for k, v in sorted(extremities.items()) if v >= min_pileups}
+                        for chr, extremities in expected.items()}
+            merged = merge_pileups([pileup_arrays(unmapped) for unmapped in self.unmapped], min_pileups)
+            self.assertDictEqual({chr: dict(zip(positions.tolist(), counts.tolist()))
+                                  for chr, (positions, counts) in merged.items()},
+                                 {chr: extremities for chr, extremities in expected.items() if extremities})
+
+    def test_save_and_load(self):
+        pileups = pileup_arrays(self.unmapped[0])
+        fd, npz_fn = tempfile.mkstemp(suffix=".npz")
+        os.close(fd)
+        try:
+            for expected in [pileups, {}]:
+                save_pileups(npz_fn, expected)
+                loaded = load_pileups(npz_fn)
+                self.assertListEqual(list(loaded), list(expected))
+                for chr, (positions, counts) in expected.items():
+                    self.assertListEqual(loaded[chr][0].tolist(), positions.tolist())
+                    self.assertListEqual(loaded[chr][1].tolist(), counts.tolist())
+        finally:
+            os.remove(npz_fn)
+
+
+class TestStrandFilter(unittest.TestCase):
+
+    def test_matches_samtools_flags(self):
+        for flag in range(4096):
+            self.assertEqual(is_strand(flag, "forward"), not flag & 20)
+            self.assertEqual(is_strand(flag, "reverse"), bool(flag & 16))
+
+
+class TestBAMSplitter(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.pool = multiprocessing.Pool(2)
+        self.bam_fn = os.path.join(self.tmp_dir.name, "reads.bam")
+        header = pysam.AlignmentHeader.from_dict(
+            {"SQ": [{"SN": "chr1", "LN": 2000}, {"SN": "chr2", "LN": 2000}], "RG": [{"ID": "a"}, {"ID": "b"}]})
+        rng = random.Random(0)
+        with pysam.AlignmentFile(self.bam_fn + ".unsorted", "wb", header=header) as f:
+            for read in random_reads(header, 2000):
+                read.flag |= rng.choice([0, 0, 0, 4, 1 | 2 | 64, 256, 2048])
+                read.set_tag("RG", rng.choice("ab"))
+                f.write(read)
+        pysam.sort("-o", self.bam_fn, self.bam_fn + ".unsorted")
+        pysam.index(self.bam_fn)
+
+    def tearDown(self):
+        self.pool.terminate()
+        self.pool.join()
+        self.tmp_dir.cleanup()
+
+    def bam_splitter(self, cache_dir, *argv):
+        os.mkdir(cache_dir)
+        args = prepare_argparser().parse_args(["genes.gff", self.bam_fn, *argv])
+        return BAMSplitter("reads", args, self.pool)
+
+    def test_single_pass_split_matches_samtools(self):
+        cache_dir = os.path.join(self.tmp_dir.name, "cache")
+        with mock.patch("peaks2utr.constants.BAM_CACHE_DIR", cache_dir):
+            self.bam_splitter(cache_dir, "--single-pass-split").split_strands()
+        for strand, strand_args in STRAND_PYSAM_ARGS.items():
+            expected_fn = os.path.join(self.tmp_dir.name, "%s.bam" % strand)
+            pysam.view("-b", *strand_args, "-o", expected_fn, self.bam_fn, catch_stdout=False)
+            reads = []
+            for fn in [os.path.join(cache_dir, "reads.%s.bam" % strand), expected_fn]:
+                with pysam.AlignmentFile(fn, "rb") as samfile:
+                    reads.append([seg.to_string() for seg in samfile.fetch(until_eof=True)])
+            self.assertTrue(reads[1])
+            self.assertListEqual(reads[0], reads[1])
+
+    def test_pileups_by_region_match_read_groups(self):
+        pileups = []
+        for name in ["read_groups", "by_region"]:
+            cache_dir = os.path.join(self.tmp_dir.name, name)
+            with mock.patch("peaks2utr.constants.BAM_CACHE_DIR", cache_dir), \
+                 mock.patch("peaks2utr.preprocess.iter_tiles", functools.partial(preprocess.iter_tiles, tile_size=100)):
+                bam_splitter = self.bam_splitter(cache_dir, "--min-pileups", "1", "--min-poly-tail", "5")
+                bam_splitter.split_strands()
+                if name == "read_groups":
+                    bam_splitter.split_read_groups()
+                    self.assertEqual(len(bam_splitter.read_group_bams), 4)
+                    bam_splitter.pileup_soft_clipped_reads()
+                else:
+                    # Reads are up to 100 bases long, so many of them straddle the edges of 100-base tiles.
+                    bam_splitter.pileup_soft_clipped_reads_by_region()
+            pileups.append({strand: {chr: (positions.tolist(), counts.tolist()) for chr, (positions, counts)
+                                     in load_pileups(os.path.join(cache_dir, "%s_unmapped.npz" % strand)).items()}
+                            for strand in STRAND_PYSAM_ARGS})
+        self.assertTrue(all(pileups[0].values()))
+        self.assertDictEqual(*pileups)
+
+    def test_native_gaps_on_the_fly(self):
+        gaps = []
+        for name, argv in [("split", []), ("on_the_fly", ["--filter-strands-on-the-fly"])]:
+            cache_dir = os.path.join(self.tmp_dir.name, name)
+            with mock.patch("peaks2utr.constants.BAM_CACHE_DIR", cache_dir):
+                bam_splitter = self.bam_splitter(cache_dir, "--gap-engine", "native", "--macs3-engine", "api", *argv)
+                bam_splitter.split_strands()
+                bam_splitter.prepare_coverage_gaps()
+            self.assertEqual(os.path.isfile(os.path.join(cache_dir, "reads.forward.bam")), name == "split")
+            gaps.append({})
+            for strand in STRAND_PYSAM_ARGS:
+                with open(os.path.join(cache_dir, "%s_coverage_gaps.bed" % strand)) as f:
+                    gaps[-1][strand] = f.readlines()
+        self.assertDictEqual(*gaps)
+
+
+class TestZeroCoverageIntervals(unittest.TestCase):
+
+    def test_matches_per_base_coverage(self):
+        rng = np.random.default_rng(0)
+        length = 500
+        for min_cov in [1, 2]:
+            block_starts = rng.integers(0, length, 60)
+            block_ends = block_starts + rng.integers(0, 40, 60)
+            coverage = np.zeros(length + 40, dtype=int)
+            for start, end in zip(block_starts, block_ends):
+                coverage[start:end] += 1
+            edges = np.diff(np.concatenate([[0], coverage[:length] < min_cov, [0]]).astype(int))
+            starts, ends = zero_coverage_intervals(block_starts, block_ends, length, min_cov)
+            self.assertListEqual(starts.tolist(), np.flatnonzero(edges == 1).tolist())
+            self.assertListEqual(ends.tolist(), np.flatnonzero(edges == -1).tolist())
+
+    def test_no_blocks(self):
+        starts, ends = zero_coverage_intervals(np.array([], dtype=int), np.array([], dtype=int), 100)
+        self.assertListEqual(list(zip(starts, ends)), [(0, 100)])
+
+
+class TestMACS3StrandTracks(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.bam_fn = os.path.join(self.tmp_dir.name, "reads.bam")
+        header = pysam.AlignmentHeader.from_dict(
+            {"SQ": [{"SN": "chr1", "LN": 2000}, {"SN": "chr2", "LN": 2000}]})
+        rng = random.Random(0)
+        with pysam.AlignmentFile(self.bam_fn, "wb", header=header) as f:
+            for read in random_reads(header, 2000):
+                read.flag |= rng.choice([0, 0, 0, 1 | 2 | 64, 1 | 2 | 128, 1 | 64, 256, 2048])
+                f.write(read)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_matches_macs3_bam_parser(self):
+        from MACS3.IO.Parser import BAMParser
+
+        tracks, tag_sizes = macs3_strand_tracks(self.bam_fn, 100000)
+        for strand, flags in [("forward", ["-F", "20"]), ("reverse", ["-f", "16"])]:
+            strand_fn = os.path.join(self.tmp_dir.name, strand + ".bam")
+            pysam.view("-b", *flags, "-o", strand_fn, self.bam_fn, catch_stdout=False)
+            parser = BAMParser(strand_fn, buffer_size=100000)
+            self.assertEqual(tag_sizes[strand], parser.tsize())
+            expected = parser.build_fwtrack()
+            expected.finalize()
+            self.assertEqual(tracks[strand].total, expected.total)
+            for chrom in expected.get_chr_names():
+                for positions, expected_positions in zip(tracks[strand].get_locations_by_chr(chrom),
+                                                         expected.get_locations_by_chr(chrom)):
+                    self.assertListEqual(list(positions), list(expected_positions))
+
+
+class TestFastCreateDB(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def assertSameDB(self, annotation):
+        dumps = []
+        for name, create_db in [("gffutils", gffutils.create_db), ("fast", gffdb.create_db)]:
+            db_fn = os.path.join(self.tmp_dir.name, name + ".db")
+            create_db(annotation, db_fn, force=True)
+            conn = sqlite3.connect(db_fn)
+            dumps.append([
+                conn.execute("SELECT * FROM features ORDER BY id").fetchall(),
+                sorted(conn.execute("SELECT * FROM relations").fetchall()),
+            ])
+            conn.close()
+        self.assertEqual(dumps[0], dumps[1])
+
+    def test_gtf(self):
+        self.assertSameDB(os.path.join(TEST_DIR, "Chr1.gtf"))
+
+    def test_gff(self):
+        self.assertSameDB(os.path.join(TEST_DIR, os.pardir, "peaks2utr", "demo", "Tb927_01_v5.1.gff"))
+
+    def test_cached_per_engine(self):
+        gtf_fn = os.path.join(TEST_DIR, "Chr1.gtf")
+        with mock.patch("peaks2utr.constants.CACHE_DIR", self.tmp_dir.name):
+            db_fns = [asyncio.run(preprocess.create_db(gtf_fn, engine)) for engine in ["gffutils", "fast", "gffutils"]]
+        self.assertNotEqual(db_fns[0], db_fns[1])
+        self.assertEqual(db_fns[0], db_fns[2])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,133 @@
+import asyncio
+import multiprocessing
+import os
+import threading
+import time
+import unittest
+
+from peaks2utr.scheduler import StageScheduler
+
+
+class TestStageScheduler(unittest.TestCase):
+
+    def setUp(self):
+        self.events = []
+        self.lock = threading.Lock()
+
+    def stage(self, name, duration=0.1, result=None):
+        def func():
+            with self.lock:
+                self.events.append(("start", name, time.monotonic()))
+            time.sleep(duration)
+            with self.lock:
+                self.events.append(("end", name, time.monotonic()))
+            return result
+        return func
+
+    def times(self, name):
+        return [t for _, n, t in self.events if n == name]
+
+    def test_dependencies_and_overlap(self):
+        scheduler = StageScheduler(2)
+        scheduler.add("split", self.stage("split"), cpus=2)
+        scheduler.add("db", self.stage("db", 0.3, "db"))
+        scheduler.add("peaks", self.stage("peaks", 0.1, "peaks"), deps=["split"])
+
+        async def gaps():
+            await asyncio.sleep(0.05)
+            return scheduler.results["peaks"]
+        scheduler.add("gaps", gaps, deps=["peaks"])
+        results = asyncio.run(scheduler.run())
+        self.assertEqual(results["db"], "db")
+        self.assertEqual(results["gaps"], "peaks")
+        self.assertGreaterEqual(self.times("peaks")[0], self.times("split")[1])
+        # split holds both slots, so db only starts once it is done, then runs alongside peaks.
+        self.assertGreaterEqual(self.times("db")[0], self.times("split")[1])
+        self.assertLess(self.times("db")[0], self.times("peaks")[1])
+        # db only waited on the budget, not on split, so split > peaks > gaps is the longest chain of dependent stages.
+        self.assertListEqual(scheduler.critical_path(), ["db"])
+
+    def test_budget(self):
+        scheduler = StageScheduler(2)
+        for name in "abcd":
+            scheduler.add(name, self.stage(name, 0.1))
+        asyncio.run(scheduler.run())
+        running, most_running = 0, 0
+        for event, _, _ in sorted(self.events, key=lambda x: (x[2], x[0] == "start")):
+            running += 1 if event == "start" else -1
+            most_running = max(most_running, running)
+        self.assertEqual(most_running, 2)
+
+    def test_critical_path(self):
+        scheduler = StageScheduler(4)
+        scheduler.add("split", self.stage("split", 0.05))
+        scheduler.add("db", self.stage("db", 0.1))
+        scheduler.add("spat", self.stage("spat", 0.2), deps=["split"])
+        scheduler.add("gaps", self.stage("gaps", 0.05), deps=["split", "db"])
+        asyncio.run(scheduler.run())
+        self.assertListEqual(scheduler.critical_path(), ["split", "spat"])
+
+    def test_critical_path_follows_dependencies(self):
+        scheduler = StageScheduler(1)
+        scheduler.add("db", self.stage("db", 0.2))
+        scheduler.add("split", self.stage("split", 0.05))
+        scheduler.add("peaks", self.stage("peaks", 0.05), deps=["split"])
+        asyncio.run(scheduler.run())
+        self.assertGreaterEqual(self.times("split")[0], self.times("db")[1])
+        self.assertListEqual(scheduler.critical_path(), ["db"])
+
+    def test_memory_budget(self):
+        scheduler = StageScheduler(4, mem=100)
+        scheduler.add("index", self.stage("index", 0.1), mem=60)
+        scheduler.add("peaks", self.stage("peaks", 0.1), mem=60)
+        scheduler.add("split", self.stage("split", 0.1), mem=30)
+        scheduler.add("gaps", self.stage("gaps", 0.1), mem=1000)
+        asyncio.run(scheduler.run())
+        self.assertGreaterEqual(self.times("peaks")[0], self.times("index")[1])
+        self.assertLess(self.times("split")[0], self.times("index")[1])
+        # A stage needing more than the budget holds all of it, so runs alone.
+        for name in ["index", "peaks", "split"]:
+            self.assertTrue(self.times("gaps")[0] >= self.times(name)[1] or self.times("gaps")[1] <= self.times(name)[0])
+
+    def test_failure(self):
+        def fail():
+            raise RuntimeError("stage failed")
+        scheduler = StageScheduler(1)
+        scheduler.add("split", fail)
+        scheduler.add("peaks", self.stage("peaks"), deps=["split"])
+        with self.assertRaises(RuntimeError):
+            asyncio.run(scheduler.run())
+        self.assertListEqual(self.events, [])
+
+    def test_unknown_dependency(self):
+        with self.assertRaises(ValueError):
+            StageScheduler(1).add("peaks", self.stage("peaks"), deps=["split"])
+
+    def test_blocking_stage_leaves_loop_running(self):
+        async def ticks():
+            for _ in range(5):
+                await asyncio.sleep(0.02)
+            return time.monotonic()
+        scheduler = StageScheduler(2)
+        scheduler.add("split", lambda: threading.current_thread() is threading.main_thread())
+        scheduler.add("spat", self.stage("spat", 0.3))
+        scheduler.add("peaks", ticks, cpus=0)
+        results = asyncio.run(scheduler.run())
+        self.assertFalse(results["split"])
+        self.assertLess(results["peaks"], self.times("spat")[1])
+
+    def test_pool_from_stage(self):
+        with multiprocessing.Pool(1) as pool:
+            scheduler = StageScheduler(1)
+            scheduler.add("spat", lambda: pool.apply(os.getpid))
+            scheduler.add("db", self.stage("db", 0.2), cpus=0)
+            self.assertNotEqual(asyncio.run(scheduler.run())["spat"], os.getpid())
+
+    def test_stage_using_no_slots(self):
+        scheduler = StageScheduler(1)
+        scheduler.add("split", self.stage("split", 0.2))
+        scheduler.add("db", self.stage("db", 0.2), cpus=0)
+        scheduler.add("peaks", self.stage("peaks", 0.2))
+        asyncio.run(scheduler.run())
+        self.assertLess(self.times("db")[0], self.times("split")[1])
+        self.assertGreaterEqual(self.times("peaks")[0], self.times("split")[1])
@@ -0,0 +1,176 @@
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+from peaks2utr.utils import CacheLock, atomic_output, atomic_outputs_dir, multiprocess_over_dict, \
+    yield_from_processes
+
+
+def send_items(conn, n, delay=0):
+    time.sleep(delay)
+    for i in range(n):
+        conn.send((os.getpid(), i))
+
+
+def crash(conn):
+    raise SystemExit(3)
+
+
+def record_run(name, output_dir):
+    start = time.monotonic()
+    time.sleep(0.1 if name != "bad" else 0)
+    if name == "bad":
+        raise ValueError("bad input")
+    with open(os.path.join(output_dir, name), "w") as f:
+        f.write("%f %f" % (start, time.monotonic()))
+
+
+def try_lock(lock_dir, shared, q):
+    lock = CacheLock("test", lock_dir)
+    q.put(lock.acquire(shared=shared, blocking=False))
+    lock.release()
+
+
+class TestCacheLock(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def try_lock_in_process(self, shared):
+        q = multiprocessing.Queue()
+        p = multiprocessing.Process(target=try_lock, args=(self.tmp_dir, shared, q))
+        p.start()
+        p.join()
+        return q.get()
+
+    def test_shared_and_exclusive(self):
+        with CacheLock("test", self.tmp_dir):
+            self.assertFalse(self.try_lock_in_process(shared=True))
+        lock = CacheLock("test", self.tmp_dir)
+        self.assertTrue(lock.acquire(shared=True))
+        self.assertTrue(self.try_lock_in_process(shared=True))
+        self.assertFalse(self.try_lock_in_process(shared=False))
+        lock.release()
+        self.assertTrue(self.try_lock_in_process(shared=False))
+
+    def test_relock_removed_file(self):
+        lock = CacheLock("test", os.path.join(self.tmp_dir, "cache"))
+        self.assertTrue(lock.acquire())
+        shutil.rmtree(os.path.dirname(lock.lock_fn))
+        lock.release()
+        self.assertTrue(lock.acquire())
+        self.assertEqual(os.stat(lock.lock_fn).st_ino, os.fstat(lock.f.fileno()).st_ino)
+        lock.release()
+
+
+class TestAtomicOutput(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        patcher = mock.patch("peaks2utr.constants.BAM_CACHE_DIR", self.tmp_dir)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_atomic_output(self):
+        fn = os.path.join(self.tmp_dir, "out.txt")
+        with atomic_output(fn) as tmp_file, open(tmp_file, "w") as f:
+            f.write("done")
+            self.assertFalse(os.path.exists(fn))
+        with open(fn) as f:
+            self.assertEqual(f.read(), "done")
+        with self.assertRaises(RuntimeError):
+            with atomic_output(os.path.join(self.tmp_dir, "failed.txt")) as tmp_file, open(tmp_file, "w") as f:
+                raise RuntimeError
+        self.assertListEqual(os.listdir(self.tmp_dir), ["out.txt"])
+
+    def test_atomic_outputs_dir(self):
+        with atomic_outputs_dir() as tmp_dir:
+            for fn in ["a.txt", "b.txt"]:
+                open(os.path.join(tmp_dir, fn), "w").close()
+            self.assertListEqual(os.listdir(self.tmp_dir), [os.path.basename(tmp_dir)])
+        self.assertSetEqual(set(os.listdir(self.tmp_dir)), {"a.txt", "b.txt"})
+        with self.assertRaises(RuntimeError):
+            with atomic_outputs_dir() as tmp_dir:
+                open(os.path.join(tmp_dir, "c.txt"), "w").close()
+                raise RuntimeError
+        self.assertSetEqual(set(os.listdir(self.tmp_dir)), {"a.txt", "b.txt"})
+
+
+class TestYieldFromProcesses(unittest.TestCase):
+
+    @staticmethod
+    def start(targets):
+        pipes = [multiprocessing.Pipe(duplex=False) for _ in targets]
+        processes = [multiprocessing.Process(target=target, args=(writer, *args))
+                     for (target, args), (_, writer) in zip(targets, pipes)]
+        for p in processes:
+            p.start()
+        for _, writer in pipes:
+            writer.close()
+        return [reader for reader, _ in pipes], processes
+
+    def test_collects_from_all_processes(self):
+        connections, processes = self.start([(send_items, (n, 0.2 if n == 5 else 0)) for n in [5, 2000, 0]])
+        items = list(yield_from_processes(connections, processes))
+        self.assertEqual(len(items), 2005)
+        self.assertTrue(all(not p.is_alive() for p in processes))
+
+    def test_raises_on_failed_process(self):
+        connections, processes = self.start([(send_items, (1, 30)), (crash, ())])
+        start = time.time()
+        with self.assertRaises(RuntimeError):
+            list(yield_from_processes(connections, processes, RuntimeError))
+        self.assertLess(time.time() - start, 10)
+        self.assertTrue(all(p.exitcode is not None for p in processes))
+
+
+class TestMultiprocessOverDict(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.pool = multiprocessing.Pool(2)
+
+    def tearDown(self):
+        self.pool.terminate()
+        self.pool.join()
+        shutil.rmtree(self.tmp_dir)
+
+    def runs(self):
+        runs = {}
+        for name in os.listdir(self.tmp_dir):
+            with open(os.path.join(self.tmp_dir, name)) as f:
+                runs[name] = tuple(map(float, f.read().split()))
+        return runs
+
+    def test_bounded_and_largest_first(self):
+        sizes = {"a": 1, "b": 5, "c": 3, "d": 2, "e": 4}
+        finished = []
+        multiprocess_over_dict(self.pool, record_run, {name: self.tmp_dir for name in sizes}, weight=sizes.get,
+                               callback=finished.append)
+        self.assertListEqual(sorted(finished), sorted(sizes))
+        runs = self.runs()
+        self.assertSetEqual(set(sorted(runs, key=lambda name: runs[name][0])[:2]), {"b", "e"})
+        running, most_running = 0, 0
+        for _, event in sorted((t, event) for start, end in runs.values() for t, event in [(start, 1), (end, -1)]):
+            running += event
+            most_running = max(most_running, running)
+        self.assertLessEqual(most_running, 2)
+
+    def test_failure_names_input(self):
+        with self.assertRaisesRegex(Exception, "record_run failed for bad:\n(.|\n)*ValueError: bad input"):
+            multiprocess_over_dict(self.pool, record_run, {"bad": self.tmp_dir, "a": self.tmp_dir})
+
+    def test_reuses_pool(self):
+        for name in "ab":
+            multiprocess_over_dict(self.pool, record_run, {name: self.tmp_dir})
+        self.assertSetEqual(set(self.runs()), {"a", "b"})